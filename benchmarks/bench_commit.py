@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures write throughput of a store for the durability modes. Group
+commit is simulated the way L{vinzclortho.core.LocalStorage} does it, by
+syncing once per batch of writes.
+
+Run from the top directory: python -m benchmarks.bench_commit
+"""
+
+import optparse
+import os
+import tempfile
+import time
+
+from vinzclortho import store
+
+def run(make_store, mode, writes, batch):
+    s = make_store(mode)
+    value = "x" * 100
+    t = time.time()
+    for i in xrange(writes):
+        s.put("key_%d"%i, value)
+        if mode == store.GROUP and (i + 1) % batch == 0:
+            s.sync()
+    if mode != store.SYNC:
+        s.sync()
+    return writes / (time.time() - t)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-w", "--writes", dest="writes", type="int", default=2000,
+                      help="Number of writes per mode")
+    parser.add_option("-b", "--batch", dest="batch", type="int", default=store.GroupCommit().max_batch,
+                      help="Writes per group commit")
+    parser.add_option("-s", "--store", dest="store", type="choice", choices=store.STORE_TYPES, default="sqlite",
+                      help="The store to measure (%s)"%", ".join(store.STORE_TYPES))
+    (options, args) = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    count = [0]
+    def make_store(mode):
+        count[0] = count[0] + 1
+        filename = os.path.join(directory, "bench_%d.db"%count[0])
+        if options.store == "bdb":
+            return store.BerkeleyDBStore(filename, mode)
+        elif options.store == "log":
+            return store.LogStore(filename, mode)
+        return store.SQLiteStore(filename, mode)
+
+    print "%-10s %14s" % ("mode", "writes/s")
+    for mode in store.DURABILITY_MODES:
+        print "%-10s %14.0f" % (mode, run(make_store, mode, options.writes, options.batch))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures the Deferred usage of a request: handlers that return results
+with succeed, results from the workers, a quorum read over three replicas,
+and a callback that returns another Deferred (like a request through the
+connection pool).
+
+Run from the top directory: python -m benchmarks.bench_deferred
+"""
+
+import functools
+import optparse
+import time
+
+import tangled.core as tc
+
+def ok(result):
+    return result
+
+def failed(failure):
+    return None
+
+def replica_ok(replica, result):
+    return result
+
+def replica_failed(replica, failure):
+    return None
+
+def succeed():
+    d = tc.succeed("response")
+    d.add_callbacks(ok, failed)
+
+def fire():
+    d = tc.Deferred()
+    d.add_callbacks(functools.partial(replica_ok, 0), functools.partial(replica_failed, 0))
+    d.callback("value")
+
+def quorum():
+    response = tc.Deferred()
+    results = []
+    def got(replica, result):
+        results.append(result)
+        if len(results) == 2:
+            response.callback(result)
+        return result
+    replicas = [tc.Deferred() for i in range(3)]
+    for i, d in enumerate(replicas):
+        d.add_callbacks(functools.partial(got, i), functools.partial(replica_failed, i))
+        d.add_both(tc.passthru)
+    response.add_callbacks(ok, failed)
+    for d in replicas:
+        d.callback("value")
+
+def chained():
+    request = tc.Deferred()
+    d = tc.Deferred()
+    d.add_callback(lambda result: request)
+    d.add_callbacks(ok, failed)
+    d.callback(None)
+    request.callback("response")
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--iterations", dest="iterations", type="int", default=100000,
+                      help="Iterations per scenario")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+                      help="Report the best of this many runs")
+    (options, args) = parser.parse_args()
+
+    print "%-10s %14s" % ("scenario", "per second")
+    for func in (succeed, fire, quorum, chained):
+        best = None
+        for r in range(options.repeat):
+            t = time.time()
+            for i in xrange(options.iterations):
+                func()
+            elapsed = time.time() - t
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%-10s %14.0f" % (func.__name__, options.iterations / best)
+
+if __name__ == "__main__":
+    main()
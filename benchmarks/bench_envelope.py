@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures encoding and decoding of stored values for a few value sizes,
+with the binary envelope and with the bz2 compressed pickles used before.
+
+Run from the top directory: python -m benchmarks.bench_envelope
+"""
+
+import bz2
+import cPickle as pickle
+import optparse
+import os
+import time
+
+from vinzclortho import envelope
+from vinzclortho import vectorclock
+
+def legacy_encode(vc, value):
+    return bz2.compress(pickle.dumps((vc, value)))
+
+def legacy_decode(blob):
+    return pickle.loads(bz2.decompress(blob))
+
+def timeit(func, arg, iterations):
+    t = time.time()
+    for i in xrange(iterations):
+        func(*arg)
+    return (time.time() - t) / iterations
+
+def make_value(size):
+    # Half random, half repetitive, so that compression has something to work with
+    return os.urandom(size // 2) + "x" * (size - size // 2)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-i", "--iterations", dest="iterations", type="int", default=2000,
+                      help="Number of encodes/decodes per measurement")
+    (options, args) = parser.parse_args()
+
+    vc = vectorclock.VectorClock()
+    vc.increment("some client id")
+    for port in (8080, 8081, 8082):
+        vc.increment(("192.168.0.1", port))
+
+    print "%8s %-16s %12s %12s %10s" % ("size", "format", "encode (us)", "decode (us)", "bytes")
+    for size in (16, 256, 4096, 65536):
+        value = make_value(size)
+        iterations = max(10, options.iterations * 256 // max(size, 256))
+        formats = [("bz2+pickle", legacy_encode, legacy_decode),
+                   ("envelope", lambda vc, value: envelope.encode(vc, value, size + 1), envelope.decode),
+                   ("envelope+zlib", lambda vc, value: envelope.encode(vc, value, 0), envelope.decode)]
+        for name, enc, dec in formats:
+            blob = enc(vc, value)
+            assert str(dec(blob)[1]) == value
+            print "%8d %-16s %12.2f %12.2f %10d" % (size, name,
+                                                   timeit(enc, (vc, value), iterations) * 1e6,
+                                                   timeit(dec, (blob,), iterations) * 1e6,
+                                                   len(blob))
+
+if __name__ == "__main__":
+    main()
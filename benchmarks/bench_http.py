@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures the cost of small HTTP requests in the server: parsing a request
+with RequestParser and with BaseHTTPRequestHandler/mimetools like the
+server used to, dispatching it with the route table and with the regex
+loop that constructed a handler for each request, and the throughput of
+a server in this process for requests sent one at a time and pipelined
+on a persistent connection.
+
+Run from the top directory: python -m benchmarks.bench_http
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+import asyncore
+import cStringIO
+import optparse
+import re
+import socket
+import threading
+import time
+
+from tangled import core as tc
+from tangled import server as ts
+
+REQUEST = ("GET /_localstore/some_key_1234 HTTP/1.1\r\n"
+           "Host: 127.0.0.1:9000\r\n"
+           "Accept-Encoding: identity\r\n"
+           "X-VinzClortho-Timeout: 2000\r\n"
+           "X-VinzClortho-Digest: 1\r\n"
+           "\r\n")
+
+class Handler(object):
+    reusable = True
+    def __init__(self, context):
+        self.context = context
+    def do_GET(self, request):
+        return tc.succeed(ts.Response(200, None, "value"))
+
+# The routes of a VinzClortho node
+ROUTES = [(r"/store(?:\?.*)?$", Handler),
+          (r"/store/([^?]*)", Handler),
+          (r"/_localstore$", Handler),
+          (r"/_localstore/(.*)", Handler),
+          (r"/_hint/(.*)", Handler),
+          (r"/_handoff", Handler),
+          (r"/_metadata", Handler),
+          (r"/_merkle/(\d+)/(\d+)", Handler),
+          (r"/admin/(.*)", Handler)]
+
+PATHS = ["/store/key", "/_localstore/key", "/_merkle/3/2", "/admin/claim"]
+
+class LegacyParser(BaseHTTPRequestHandler):
+    def __init__(self, data):
+        self.rfile = cStringIO.StringIO(data)
+        self.raw_requestline = self.rfile.readline()
+        self.parse_request()
+        self.headers.getheader("transfer-encoding")
+        self.headers.getheader("content-length", 0)
+
+def legacy_route(routes, path):
+    for r, cls in routes:
+        m = r.match(path)
+        if m is not None:
+            return cls(None), m
+
+def timeit(func, args, iterations):
+    t = time.time()
+    for i in xrange(iterations):
+        func(*args)
+    return (time.time() - t) / iterations
+
+def throughput(port, requests, depth):
+    """Sends requests, depth of them at a time, returns the requests per second"""
+    s = socket.create_connection(("127.0.0.1", port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    request = REQUEST.replace("/_localstore/some_key_1234", "/_localstore/k")
+    end = "\r\n\r\nvalue"
+    t = time.time()
+    for i in xrange(requests // depth):
+        s.sendall(request * depth)
+        data = ""
+        while data.count(end) < depth:
+            data = data + s.recv(65536)
+    elapsed = time.time() - t
+    s.close()
+    return requests // depth * depth / elapsed
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-i", "--iterations", dest="iterations", type="int", default=20000,
+                      help="Number of requests to parse and route")
+    parser.add_option("-r", "--requests", dest="requests", type="int", default=5000,
+                      help="Number of requests to send to the server")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8765,
+                      help="Port of the server")
+    (options, args) = parser.parse_args()
+
+    n = options.iterations
+    print "%-24s %14s %14s" % ("", "new (us)", "legacy (us)")
+    # A parser reads all the requests of a connection
+    print "%-24s %14.2f %14.2f" % ("parse request",
+                                   timeit(ts.RequestParser(1024, 1024).feed, (REQUEST,), n) * 1e6,
+                                   timeit(LegacyParser, (REQUEST,), n) * 1e6)
+    table = ts.RouteTable(ROUTES, None)
+    compiled = [(re.compile(r), h) for r, h in ROUTES]
+    for path in PATHS:
+        print "%-24s %14.2f %14.2f" % ("route " + path,
+                                       timeit(table.match, (path,), n) * 1e6,
+                                       timeit(legacy_route, (compiled, path), n) * 1e6)
+
+    server = ts.AsyncHTTPServer(("127.0.0.1", options.port), None, ROUTES)
+    thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.1})
+    thread.setDaemon(True)
+    thread.start()
+    print
+    print "%-24s %14s" % ("pipeline depth", "requests/s")
+    for depth in (1, 16):
+        print "%-24d %14.0f" % (depth, throughput(options.port, options.requests, depth))
+    server.close()
+    thread.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Compares the poller backends of the reactor with a lot of idle sockets
+and some active ones. Each active connection is a socket pair that
+echoes a small message back and forth, the idle ones are sockets that
+never become readable.
+
+Run from the top directory: python -m benchmarks.bench_poller
+"""
+
+import asyncore
+import optparse
+import socket
+import time
+
+from tangled import core
+
+class Idle(asyncore.dispatcher):
+    def __init__(self, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(1)
+
+
+class Echo(asyncore.dispatcher):
+    def __init__(self, sock, map, counter):
+        asyncore.dispatcher.__init__(self, sock, map=map)
+        self.counter = counter
+        self.out = ""
+
+    def writable(self):
+        return len(self.out) > 0
+
+    def handle_read(self):
+        data = self.recv(4096)
+        self.counter[0] += 1
+        self.out += data
+
+    def handle_write(self):
+        sent = self.send(self.out)
+        self.out = self.out[sent:]
+
+
+def run(poller, idle, active, duration):
+    map = {}
+    counter = [0]
+    try:
+        for i in range(idle):
+            Idle(map)
+        for i in range(active):
+            a, b = socket.socketpair()
+            Echo(a, map, counter).out = "ping"
+            Echo(b, map, counter)
+        iterations = 0
+        start = time.time()
+        while time.time() - start < duration:
+            poller.poll(1.0, map)
+            iterations += 1
+        elapsed = time.time() - start
+        return iterations / elapsed, counter[0] / elapsed
+    finally:
+        for obj in map.values():
+            obj.close()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-i", "--idle", dest="idle", type="int", default=10000,
+                      help="Number of idle sockets")
+    parser.add_option("-a", "--active", dest="active", type="int", default=500,
+                      help="Number of active connections")
+    parser.add_option("-t", "--time", dest="duration", type="float", default=3.0,
+                      help="Seconds to run each backend")
+    (options, args) = parser.parse_args()
+
+    backends = [("select", core.SelectPoller), ("poll", core.PollPoller), ("epoll", core.EpollPoller)]
+    print "%d idle + %d active connections" % (options.idle, options.active)
+    print "%8s %14s %14s" % ("backend", "polls/s", "messages/s")
+    for name, cls in backends:
+        try:
+            polls, messages = run(cls(), options.idle, options.active, options.duration)
+        except (ValueError, AttributeError), e:
+            print "%8s %s" % (name, e)
+            continue
+        print "%8s %14.1f %14.1f" % (name, polls, messages)
+
+if __name__ == "__main__":
+    main()
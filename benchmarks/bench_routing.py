@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures the cost of routing a request, i.e. going from a key to the
+list of preferred nodes, for a few ring sizes. The legacy numbers walk
+the whole ring like Ring.preferred used to do.
+
+Run from the top directory: python -m benchmarks.bench_routing
+"""
+
+import functools
+import optparse
+import time
+
+from vinzclortho import consistenthashing as chash
+
+def make_ring(partitions, nodes, N):
+    first = chash.Node("node_0", 8080)
+    ring = chash.Ring(partitions, first, N)
+    # Ring.add_node is quadratic in the number of partitions, so
+    # distribute the partitions round robin instead
+    ring.nodes = [first] + [chash.Node("node_%d"%i, 8080) for i in range(1, nodes)]
+    ring.N = min(nodes, N)
+    for n in ring.nodes:
+        n.claim = []
+    for p in range(partitions):
+        n = ring.nodes[p % nodes]
+        n.claim.append(p)
+        ring.partitions[p] = n
+    return ring
+
+def legacy_preferred(ring, key):
+    cwnodelist = [ring.partitions[p] for p in ring._walk_cw(ring.key_to_partition(key))]
+    return cwnodelist[:ring.N], cwnodelist[ring.N:]
+
+def timeit(func, keys):
+    t = time.time()
+    for k in keys:
+        func(k)
+    return (time.time() - t) / len(keys)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--nodes", dest="nodes", type="int", default=16,
+                      help="Number of nodes in the ring")
+    parser.add_option("-k", "--keys", dest="keys", type="int", default=2000,
+                      help="Number of keys to route")
+    (options, args) = parser.parse_args()
+
+    keys = ["key_%d"%i for i in range(options.keys)]
+    print "%10s %14s %14s %14s" % ("partitions", "build (ms)", "table (us)", "legacy (us)")
+    for partitions in (512, 4096, 65536):
+        ring = make_ring(partitions, options.nodes, 3)
+        t = time.time()
+        ring.preference_list(0)
+        build = time.time() - t
+        table = timeit(ring.preferred, keys)
+        legacy = timeit(functools.partial(legacy_preferred, ring), keys[:max(10, options.keys * 512 // partitions)])
+        print "%10d %14.1f %14.2f %14.2f" % (partitions, build * 1e3, table * 1e6, legacy * 1e6)
+
+if __name__ == "__main__":
+    main()
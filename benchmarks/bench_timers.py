@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Compares the L{tangled.core.TimerWheel} of the reactor with a heap of
+timers (how L{tangled.core.Reactor.call_later} used to keep them, with
+cancelled timers left in the heap) when many timers are pending, like
+request timeouts that are almost always cancelled.
+
+Run from the top directory: python -m benchmarks.bench_timers
+"""
+
+import heapq
+import optparse
+import random
+import time
+
+import tangled.core as tc
+
+class TimerHeap(object):
+    """The timers in a heap, ordered by time"""
+    def __init__(self, now=None):
+        self._heap = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, timer):
+        self._sequence = self._sequence + 1
+        heapq.heappush(self._heap, (timer.when, self._sequence, timer))
+        return timer
+
+    def expire(self, now):
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if not timer.cancelled:
+                due.append(timer)
+        return due
+
+    def timeout(self, now):
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - now)
+
+def nothing():
+    pass
+
+def run(cls, timers, cancel, steady, seed):
+    random.seed(seed)
+    now = 1000.0
+    queue = cls(now=now)
+    delays = [random.uniform(0.1, 30.0) for i in xrange(timers)]
+    results = {}
+
+    t = time.time()
+    handles = [queue.add(tc.Timer(now + delay, nothing)) for delay in delays]
+    results["schedule"] = timers / (time.time() - t)
+
+    victims = random.sample(handles, int(timers * cancel))
+    t = time.time()
+    for timer in victims:
+        timer.cancel()
+    results["cancel"] = len(victims) / (time.time() - t)
+
+    # A request each 1/10 ms: schedule its timeout, and cancel it when it's
+    # answered, while the clock moves on
+    t = time.time()
+    for i in xrange(steady):
+        now = now + 0.0001
+        queue.add(tc.Timer(now + delays[i % timers], nothing)).cancel()
+        queue.expire(now)
+        queue.timeout(now)
+    results["steady"] = steady / (time.time() - t)
+
+    # Run the rest, polling with a 10 ms resolution
+    fired = 0
+    t = time.time()
+    while len(queue):
+        now = now + max(queue.timeout(now), 0.01)
+        fired = fired + len(queue.expire(now))
+    results["expire"] = (time.time() - t) * 1000
+    results["fired"] = fired
+    return results
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--timers", dest="timers", type="int", default=100000,
+                      help="Number of pending timers")
+    parser.add_option("-c", "--cancel", dest="cancel", type="float", default=0.9,
+                      help="Fraction of the timers that are cancelled")
+    parser.add_option("-s", "--steady", dest="steady", type="int", default=100000,
+                      help="Number of schedule/cancel pairs with the timers pending")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Report the best of this many runs")
+    (options, args) = parser.parse_args()
+
+    print "%-6s %12s %12s %12s %12s %8s" % ("queue", "schedule/s", "cancel/s", "steady/s", "expire(ms)", "fired")
+    for name, cls in (("heap", TimerHeap), ("wheel", tc.TimerWheel)):
+        best = None
+        for r in range(options.repeat):
+            results = run(cls, options.timers, options.cancel, options.steady, r)
+            if best is None:
+                best = results
+            else:
+                for k in ("schedule", "cancel", "steady"):
+                    best[k] = max(best[k], results[k])
+                best["expire"] = min(best["expire"], results["expire"])
+        print "%-6s %12.0f %12.0f %12.0f %12.1f %8d" % (name, best["schedule"], best["cancel"], best["steady"],
+                                                       best["expire"], best["fired"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures how many worker results per second the reactor can take in,
+that is, the cost of waking the main loop and running the callbacks
+there. The calls themselves do nothing.
+
+Run from the top directory: python -m benchmarks.bench_trigger
+"""
+
+import asyncore
+import optparse
+import time
+
+import tangled.core as tc
+
+def run(reactor, pool, calls, lanes, in_flight):
+    done = [0]
+    sent = [0]
+    def complete(result):
+        done[0] = done[0] + 1
+        if sent[0] < calls:
+            submit()
+    def submit():
+        lane = pool.lane(sent[0] % lanes)
+        sent[0] = sent[0] + 1
+        reactor.defer_to_worker(int, lane).add_callback(complete)
+    t = time.time()
+    for i in xrange(min(in_flight, calls)):
+        submit()
+    while done[0] < calls:
+        reactor.poller.poll(1.0, asyncore.socket_map)
+    return calls / (time.time() - t)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--calls", dest="calls", type="int", default=50000,
+                      help="Number of calls")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=4,
+                      help="Number of worker threads")
+    parser.add_option("-i", "--in-flight", dest="in_flight", default="1,16,256",
+                      help="Comma separated numbers of calls kept in flight",
+                      metavar="N[,N...]")
+    (options, args) = parser.parse_args()
+
+    reactor = tc.Reactor()
+    pool = tc.WorkerPool(reactor, options.threads)
+    print "%-10s %16s" % ("in flight", "completions/s")
+    for in_flight in [int(n) for n in options.in_flight.split(",")]:
+        print "%-10d %16.0f" % (in_flight, run(reactor, pool, options.calls, options.threads * 4, in_flight))
+    pool.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Measures how long calls for the partitions wait when one partition is
+slow (as when it's being handed off), with one L{tangled.core.Worker} per
+partition modulo the number of workers, and with a
+L{tangled.core.WorkerPool} that has one lane per partition. The calls
+sleep, to simulate waiting for the disk.
+
+Run from the top directory: python -m benchmarks.bench_workers
+"""
+
+import optparse
+import threading
+import time
+
+import tangled.core as tc
+
+def run(get_worker, partitions, calls, fast, slow):
+    done = threading.Event()
+    latencies = []
+    remaining = [calls * partitions]
+    lock = threading.Lock()
+    def complete(start, result):
+        lock.acquire()
+        latencies.append(time.time() - start)
+        remaining[0] = remaining[0] - 1
+        if remaining[0] == 0:
+            done.set()
+        lock.release()
+    t = time.time()
+    for i in xrange(calls):
+        for p in xrange(partitions):
+            # Partition 0 is the slow one
+            delay = slow if p == 0 else fast
+            get_worker(p).execute(lambda delay=delay: time.sleep(delay),
+                                  lambda result, start=time.time(): complete(start, result))
+    done.wait()
+    elapsed = time.time() - t
+    latencies.sort()
+    return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=8,
+                      help="Number of threads")
+    parser.add_option("-p", "--partitions", dest="partitions", type="int", default=64,
+                      help="Number of partitions")
+    parser.add_option("-c", "--calls", dest="calls", type="int", default=20,
+                      help="Calls per partition")
+    parser.add_option("-f", "--fast", dest="fast", type="float", default=0.0005,
+                      help="Seconds per call to the other partitions")
+    parser.add_option("-s", "--slow", dest="slow", type="float", default=0.02,
+                      help="Seconds per call to the slow partition")
+    (options, args) = parser.parse_args()
+
+    workers = [tc.Worker(None, True) for i in range(options.threads)]
+    pool = tc.WorkerPool(None, options.threads)
+    print "%-12s %10s %10s %10s" % ("scheme", "total(s)", "p50(ms)", "p99(ms)")
+    for name, get_worker in (("pinned", lambda p: workers[p % len(workers)]),
+                             ("pool", pool.lane)):
+        elapsed, p50, p99 = run(get_worker, options.partitions, options.calls, options.fast, options.slow)
+        print "%-12s %10.2f %10.1f %10.1f" % (name, elapsed, p50 * 1000, p99 * 1000)
+    for w in workers:
+        w.stop()
+    pool.stop()
+
+if __name__ == "__main__":
+    main()
@@ -4,30 +4,47 @@
 # See LICENSE for details.
 
 import asyncore
+import collections
+import functools
 import socket
+import time
 import urlparse
-import mimetools
-import cStringIO
 import core
+import server
 
 import logging
 log = logging.getLogger("tangled.client")
 
+class TimeoutError(Exception):
+    """A connection attempt or a request didn't finish in time"""
+    pass
+
+
 class Response(object):
     """
-    This is the response object returned by L{AsyncHTTPClient}. 
+    This is the response object returned by L{AsyncHTTPClient}. If the
+    request failed before a response was received, status is None.
+
+    The body is collected in pieces, and is available as data when the
+    response is complete.
     """
     def __init__(self, addr):
         self.data = ""
         self.header = ""
+        self.status = None
+        self.reason = ""
         self.finished = False
         self.server_address = addr
+        self._parts = []
 
     def close(self):
         self.finished = True
+        if self._parts:
+            self.data = "".join(self._parts)
+            self._parts = []
 
     def feed(self, data):
-        self.data += data
+        self._parts.append(data)
 
     def http_header(self, header):
         self.header = header
@@ -40,42 +57,178 @@ class Response(object):
             self.reason = ""
 
 
-class AsyncHTTPClient(asyncore.dispatcher_with_send):
+def split_url(url):
+    """Returns ((host, port), path) for url"""
+    parsed = urlparse.urlparse(url)
+    addr = parsed.netloc.split(":")
+    host = addr[0]
+    try:
+        port = int(addr[1])
+    except IndexError:
+        port = 80
+    path = parsed.path
+    if parsed.query:
+        path = path + "?" + parsed.query
+    return (host, port), path
+
+
+def _cancel_timer(timer, result):
+    timer.cancel()
+    return result
+
+
+class HTTPConnection(asyncore.dispatcher):
     """
-    Asynchronous HTTP client, based on
-    http://effbot.org/librarybook/SimpleAsyncHTTP.py
+    An asynchronous HTTP/1.1 client connection. It can be used for several
+    requests, one at a time, as long as the server keeps the connection
+    open.
+
+    The body of a request is queued as it is, and sent straight from the
+    strs (or buffers) it's made of, so several requests can share one
+    large body without copying it. Small pieces, like the header and a
+    small body, are joined to be sent together (see L{server.coalesce}).
+    A body that is an iterable of unknown length is sent with the chunked
+    transfer encoding, and chunked responses are decoded.
+
+    Timeouts are only available if a reactor is provided. A request that
+    times out fails with a L{TimeoutError}, and the connection is closed.
+
+    @param address: Tuple of host, port
+    @param pool: The L{ConnectionPool} that owns this connection, if any
+    @param reactor: Used for the timeouts
+    @type reactor: L{core.Reactor}
+    @param connect_timeout: Seconds to wait for the connection to be established
     """
-    def __init__(self, url, command="GET", data="", consumer=None):
-        asyncore.dispatcher_with_send.__init__(self)
-        parsed = urlparse.urlparse(url)
-        self._request = '%s %s HTTP/1.1\r\n' % (command, parsed.path)
-        self._request = self._request + 'Host: %s\r\n' % parsed.netloc
-        if len(data) > 0:
-            self._request = self._request + 'Content-Length: %d\r\n\r\n%s' % (len(data), data)
+    send_size = 65536
+
+    def __init__(self, address, pool=None, reactor=None, connect_timeout=None):
+        asyncore.dispatcher.__init__(self)
+        self.address = address
+        self.pool = pool
+        self.reactor = reactor
+        self.requests = 0
+        self.last_used = time.time()
+        self._result = None
+        # The strs, buffers and producers to send, the first one from _offset
+        self._out = collections.deque()
+        self._offset = 0
+        self._connect_timer = None
+        self._request_timer = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        if reactor is not None and connect_timeout is not None:
+            self._connect_timer = reactor.call_later(self._connect_timed_out, connect_timeout)
+
+    def _connect_timed_out(self):
+        if not self.connected and self.socket is not None:
+            self._timed_out("Connecting to %s:%d timed out"%self.address)
+
+    def _request_timed_out(self, request):
+        if self._result is not None and self.requests == request:
+            self._timed_out("Request to %s:%d timed out"%self.address)
+
+    def _timed_out(self, message):
+        log.debug(message)
+        result, self._result = self._result, None
+        # A late response must not be mistaken for the next one
+        self.close()
+        if result is not None:
+            result.errback(core.Failure(TimeoutError(message)))
+
+    def send_request(self, command, path, data="", headers=None, consumer=None, keep_alive=True, timeout=None):
+        """
+        Sends a request on this connection.
+
+        @param command: "GET", "PUT", etc.
+        @param path: The uri of the request, /foo/bar
+        @param data: The body of the request, a str, buffer, list of those, or an iterable of strs to send chunked
+        @param headers: A dictionary of extra headers
+        @param consumer: The object that receives the response, a L{Response} is created if not provided
+        @param keep_alive: If false, the server is asked to close the connection after responding
+        @param timeout: Seconds to wait for the complete response
+        @return: A L{core.Deferred} that will get the consumer when the response is complete
+        """
+        assert self._result is None, "A request is already in progress"
+        request = ['%s %s HTTP/1.1\r\n' % (command, path),
+                   'Host: %s:%d\r\n' % self.address]
+        if not keep_alive:
+            request.append('Connection: close\r\n')
+        if headers:
+            for k, v in headers.items():
+                request.append('%s: %s\r\n' % (k, v))
+        if isinstance(data, (basestring, buffer)):
+            data = [data]
+        if isinstance(data, list):
+            request.append('Content-Length: %d\r\n\r\n' % sum([len(d) for d in data]))
         else:
-            self._request = self._request + "\r\n"
-        addr = parsed.netloc.split(":")
-        host = addr[0]
-        try:
-            port = int(addr[1])
-        except IndexError:
-            port = 80
+            request.append('Transfer-Encoding: chunked\r\n\r\n')
+            data = [server.StreamProducer(data, True, self.handle_error)]
         self.consumer = consumer
         if self.consumer is None:
-            self.consumer = Response((host, port))
-            self.response = self.consumer
+            self.consumer = Response(self.address)
+        self.response = self.consumer
+        self.keep_alive = keep_alive
+        self.command = command
         self.status = None
         self.header = None
         self.data = ""
+        self.received = False
+        self._remaining = None
+        self._chunked = None
         self._result = core.Deferred()
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect((host, port))
+        self.requests += 1
+        self.last_used = time.time()
+        result = self._result
+        if timeout is not None and self.reactor is not None:
+            self._request_timer = self.reactor.call_later(functools.partial(self._request_timed_out, self.requests),
+                                                          timeout)
+        self._out.append("".join(request))
+        self._out.extend([d for d in data if not isinstance(d, basestring) or d])
+        if self.connected:
+            # Otherwise sent when connected
+            self.initiate_send()
+        return result
 
-    def request(self):
-        return self._result
+    @property
+    def busy(self):
+        return self._result is not None
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_write(self):
+        self.initiate_send()
+
+    def initiate_send(self):
+        while self._out and self.connected:
+            first = self._out[0]
+            if not isinstance(first, (basestring, buffer)):
+                # The chunks of a body, taken as they can be sent
+                data = first.more()
+                if self._out and self._out[0] is first:
+                    if data:
+                        self._out.appendleft(data)
+                    else:
+                        self._out.popleft()
+                continue
+            if self._offset == 0:
+                first = server.coalesce(self._out, self.send_size)
+                if not self.connected:
+                    return
+            size = min(len(first) - self._offset, self.send_size)
+            num_sent = self.send(buffer(first, self._offset, size))
+            self._offset += num_sent
+            if self._offset == len(first):
+                self._out.popleft()
+                self._offset = 0
+            if num_sent < size:
+                # Wait until the socket is writable again
+                return
 
     def handle_connect(self):
-        self.send(self._request)
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
 
     def notify_header(self):
         self.consumer.http_status(self.status)
@@ -83,38 +236,333 @@ class AsyncHTTPClient(asyncore.dispatcher_with_send):
 
     def handle_expt(self):
         # connection failed; notify consumer (status is None)
-        self.close()
-        self.notify_header()
-        self._result.callback(self.response)
+        self.handle_close()
+
+    def handle_error(self):
+        log.debug("Connection to %s:%d failed", *self.address, exc_info=True)
+        self.handle_close()
+
+    def _body_length(self):
+        if self.command == "HEAD" or self.status[1][:1] == "1" or self.status[1] in ("204", "304"):
+            return 0
+        if "chunked" in self.header.getheader("transfer-encoding", "").lower():
+            # Decoded by _feed_chunked
+            self._chunked = ""
+            return None
+        length = self.header.getheader("content-length")
+        if length is None:
+            # Read until the server closes the connection
+            return None
+        return int(length)
 
     def handle_read(self):
-        data = self.recv(2048)
-        if not self.header:
+        data = self.recv(65536)
+        if not data or self._result is None:
+            return
+        self.received = True
+        if self.status is None:
             self.data = self.data + data
             i = self.data.find("\r\n\r\n")
-            if i != -1:
-                # parse header
-                fp = cStringIO.StringIO(self.data[:i+4])
-                # status line is "HTTP/version status message"
-                status = fp.readline()
-                self.status = status.split(" ", 2)
-                # followed by a rfc822-style message header
-                self.header = mimetools.Message(fp)
-                # followed by a newline, and the payload (if any)
-                data = self.data[i+4:]
-                self.data = ""
-                # notify consumer (status is non-zero)
-                self.notify_header()
-                if not self.connected:
-                    return # channel was closed by consumer
+            if i == -1:
+                return
+            # status line is "HTTP/version status message"
+            lines = self.data[:i].split("\r\n")
+            self.status = lines[0].split(" ", 2)
+            # followed by the headers
+            try:
+                self.header = server.parse_headers(lines[1:])
+            except server.HTTPError:
+                self.handle_error()
+                return
+            # followed by a newline, and the payload (if any)
+            data = self.data[i+4:]
+            self.data = ""
+            self._remaining = self._body_length()
+            if self.header.getheader("connection", "").lower() == "close":
+                self.keep_alive = False
+            # notify consumer (status is non-zero)
+            self.notify_header()
+            if not self.connected:
+                return # channel was closed by consumer
 
-        if self.header:
+        if self._chunked is not None:
+            if self._feed_chunked(data):
+                self._finished()
+        elif self._remaining is None:
             self.consumer.feed(data)
+        else:
+            if data:
+                self.consumer.feed(data[:self._remaining])
+                self._remaining -= min(len(data), self._remaining)
+            if self._remaining == 0:
+                self._finished()
 
-    def handle_close(self):
+    def _feed_chunked(self, data):
+        """Decodes a chunked body, returns True when it has been read"""
+        while data:
+            if self._remaining > 0:
+                chunk = data[:self._remaining]
+                self.consumer.feed(chunk)
+                self._remaining -= len(chunk)
+                data = data[len(chunk):]
+                continue
+            # The size of the next chunk, the line that ends a chunk, or the trailer
+            self._chunked = self._chunked + data
+            i = self._chunked.find("\r\n")
+            if i == -1:
+                return False
+            line, data = self._chunked[:i], self._chunked[i+2:]
+            self._chunked = ""
+            if self._remaining is None:
+                size = int(line.split(";", 1)[0].strip(), 16)
+                if size == 0:
+                    self._remaining = -1
+                else:
+                    self._remaining = size
+            elif self._remaining == 0:
+                # The end of a chunk
+                self._remaining = None
+            elif not line:
+                # The end of the trailer
+                return True
+        return False
+
+    def _finished(self):
+        """The response is complete, the connection can be reused or closed"""
+        result, self._result = self._result, None
+        response = self.response
+        if self._request_timer is not None:
+            self._request_timer.cancel()
+            self._request_timer = None
         self.consumer.close()
-        self.close()
-        self._result.callback(self.response)
+        self.last_used = time.time()
+        if not self.keep_alive:
+            self.close()
+        elif self.pool is not None:
+            # This may start the next request on this connection
+            self.pool.release(self)
+        result.callback(response)
+
+    def close(self):
+        for timer in (self._connect_timer, self._request_timer):
+            if timer is not None:
+                timer.cancel()
+        self._connect_timer = self._request_timer = None
+        self._out.clear()
+        self._offset = 0
+        asyncore.dispatcher.close(self)
+        if self.pool is not None:
+            self.pool.connection_closed(self)
+
+    def handle_close(self):
+        if self._result is not None:
+            if self.header is not None and self._remaining is None and self._chunked is None:
+                # The end of the response is the end of the connection
+                self.keep_alive = False
+                self._finished()
+                return
+            result, self._result = self._result, None
+            self.consumer.close()
+            self.close()
+            result.callback(self.response)
+        else:
+            self.close()
+
+
+class AsyncHTTPClient(HTTPConnection):
+    """
+    Asynchronous HTTP client, based on
+    http://effbot.org/librarybook/SimpleAsyncHTTP.py
+
+    Makes a single request, and closes the connection when done.
+    """
+    def __init__(self, url, command="GET", data="", consumer=None):
+        address, path = split_url(url)
+        HTTPConnection.__init__(self, address)
+        self._deferred = self.send_request(command, path, data, consumer=consumer, keep_alive=False)
+
+    def request(self):
+        return self._deferred
+
+
+class ConnectionPool(object):
+    """
+    Keeps persistent connections to any number of destinations. At most
+    L{max_size} connections are opened per destination, requests beyond
+    that wait for a connection to become available.
+
+    Connections that have been idle for L{idle_timeout} seconds are closed.
+    This is checked whenever a connection is needed, and periodically if
+    a reactor is provided.
+
+    @param reactor: Used to schedule eviction of idle connections and timeouts
+    @type reactor: L{core.Reactor}
+    @param connect_timeout: Seconds to wait for a new connection to be established
+    """
+    def __init__(self, reactor=None, max_size=8, idle_timeout=30.0, connect_timeout=None):
+        self.reactor = reactor
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        # address -> list of idle connections, most recently used last
+        self._idle = collections.defaultdict(list)
+        # address -> set of connections that are in use or connecting
+        self._busy = collections.defaultdict(set)
+        # address -> deque of requests waiting for a connection
+        self._waiting = collections.defaultdict(collections.deque)
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.errors = 0
+        if self.reactor is not None:
+            self.reactor.call_later(self._evict_periodically, self.idle_timeout)
+
+    def stats(self):
+        """Returns a dictionary with the pool counters"""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "idle": sum([len(c) for c in self._idle.values()]),
+                "busy": sum([len(c) for c in self._busy.values()]),
+                "waiting": sum([len(w) for w in self._waiting.values()])}
+
+    def request(self, url, command="GET", data="", headers=None, timeout=None):
+        """
+        Makes a request using a pooled connection
+
+        @param timeout: Seconds to wait for the response, including the time spent waiting for a connection
+        @return: A L{core.Deferred} that will get a L{Response}, or fail with L{TimeoutError}
+        """
+        address, path = split_url(url)
+        d = core.Deferred()
+        deadline = None
+        if timeout is not None and self.reactor is not None:
+            deadline = time.time() + timeout
+            timer = self.reactor.call_later(functools.partial(self._expired, address, d), timeout)
+            d.add_both(functools.partial(_cancel_timer, timer))
+        self._submit(address, (command, path, data, headers, deadline), d, True)
+        return d
+
+    def _expired(self, address, d):
+        if not d.called:
+            # Still waiting for a connection, requests that were sent
+            # are timed out by their connection
+            self.timeouts += 1
+            self._waiting[address] = collections.deque([w for w in self._waiting[address] if w[1] is not d])
+            d.errback(core.Failure(TimeoutError("Request to %s:%d timed out"%address)))
+
+    def _submit(self, address, request, d, retry):
+        conn = self._checkout(address)
+        if conn is not None:
+            self.hits += 1
+        elif len(self._busy[address]) >= self.max_size:
+            self.waits += 1
+            self._waiting[address].append((request, d, retry))
+            return
+        else:
+            self.misses += 1
+            conn = HTTPConnection(address, self, self.reactor, self.connect_timeout)
+        self._send(conn, address, request, d, retry and conn.requests > 0)
+
+    def _send(self, conn, address, request, d, retry):
+        self._busy[address].add(conn)
+        command, path, data, headers, deadline = request
+        timeout = None
+        if deadline is not None:
+            timeout = max(0.0, deadline - time.time())
+        r = conn.send_request(command, path, data, headers, timeout=timeout)
+        r.add_callbacks(functools.partial(self._completed, conn, address, request, d, retry),
+                        functools.partial(self._failed, d))
+
+    def _next_waiting(self, address):
+        """Returns the next request waiting for a connection that hasn't timed out"""
+        waiting = self._waiting.get(address)
+        while waiting:
+            request, d, retry = waiting.popleft()
+            if not d.called:
+                return request, d, retry
+        return None
+
+    def _healthy(self, conn, now):
+        return (conn.connected and conn.socket is not None and
+                now - conn.last_used < self.idle_timeout)
+
+    def _checkout(self, address):
+        idle = self._idle.get(address)
+        now = time.time()
+        while idle:
+            conn = idle.pop()
+            if self._healthy(conn, now):
+                return conn
+            conn.pool = None
+            conn.close()
+        return None
+
+    def _completed(self, conn, address, request, d, retry, response):
+        if d.called:
+            return
+        if response.status is None and retry and not conn.received:
+            # The server probably closed the idle connection just as
+            # the request was sent. The other idle connections are likely
+            # to be stale too, so drop them and try again on a fresh one.
+            self.retries += 1
+            idle = self._idle.pop(address, [])
+            for c in idle:
+                c.pool = None
+                c.close()
+            self._submit(address, request, d, False)
+        else:
+            d.callback(response)
+
+    def _failed(self, d, failure):
+        if not d.called:
+            if failure.check(TimeoutError):
+                self.timeouts += 1
+            else:
+                self.errors += 1
+            d.errback(failure)
+
+    def release(self, conn):
+        """Called by a connection when it is available for a new request"""
+        self._busy[conn.address].discard(conn)
+        waiting = self._next_waiting(conn.address)
+        if waiting is not None:
+            request, d, retry = waiting
+            self.hits += 1
+            self._send(conn, conn.address, request, d, retry)
+        else:
+            self._idle[conn.address].append(conn)
+
+    def connection_closed(self, conn):
+        """Called by a connection when it has been closed"""
+        conn.pool = None
+        self._busy[conn.address].discard(conn)
+        try:
+            self._idle[conn.address].remove(conn)
+        except ValueError:
+            pass
+        if len(self._busy[conn.address]) < self.max_size:
+            waiting = self._next_waiting(conn.address)
+            if waiting is not None:
+                request, d, retry = waiting
+                self._submit(conn.address, request, d, retry)
+
+    def evict_idle(self):
+        """Closes connections that have been idle too long"""
+        now = time.time()
+        for address, idle in self._idle.items():
+            for conn in [c for c in idle if not self._healthy(c, now)]:
+                conn.close()
+
+    def _evict_periodically(self):
+        self.evict_idle()
+        self.reactor.call_later(self._evict_periodically, self.idle_timeout / 2)
+
 
 def request(url, command="GET", data=""):
     """
@@ -6,14 +6,26 @@
 import asynchat
 import asyncore
 import socket
+import os
 import threading
 import functools
 import Queue
 import sys
 import time
 import heapq
+import collections
+import itertools
 import select
+import errno
+import math
+import random
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where Trigger uses sockets
+    fcntl = None
 import traceback
+import unittest
 
 import logging
 log = logging.getLogger("tangled.core")
@@ -23,22 +35,58 @@ __version__ = "0.1.1.2"
 def succeed(r):
     """Syntactic sugar for making a synchronous call look asynchronous"""
     d = Deferred()
-    d.callback(r)
+    # There are no callbacks to run yet
+    d.called = True
+    d.result = r
     return d
 
 def fail(r):
     """Syntactic sugar for making a synchronous call look asynchronous, failure version"""
     d = Deferred()
-    d.callback(r)
+    d.errback(r)
     return d
 
 def passthru(r):
     """A callback/errback that doesn't do anything"""
     return r
 
+def gather_results(deferreds):
+    """
+    Returns a L{Deferred} that is called back with a list of the results when all
+    of the deferreds have been called back, or errbacked with the first failure.
+
+    @param deferreds: The deferreds to wait for
+    @type deferreds: list of L{Deferred}
+    """
+    d = Deferred()
+    results = [None] * len(deferreds)
+    remaining = [len(deferreds)]
+    def done(index, result):
+        if isinstance(result, Failure):
+            if not d.called:
+                d.errback(result)
+            return
+        results[index] = result
+        remaining[0] = remaining[0] - 1
+        if remaining[0] == 0 and not d.called:
+            d.callback(results)
+    for i, r in enumerate(deferreds):
+        r.add_both(functools.partial(done, i))
+    if not deferreds:
+        d.callback(results)
+    return d
+
+FOREGROUND = 0
+"""Priority of work that someone is waiting for"""
+BACKGROUND = 1
+"""Priority of work that can wait, it's only done when there's no L{FOREGROUND} work queued"""
+_STOP = 2
+"""Priority of the sentinel that stops a thread, after the work already queued"""
+
 class Worker(threading.Thread):
     """
-    This is a worker thread which executes a function and calls a callback on completion
+    This is a worker thread which executes a function and calls a callback on completion.
+    Queued L{FOREGROUND} calls are executed before queued L{BACKGROUND} calls.
 
     @param reactor: The reactor this is a worker for.
     @type reactor: L{Reactor}
@@ -46,7 +94,9 @@ class Worker(threading.Thread):
     """
     def __init__(self, reactor, autostart=False):
         threading.Thread.__init__(self, target=self._runner)
-        self._queue = Queue.Queue()
+        self._queue = Queue.PriorityQueue()
+        # Keeps calls of the same priority in order
+        self._sequence = itertools.count()
         self.reactor = reactor
         self._running = True
         self.daemon = True
@@ -54,43 +104,151 @@ class Worker(threading.Thread):
             self.start()
 
     def stop(self):
-        """Stops the worker"""
-        self._running = False
+        """Stops the worker, when the calls already queued are done"""
+        self._queue.put((_STOP, self._sequence.next(), None, None))
 
     def _runner(self):
         """The message pump of the worker"""
-        while self._running:
+        while True:
+            priority, sequence, func, oncomplete = self._queue.get()
+            if func is None:
+                break
+            res = None
             try:
-                func, oncomplete = self._queue.get(block=True, timeout=1)
-            except Queue.Empty:
-                pass
-            else:
-                res = None
-                try:
-                    res = func()
-                except:
-                    res = Failure()
-                oncomplete(res)
+                res = func()
+            except:
+                res = Failure()
+            oncomplete(res)
 
-    def execute(self, func, oncomplete):
+    def execute(self, func, oncomplete, priority=FOREGROUND):
         """
         Executes func in the worker thread, which then calls oncomplete
 
         @type func: callable
         @type oncomplete: callable
+        @param priority: L{FOREGROUND} or L{BACKGROUND}
         """
-        self._queue.put((func, oncomplete))
+        self._queue.put((priority, self._sequence.next(), func, oncomplete))
 
-    def defer(self, func):
+    def defer(self, func, priority=FOREGROUND):
         """
         Defers the call to func to this worker
 
         @param func: The function you want the worker to call
         @type func: callable
+        @param priority: L{FOREGROUND} or L{BACKGROUND}
         @return: A L{Deferred} object that will eventually get the result of func
         @rtype: L{Deferred}
         """
-        return self.reactor.defer_to_worker(func, self)
+        return self.reactor.defer_to_worker(func, self, priority)
+
+class Lane(object):
+    """
+    A queue of calls in a L{WorkerPool}. The calls of a lane are executed one
+    at a time and in order (within a priority), by whichever thread of the
+    pool is free. It can be used instead of a L{Worker}.
+
+    Don't create these directly, use L{WorkerPool.lane}.
+    """
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.reactor = pool.reactor
+        self.name = name
+        # A heap of (priority, sequence, func, oncomplete), guarded by the lock of the pool
+        self._calls = []
+        # True while the lane is in the ready queue or being run
+        self._scheduled = False
+
+    def execute(self, func, oncomplete, priority=FOREGROUND):
+        """See L{Worker.execute}"""
+        self.pool._add(self, (priority, self.pool._sequence.next(), func, oncomplete))
+
+    def defer(self, func, priority=FOREGROUND):
+        """See L{Worker.defer}"""
+        return self.reactor.defer_to_worker(func, self, priority)
+
+class WorkerPool(object):
+    """
+    A pool of threads that execute the calls of many L{Lane}s. A lane that
+    has calls queued is put in a ready queue shared by the threads, so that
+    a slow lane only occupies one thread and the other threads go on with
+    the other lanes. A lane waits in the ready queue with the priority of
+    the first of its calls.
+
+    @param reactor: The reactor this is a pool for.
+    @type reactor: L{Reactor}
+    @param size: The number of threads
+    """
+    def __init__(self, reactor, size):
+        self.reactor = reactor
+        self.size = size
+        self._lock = threading.Lock()
+        self._ready = Queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lanes = {}
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._runner)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def __len__(self):
+        return self.size
+
+    def lane(self, key):
+        """Returns the lane for key (any hashable), which is created if needed"""
+        try:
+            return self._lanes[key]
+        except KeyError:
+            return self._lanes.setdefault(key, Lane(self, key))
+
+    def _add(self, lane, call):
+        self._lock.acquire()
+        try:
+            heapq.heappush(lane._calls, call)
+            if lane._scheduled:
+                return
+            lane._scheduled = True
+        finally:
+            self._lock.release()
+        self._ready.put((call[0], call[1], lane))
+
+    def _runner(self):
+        while True:
+            priority, sequence, lane = self._ready.get()
+            if lane is None:
+                break
+            self._lock.acquire()
+            try:
+                priority, sequence, func, oncomplete = heapq.heappop(lane._calls)
+            finally:
+                self._lock.release()
+            res = None
+            try:
+                res = func()
+            except:
+                res = Failure()
+            oncomplete(res)
+            # Back to the end of the ready queue, so that the lanes take turns
+            self._lock.acquire()
+            try:
+                if lane._calls:
+                    head = lane._calls[0]
+                else:
+                    head = None
+                    lane._scheduled = False
+            finally:
+                self._lock.release()
+            if head is not None:
+                self._ready.put((head[0], self._sequence.next(), lane))
+
+    def stop(self):
+        """Stops the threads when the calls already queued are done, and waits for them"""
+        for t in self._threads:
+            self._ready.put((_STOP, self._sequence.next(), None))
+        for t in self._threads:
+            t.join()
 
 class Failure(object):
     """Like Twisted's Failure object, but with no features"""
@@ -116,40 +274,100 @@ class Failure(object):
         for e in exceptions:
             if isinstance(self.type, e):
                 return True
+            if isinstance(self.type, type) and issubclass(self.type, e):
+                return True
         return False
 
 
+_CONTINUE = object()
+"""
+Marks the place in the callbacks of a Deferred where another Deferred,
+paused while waiting for this one, takes over the result
+"""
+
 class Deferred(object):
-    """Very similar to Twisted's Deferred object, but with less features"""
+    """
+    Very similar to Twisted's Deferred object, but with less features.
+
+    When a callback returns another Deferred, the chain is paused until that
+    one has a result (if it has one already, the chain goes on right away).
+    The chains are run by a loop, not by recursion, so they can be as long
+    as they like.
+    """
+    __slots__ = ("callbacks", "called", "paused", "result", "_running")
+
     def __init__(self):
-        self.callbacks = []
+        self.callbacks = collections.deque()
         self.called = False
         self.paused = 0
+        self.result = None
+        self._running = False
 
     def _start_callbacks(self, result):
         if not self.called:
             self.called = True
             self.result = result
-            self._run_callbacks()
+            if self.callbacks:
+                self._run_callbacks()
+            elif isinstance(result, Failure):
+                log.error("Unhandled Failure: %s", result)
 
     def _run_callbacks(self):
-        if not self.paused:
-            while self.callbacks:
+        if self._running:
+            # The loop that is running will get to the new callbacks
+            return
+        chain = [self]
+        while chain:
+            current = chain[-1]
+            if current.paused:
+                # Waiting for another Deferred, which will continue the chain
+                return
+            finished = True
+            callbacks = current.callbacks
+            # Callbacks added by the callbacks are run by this loop
+            current._running = True
+            while callbacks:
+                cb, eb = callbacks.popleft()
+                if cb is _CONTINUE:
+                    # eb has been waiting for current's result, continue with it
+                    eb.result = current.result
+                    current.result = None
+                    eb.paused = eb.paused - 1
+                    chain.append(eb)
+                    # current is done with after eb
+                    finished = False
+                    break
                 try:
-                    cb, eb = self.callbacks.pop(0)
-                    if isinstance(self.result, Failure):
-                        cb = eb
-                    self.result = cb(self.result)
-                    if isinstance(self.result, Deferred):
-                        self.pause()
-                        # This will cause the callback chain to resume later,
-                        # or immediately (recursively) if result is already
-                        # available
-                        self.add_both(self._continue)
+                    if isinstance(current.result, Failure):
+                        result = eb(current.result)
+                    else:
+                        result = cb(current.result)
                 except:
-                    self.result = Failure()
-            if isinstance(self.result, Failure):
-                log.error("Unhandled Failure: %s", self.result)
+                    result = Failure()
+                if isinstance(result, Deferred):
+                    if not current._wait_for(result):
+                        break
+                else:
+                    current.result = result
+            current._running = False
+            if finished:
+                if not current.paused and isinstance(current.result, Failure):
+                    log.error("Unhandled Failure: %s", current.result)
+                chain.pop()
+
+    def _wait_for(self, d):
+        """
+        Called when a callback has returned d. Takes d's result and returns
+        True if it has one, and else pauses until it has and returns False.
+        """
+        if d.called and not d.paused:
+            self.result = d.result
+            d.result = None
+            return True
+        self.paused = self.paused + 1
+        self.result = None
+        d.callbacks.append((_CONTINUE, self))
+        return False
 
     def add_callback(self, cb):
         """See L{add_callbacks}"""
@@ -178,9 +396,31 @@ class Deferred(object):
         @param cb: callback
         @param eb: errback
         """
-        self.callbacks.append((cb, eb or passthru))
-        if self.called:
+        if not self.called or self.paused or self._running:
+            self.callbacks.append((cb, eb or passthru))
+            return
+        # The result is there, and no other callbacks are waiting for it
+        result = self.result
+        self._running = True
+        try:
+            if isinstance(result, Failure):
+                if eb is not None:
+                    result = eb(result)
+            else:
+                result = cb(result)
+        except:
+            result = Failure()
+        self._running = False
+        if isinstance(result, Deferred):
+            if not self._wait_for(result):
+                return
+        else:
+            self.result = result
+        if self.callbacks:
+            # Added by the callback
             self._run_callbacks()
+        elif isinstance(self.result, Failure):
+            log.error("Unhandled Failure: %s", self.result)
 
     def pause(self):
         self.paused = self.paused + 1
@@ -192,10 +432,6 @@ class Deferred(object):
         if self.called:
             self._run_callbacks()
 
-    def _continue(self, result):
-        self.result = result
-        self.unpause()
-
     def callback(self, result):
         self._start_callbacks(result)
 
@@ -216,50 +452,52 @@ def set_reuse_addr(s):
     except socket.error:
         pass
 
-class BindError(Exception):
-    pass
-
 class Trigger(asyncore.dispatcher):
-    """Used to trigger the event loop with external stuff,
-    also from Medusa"""
+    """
+    Used to wake the event loop from other threads, and to have functions
+    called in it. Uses a pipe where there are pipes that can be polled, and
+    else a pair of connected sockets.
 
+    Only one byte is written while a wakeup is pending, however many
+    functions are added, and the functions are called without holding the
+    lock, so that the workers don't have to wait for them.
+    """
+    max_rounds = 16
+    """How many batches of functions to call per wakeup, at most"""
     def __init__(self):
-        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        w = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        set_reuse_addr(a)
-        set_reuse_addr(w)
-
-        # set TCP_NODELAY to true to avoid buffering
-        w.setsockopt(socket.IPPROTO_TCP, 1, 1)
-
-        # tricky: get a pair of connected sockets
-        host='127.0.0.1'
-        port=19999
-        while 1:
-            try:
-                self.address = (host, port)
-                a.bind(self.address)
-                break
-            except:
-                if port <= 19950:
-                    raise BindError
-                port = port - 1
-
-        a.listen(1)
-        w.setblocking(0)
-        try:
-            w.connect(self.address)
-        except:
-            pass
-        r, addr = a.accept()
-        a.close()
-        w.setblocking(1)
-        self.trigger = w
-
+        asyncore.dispatcher.__init__(self)
         self.lock = threading.Lock()
         self.funcs = []
+        self._pending = False
+        if os.name == "posix":
+            r, w = os.pipe()
+            for fd in (r, w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._write_fd = w
+            self._send = self._write_pipe
+            # Like asyncore.file_dispatcher
+            self.connected = True
+            self.socket = asyncore.file_wrapper(r)
+            self._fileno = r
+            self.add_channel()
+        else:
+            a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            a.bind(("127.0.0.1", 0))
+            a.listen(1)
+            w = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            w.connect(a.getsockname())
+            r, addr = a.accept()
+            a.close()
+            # set TCP_NODELAY to true to avoid buffering
+            w.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            w.setblocking(0)
+            self._write_socket = w
+            self._send = self._write_socket.send
+            self.set_socket(r)
 
-        asyncore.dispatcher.__init__(self, r)
+    def _write_pipe(self, data):
+        os.write(self._write_fd, data)
 
     def readable(self):
         return 1
@@ -271,32 +509,318 @@ class Trigger(asyncore.dispatcher):
         pass
 
     def pull_trigger(self, func=None):
-        if func:
-            try:
-                self.lock.acquire()
+        """Wakes the event loop, which then calls func (if given)"""
+        self.lock.acquire()
+        try:
+            if func is not None:
                 self.funcs.append(func)
-            finally:
-                self.lock.release()
-                self.trigger.send('x')
+            if self._pending:
+                return
+            self._pending = True
+        finally:
+            self.lock.release()
+        try:
+            self._send("x")
+        except (OSError, socket.error):
+            # Full, so the loop will wake up anyway
+            pass
 
     def handle_read(self):
-        self.recv(8192)
         try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        # The wakeup stays pending while the functions are called, so that the
+        # functions added in the meantime don't write to the trigger again
+        for i in xrange(self.max_rounds):
             self.lock.acquire()
-            for func in self.funcs:
-                func()
-            self.funcs = []
-        finally:
-            self.lock.release()
+            try:
+                funcs = self.funcs
+                self.funcs = []
+                if not funcs:
+                    self._pending = False
+                    return
+            finally:
+                self.lock.release()
+            for func in funcs:
+                try:
+                    func()
+                except:
+                    # Don't let it take the rest of the batch with it
+                    log.error("Function called by the trigger failed: %s", Failure())
+        # Let the other dispatchers have a go, and come back
+        self._send("x")
+
+class SelectPoller(object):
+    """Polls the dispatchers using select, works everywhere but doesn't scale"""
+    def poll(self, timeout, map):
+        asyncore.poll(timeout, map)
+
+
+class PollPoller(object):
+    """Polls the dispatchers using poll"""
+    def poll(self, timeout, map):
+        asyncore.poll2(timeout, map)
+
+
+class EpollPoller(object):
+    """
+    Polls the dispatchers using epoll (Linux only). The interest set is
+    kept in the kernel between calls, only dispatchers that have been
+    added, removed or changed their readable/writable state cause a
+    system call.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        # fd -> (dispatcher, mask)
+        self._registered = {}
+
+    def _unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # Closed fds are removed from the epoll set automatically
+            pass
+
+    def _update(self, map):
+        registered = self._registered
+        get = registered.get
+        epoll = self._epoll
+        EPOLLIN = select.EPOLLIN | select.EPOLLPRI
+        EPOLLOUT = select.EPOLLOUT
+        for fd, obj in map.iteritems():
+            mask = 0
+            if obj.readable():
+                mask = EPOLLIN
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                mask |= EPOLLOUT
+            current = get(fd)
+            if current is None or current[0] is not obj:
+                if current is not None:
+                    # The fd has been reused by another dispatcher
+                    self._unregister(fd)
+                try:
+                    epoll.register(fd, mask)
+                except IOError, e:
+                    if e.args[0] != errno.EEXIST:
+                        raise
+                    epoll.modify(fd, mask)
+                registered[fd] = (obj, mask)
+            elif current[1] != mask:
+                try:
+                    epoll.modify(fd, mask)
+                except IOError, e:
+                    if e.args[0] != errno.ENOENT:
+                        raise
+                    epoll.register(fd, mask)
+                registered[fd] = (obj, mask)
+        if len(registered) > len(map):
+            for fd in [fd for fd in registered if fd not in map]:
+                self._unregister(fd)
+                del registered[fd]
+
+    def poll(self, timeout, map):
+        self._update(map)
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for fd, flags in events:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            # The epoll flags have the same values as the poll flags
+            asyncore.readwrite(obj, flags)
+
+
+def default_poller(use_poll=False):
+    """Returns the most scalable poller available on this platform"""
+    if hasattr(select, "epoll"):
+        return EpollPoller()
+    if use_poll and hasattr(select, "poll"):
+        return PollPoller()
+    return SelectPoller()
+
+
+class Timer(object):
+    """A call scheduled by L{Reactor.call_later}"""
+    __slots__ = ("when", "tick", "func", "cancelled")
+
+    def __init__(self, when, func):
+        self.when = when
+        self.tick = 0
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        """Makes sure the call isn't made, if it hasn't been made already"""
+        self.cancelled = True
+        # Don't keep what the call refers to alive until the timer is dropped
+        self.func = None
+
+    @property
+    def active(self):
+        """True until the call has been made or cancelled"""
+        return self.func is not None
+
+
+class TimerWheel(object):
+    """
+    Keeps L{Timer}s in a hierarchical timing wheel, so that adding and
+    cancelling timers is O(1) however many there are.
+
+    Time is divided into ticks of L{resolution} seconds, and a timer is due
+    on the first tick after its time. The lowest level has a bucket for each
+    of the next L{slots} ticks. A bucket on the next level holds the timers
+    of a whole turn of the level below, and so on. When the level below has
+    turned, the timers of the next bucket on the level above are spread out
+    on the level below. Cancelled timers are left in their buckets, and
+    dropped when the bucket comes up.
+
+    @param resolution: Seconds per tick
+    @param now: The current time
+    """
+    slots = 256
+    levels = 4
+
+    def __init__(self, resolution=0.01, now=None):
+        if now is None:
+            now = time.time()
+        self.resolution = resolution
+        self._wheels = [[[] for i in xrange(self.slots)] for l in xrange(self.levels)]
+        # Ticks per bucket, for each level
+        self._spans = [self.slots ** l for l in xrange(self.levels + 1)]
+        # The next tick to process
+        self._current = int(now / resolution) + 1
+        # A tick that no timer is due before, None if unknown
+        self._next = None
+        # Timers in the buckets, including cancelled ones
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, timer):
+        """Adds a timer, returns it"""
+        tick = int(math.ceil(timer.when / self.resolution))
+        if tick < self._current:
+            tick = self._current
+        timer.tick = tick
+        self._place(timer, self._current)
+        self._count = self._count + 1
+        if self._next is not None and tick < self._next:
+            self._next = tick
+        return timer
+
+    def _place(self, timer, current):
+        """Puts timer in its bucket, as seen from the tick current"""
+        spans = self._spans
+        delta = timer.tick - current
+        level = 0
+        while level < self.levels - 1 and delta >= spans[level + 1]:
+            level = level + 1
+        # Far away timers wait in the last bucket of the top level
+        tick = min(timer.tick, current + spans[self.levels] - 1)
+        self._wheels[level][(tick // spans[level]) % self.slots].append(timer)
+
+    def _cascade(self, tick):
+        spans = self._spans
+        for level in xrange(self.levels - 1, 0, -1):
+            if tick % spans[level] == 0:
+                wheel = self._wheels[level]
+                index = (tick // spans[level]) % self.slots
+                bucket = wheel[index]
+                if bucket:
+                    wheel[index] = []
+                    for timer in bucket:
+                        if timer.cancelled:
+                            self._count = self._count - 1
+                        else:
+                            self._place(timer, tick)
+
+    def expire(self, now):
+        """Removes and returns the timers that are due at now, in the order they're due"""
+        last = int(now / self.resolution)
+        if last < self._current:
+            return []
+        if not self._count:
+            self._current = last + 1
+            return []
+        due = []
+        wheel = self._wheels[0]
+        slots = self.slots
+        self._next = None
+        while self._count:
+            # Skip the ticks where nothing happens
+            tick = self._find_next()
+            if tick > last:
+                self._next = tick
+                break
+            if tick % slots == 0:
+                self._cascade(tick)
+            bucket = wheel[tick % slots]
+            if bucket:
+                wheel[tick % slots] = []
+                self._count = self._count - len(bucket)
+                due.extend(bucket)
+            self._current = tick + 1
+        self._current = max(self._current, last + 1)
+        return [timer for timer in due if not timer.cancelled]
+
+    def timeout(self, now):
+        """Returns the seconds until the timers need looking at, None if there are no timers"""
+        if not self._count:
+            return None
+        if self._next is None:
+            self._next = self._find_next()
+        return max(0.0, self._next * self.resolution - now)
+
+    def _find_next(self):
+        """Returns the next tick with timers due, or with timers to move down a level"""
+        slots = self.slots
+        spans = self._spans
+        current = self._current
+        wheel = self._wheels[0]
+        found = None
+        for tick in xrange(current, current + slots):
+            if wheel[tick % slots]:
+                found = tick
+                break
+        for level in xrange(1, self.levels):
+            span = spans[level]
+            # The first bucket of this level to come up
+            start = -(-current // span) * span
+            if found is not None and start >= found:
+                break
+            wheel = self._wheels[level]
+            for tick in xrange(start, start + spans[level + 1], span):
+                if found is not None and tick >= found:
+                    break
+                if wheel[(tick // span) % slots]:
+                    found = tick
+                    break
+        return found
+
 
 class Reactor(object):
-    """The reactor is the engine of your asynchronous application."""
-    # trigger object to wake the loop
-    _trigger = Trigger()
+    """
+    The reactor is the engine of your asynchronous application.
+
+    @param poller: Used to wait for socket events, see L{default_poller}
+    """
     use_poll = False
+    timer_resolution = 0.01
 
-    def __init__(self):
-        self._pending_calls = []
+    def __init__(self, poller=None):
+        # trigger object to wake the loop
+        self._trigger = Trigger()
+        self._timers = TimerWheel(self.timer_resolution)
+        self.poller = poller or default_poller(self.use_poll)
 
     def wake(self):
         """Uses the trigger to wake the async loop"""
@@ -310,13 +834,14 @@ class Reactor(object):
         """     
         self._trigger.pull_trigger(func)
 
-    def defer_to_worker(self, func, worker):
+    def defer_to_worker(self, func, worker, priority=FOREGROUND):
         """
         Calls a function in a worker, and return the result as a L{Deferred}
 
         @param func: The function to call in the worker
         @param worker: The worker that should handle the call
         @type worker: L{Worker}
+        @param priority: L{FOREGROUND} or L{BACKGROUND}
         @return: A L{Deferred} objeft that will eventually contain the result
         @rtype: L{Deferred}
         """
@@ -326,41 +851,255 @@ class Reactor(object):
                 self.run_in_main(functools.partial(d.errback, result))
             else:
                 self.run_in_main(functools.partial(d.callback, result))
-        worker.execute(func, callback)
+        worker.execute(func, callback, priority)
         return d
 
     def call_later(self, func, timeout):
         """
-        Call a function at a later time in the main loop
+        Call a function at a later time in the main loop. This must be
+        called from the main loop (or before it is started).
    
         @param func: The function to call
         @param timeout: How long (in seconds) to the call shall be made
+        @return: A L{Timer}, that can be used to cancel the call
+        @rtype: L{Timer}
         """
-        heapq.heappush(self._pending_calls, (time.time() + timeout, func))
-        self.wake()
+        return self._timers.add(Timer(time.time() + timeout, func))
 
     def _timeout(self):
-        if not self._pending_calls:
-            return None
-        return max(0, self._pending_calls[0][0] - time.time())
+        return self._timers.timeout(time.time())
 
-    def loop(self):
-        if self.use_poll and hasattr(select, 'poll'):
-            poll_fun = asyncore.poll2
-        else:
-            poll_fun = asyncore.poll
+    def _run_timers(self):
+        for timer in self._timers.expire(time.time()):
+            # Cancelled by an earlier call of the batch?
+            func = timer.func
+            if func is None:
+                continue
+            timer.func = None
+            try:
+                func()
+            except:
+                log.error("Timed call failed: %s", Failure())
 
+    def loop(self):
         while asyncore.socket_map:
             timeout = self._timeout()
-            poll_fun(timeout, asyncore.socket_map)
-            # check expired timeouts
-            t = time.time()
-            while self._pending_calls:
-                timeout, func = self._pending_calls[0]
-                if timeout < t:
-                    func()
-                    heapq.heappop(self._pending_calls)
-                else:
-                    # No timeout
-                    break
+            self.poller.poll(timeout, asyncore.socket_map)
+            self._run_timers()
+
+
+
+class TestDeferred(unittest.TestCase):
+    def test_callbacks_and_errbacks(self):
+        results = []
+        def fails(r):
+            raise KeyError(r)
+        def recovers(failure):
+            results.append(failure.check(KeyError))
+            return "recovered"
+        d = Deferred()
+        d.add_callback(lambda r: r + 1)
+        d.add_callback(fails)
+        d.add_callback(results.append)
+        d.add_errback(recovers)
+        d.add_callbacks(results.append, results.append)
+        d.callback(1)
+        self.assertEqual(results, [True, "recovered"])
+
+        results = []
+        d = fail(ValueError)
+        d.add_callbacks(results.append, lambda f: f.check(ValueError))
+        d.add_both(results.append)
+        self.assertEqual(results, [True])
+
+    def test_add_after_firing(self):
+        results = []
+        d = succeed(1)
+        d.add_callback(lambda r: r * 2)
+        d.add_callback(results.append)
+        self.assertEqual(results, [2])
+        d = Deferred()
+        d.callback("a")
+        def more(r):
+            # Added while the callback runs, it runs after it, before the ones added later
+            d.add_callback(lambda r: results.append(("late", r)))
+            return r + "b"
+        d.add_callback(more)
+        d.add_callback(results.append)
+        self.assertEqual(results, [2, ("late", "ab"), None])
+
+    def test_nested(self):
+        results = []
+        inner = Deferred()
+        innermost = Deferred()
+        inner.add_callback(lambda r: innermost)
+        inner.add_callback(lambda r: r + "+inner")
+        outer = Deferred()
+        outer.add_callback(lambda r: inner)
+        outer.add_callback(results.append)
+        outer.callback("outer")
+        inner.callback("x")
+        self.assertEqual(results, [])
+        self.assertTrue(outer.paused)
+        innermost.callback("innermost")
+        self.assertEqual(results, ["innermost+inner"])
+        self.assertFalse(outer.paused)
+
+        # Already fired Deferreds are continued with at once
+        results = []
+        d = succeed(1)
+        d.add_callback(lambda r: succeed(r + 1))
+        d.add_callback(lambda r: fail(KeyError))
+        d.add_errback(lambda f: f.check(KeyError) and "caught")
+        d.add_callback(results.append)
+        self.assertEqual(results, ["caught"])
+
+    def test_long_chains(self):
+        n = 5000
+        results = []
+        d = Deferred()
+        for i in xrange(n):
+            d.add_callback(lambda r: r + 1)
+        d.add_callback(results.append)
+        d.callback(0)
+        self.assertEqual(results, [n])
+
+        # Each Deferred waits for the next one, deeper than the recursion limit
+        ds = [Deferred() for i in xrange(n)]
+        for i in xrange(n - 1):
+            ds[i].add_callback(lambda r, next=ds[i + 1]: next)
+            ds[i].add_callback(lambda r: r + 1)
+        for d in ds[:-1]:
+            d.callback(None)
+        ds[0].add_callback(results.append)
+        self.assertEqual(results, [n])
+        ds[-1].callback(0)
+        self.assertEqual(results, [n, n - 1])
+
+        # Fired from the inside out
+        ds = [succeed(0)]
+        for i in xrange(n):
+            d = Deferred()
+            d.add_callback(lambda r, prev=ds[-1]: prev)
+            d.add_callback(lambda r: r + 1)
+            ds.append(d)
+        for d in reversed(ds[1:]):
+            d.callback(None)
+        ds[-1].add_callback(results.append)
+        self.assertEqual(results[-1], n)
+
+    def test_pause(self):
+        results = []
+        d = Deferred()
+        d.pause()
+        d.add_callback(results.append)
+        d.callback(1)
+        self.assertEqual(results, [])
+        d.unpause()
+        self.assertEqual(results, [1])
+
+    def test_gather_results(self):
+        results = []
+        ds = [Deferred(), succeed(2)]
+        gather_results(ds).add_callback(results.append)
+        ds[0].callback(1)
+        self.assertEqual(results, [[1, 2]])
+        ds = [Deferred(), Deferred()]
+        gather_results(ds).add_errback(lambda f: results.append(f.check(KeyError)))
+        ds[1].errback(Failure(KeyError))
+        ds[0].callback(1)
+        self.assertEqual(results, [[1, 2], True])
+        gather_results([]).add_callback(results.append)
+        self.assertEqual(results[-1], [])
+
+
+class TestTimerWheel(unittest.TestCase):
+    def _timers(self, whens):
+        return [Timer(when, passthru) for when in whens]
+
+    def test_expire_across_levels(self):
+        span = TimerWheel.slots
+        whens = [0, 0.5, 1, 2, 255, 256, 257, 300, 511.5, 512, span ** 2 - 1, span ** 2, span ** 2 + 1, 70000,
+                 span ** 3 - 1, span ** 3, span ** 3 + 5, span ** 4 + 10]
+        rand = random.Random(1)
+        whens.extend([rand.uniform(0, 2 * span ** 3) for i in range(200)])
+        w = TimerWheel(1.0, 0.0)
+        timers = self._timers(whens)
+        for timer in timers:
+            w.add(timer)
+        self.assertEqual(len(w), len(timers))
+        by_tick = {}
+        for timer in timers:
+            by_tick.setdefault(max(1, int(math.ceil(timer.when))), set()).add(timer)
+        for tick in sorted(by_tick):
+            # Not a tick early, the lower levels are filled from the higher ones in time
+            self.assertEqual(w.expire(tick - 1), [])
+            self.assertEqual(w.timeout(tick - 1), 1.0)
+            self.assertEqual(set(w.expire(tick)), by_tick[tick])
+        self.assertEqual(len(w), 0)
+        self.assertEqual(w.timeout(0), None)
+
+        # All at once, in the order they're due
+        w = TimerWheel(1.0, 0.0)
+        for timer in timers:
+            w.add(timer)
+        due = w.expire(2 * span ** 4)
+        self.assertEqual(len(due), len(timers))
+        ticks = [timer.tick for timer in due]
+        self.assertEqual(ticks, sorted(ticks))
+
+    def test_cancel(self):
+        w = TimerWheel(1.0, 0.0)
+        early, late, cascaded = self._timers([100, 70000, 70000])
+        for timer in (early, late, cascaded):
+            w.add(timer)
+        # Before a cascade
+        early.cancel()
+        late.cancel()
+        self.assertFalse(late.active)
+        self.assertEqual(w.expire(TimerWheel.slots ** 2 + 1), [])
+        self.assertTrue([b for b in w._wheels[1] if cascaded in b])
+        # After it
+        cascaded.cancel()
+        self.assertEqual(w.expire(70000), [])
+        self.assertEqual(len(w), 0)
+
+    def test_add_while_expiring(self):
+        w = TimerWheel(1.0, 0.0)
+        first, second = self._timers([10, 5])
+        w.add(first)
+        self.assertEqual(w.expire(3), [])
+        # Added after the wheel has moved on, but due before the first one
+        w.add(second)
+        self.assertEqual(w.expire(20), [second, first])
+        third, fourth = self._timers([20, 0])
+        # Due now, or in the past, while the timers of now are being run
+        w.add(third)
+        w.add(fourth)
+        self.assertEqual(w.expire(20), [])
+        self.assertEqual(w.expire(21), [third, fourth])
+
+    def test_reactor_timers(self):
+        r = Reactor()
+        try:
+            calls = []
+            def first():
+                calls.append("first")
+                r.call_later(functools.partial(calls.append, "added"), 0)
+                third.cancel()
+            r.call_later(first, 0)
+            r.call_later(functools.partial(calls.append, "second"), 0)
+            third = r.call_later(functools.partial(calls.append, "third"), 0)
+            time.sleep(2 * r.timer_resolution)
+            r._run_timers()
+            # The timer added by a timer waits for the next round
+            self.assertEqual(calls, ["first", "second"])
+            time.sleep(2 * r.timer_resolution)
+            r._run_timers()
+            self.assertEqual(calls, ["first", "second", "added"])
+        finally:
+            r._trigger.close()
+
 
+if __name__=="__main__":
+    unittest.main()
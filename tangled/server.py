@@ -3,15 +3,22 @@
 # Copyright (c) 2001-2010 Pär Bohrarper.
 # See LICENSE for details.
 
-from BaseHTTPServer import BaseHTTPRequestHandler
-import asynchat
 import asyncore
-import socket
+import collections
 import cStringIO
+import email.utils
+import httplib
+import socket
+import functools
 import re
 import sys
+import tempfile
+import time
+import unittest
 import uuid
 
+import core
+
 import logging
 log = logging.getLogger("tangled.server")
 
@@ -25,17 +32,194 @@ class Request(object):
     @ivar client_address: tuple of address, port
     @ivar method: "GET", "PUT", etc.
     @ivar path: The uri of the request, /foo/bar
-    @ivar data: The body of the request
     @ivar groups: This contains the groups (if any) from the regex used when registering the request handler
     """
     def __init__(self, client_address, method, path, headers, data, groups):
+        """
+        @param data: The body of the request, a str or a file (see L{RequestBody})
+        """
         self.client_address = client_address
         self.method = method
         self.path = path
         self.headers = headers
-        self.data = data
+        self._data = data
         self.groups = groups
 
+    @property
+    def data(self):
+        """The body of the request, read into memory if it was spooled to a file"""
+        if not isinstance(self._data, basestring):
+            f = self._data
+            f.seek(0)
+            self._data = f.read()
+            f.close()
+        return self._data
+
+    @property
+    def body(self):
+        """The body of the request as a file like object, for handlers that can read it piece by piece"""
+        if isinstance(self._data, basestring):
+            return cStringIO.StringIO(self._data)
+        self._data.seek(0)
+        return self._data
+
+
+class RequestBody(object):
+    """
+    Collects the body of a request as it's received. It's kept in memory
+    until it's larger than spool_threshold bytes, then it's written to a
+    temporary file, so that slow uploads of large bodies don't hold on to
+    memory.
+    """
+    def __init__(self, spool_threshold):
+        self.spool_threshold = spool_threshold
+        self.size = 0
+        self._parts = []
+        self._file = None
+
+    @property
+    def spooled(self):
+        return self._file is not None
+
+    def write(self, data):
+        self.size = self.size + len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._parts.append(data)
+        if self.size > self.spool_threshold:
+            self._file = tempfile.TemporaryFile()
+            self._file.writelines(self._parts)
+            self._parts = []
+
+    def getvalue(self):
+        """Returns the body as a str, or as the file it was spooled to"""
+        if self._file is not None:
+            self._file.seek(0)
+            return self._file
+        if len(self._parts) == 1:
+            return self._parts[0]
+        return "".join(self._parts)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._parts = []
+
+
+def chunked(iterable):
+    """Yields the strs of iterable with the chunked transfer encoding, for a body of unknown length"""
+    for data in iterable:
+        if data:
+            yield "%x\r\n"%len(data)
+            yield data
+            yield "\r\n"
+    yield "0\r\n\r\n"
+
+
+class StreamProducer(object):
+    """
+    A producer of a body that is an iterable of strs, that are only asked
+    for when the previous ones have been sent. If the iterable fails,
+    on_error is called (from the except block), since the body can't be
+    completed.
+    """
+    def __init__(self, iterable, encode=True, on_error=None):
+        if encode:
+            iterable = chunked(iterable)
+        self.iterator = iter(iterable)
+        self.on_error = on_error
+
+    def more(self):
+        if self.iterator is None:
+            return ""
+        try:
+            for data in self.iterator:
+                if data:
+                    return data
+        except Exception:
+            self.iterator = None
+            if self.on_error is None:
+                raise
+            self.on_error()
+            return ""
+        self.iterator = None
+        return ""
+
+
+class FileRegion(object):
+    """
+    A body that is a part of a file, like a value in a storage file. It's
+    read L{block_size} bytes at a time as it's sent, so it's never all in
+    memory. The file is closed when the region has been sent.
+
+    @param f: A file opened for this region only, since it's seeked
+    """
+    block_size = 65536
+
+    def __init__(self, f, offset, length):
+        self.file = f
+        self.offset = offset
+        self.length = length
+        self._sent = 0
+
+    def __len__(self):
+        return self.length
+
+    def more(self):
+        if self.file is None:
+            return ""
+        if self._sent == self.length:
+            self.close()
+            return ""
+        self.file.seek(self.offset + self._sent)
+        data = self.file.read(min(self.block_size, self.length - self._sent))
+        if not data:
+            self.close()
+            raise IOError("The file of a region was truncated")
+        self._sent += len(data)
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def coalesce(fifo, limit):
+    """
+    Joins the small strs and buffers at the head of fifo, and what the
+    producers after them produce, into one str of at most limit bytes, so
+    that they are sent with one send() rather than as a packet each (that
+    the Nagle algorithm holds back until the previous one is acknowledged).
+    Larger ones are left as they are, to be sent without copying them.
+
+    @param fifo: A deque of strs, buffers, producers and None (close)
+    @return: The new head of fifo
+    """
+    first = fifo.popleft()
+    parts = [first]
+    size = len(first)
+    while fifo and size < limit:
+        item = fifo[0]
+        if item is None:
+            break
+        if not isinstance(item, (basestring, buffer)):
+            data = item.more()
+            if data:
+                fifo.appendleft(data)
+            elif fifo and fifo[0] is item:
+                fifo.popleft()
+            continue
+        if size + len(item) > limit:
+            break
+        parts.append(fifo.popleft())
+        size += len(item)
+    if len(parts) > 1:
+        first = "".join([str(p) for p in parts])
+    fifo.appendleft(first)
+    return first
+
 
 class Response(object):
     """
@@ -45,169 +229,682 @@ class Response(object):
         """
         @param code: A numeric HTTP status
         @param headers: A dictionary containing header/content pairs
-        @param data: A str (or equivalent) containing the data
+        @param data: A str or buffer, a list of those (sent as a multipart/mixed body),
+        a L{FileRegion}, or an iterable of strs (streamed with the chunked transfer encoding)
         """
         self.code = code or 200
         self.headers = headers or {}
         self.data = data or ""
 
+    def has_header(self, name):
+        """True if the response has the header, the names are compared case-insensitively"""
+        name = name.lower()
+        for k in self.headers:
+            if k.lower() == name:
+                return True
+        return False
+
+
+class PendingResponse(object):
+    """
+    Keeps track of a request that is waiting for its response. Responses
+    must be sent in the same order as the requests were received, so
+    pipelined requests that complete early wait here for their turn.
+    """
+    def __init__(self, head):
+        """
+        @param head: The request, None if it couldn't be parsed
+        @type head: L{RequestHead}
+        """
+        if head is None:
+            self.requestline = "-"
+            self.version = "HTTP/1.1"
+            self.close = True
+        else:
+            self.requestline = head.requestline
+            self.version = head.version
+            self.close = head.close
+        self.response = None
+
+
+class HTTPError(Exception):
+    """A request that can't be handled, it's answered with code and the connection is closed"""
+    def __init__(self, code, head=None):
+        Exception.__init__(self, code)
+        self.code = code
+        self.head = head
+        self.requests = []
+
 
-class AsyncHTTPRequestHandler(asynchat.async_chat, BaseHTTPRequestHandler):
+class Headers(dict):
+    """
+    The headers of a request or response, a dict of the lower case names to
+    the values where the names are looked up case-insensitively. Repeated
+    headers are joined with ", ".
+    """
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+    # Like mimetools.Message
+    getheader = get
+
+    def add(self, name, value):
+        name = name.lower()
+        old = dict.get(self, name)
+        if old is not None:
+            value = old + ", " + value
+        dict.__setitem__(self, name, value)
+
+
+class RequestHead(object):
+    """The request line and the headers of a request"""
+    __slots__ = ("method", "path", "version", "headers", "close")
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            self.close = "close" in connection
+        else:
+            self.close = "keep-alive" not in connection
+
+    @property
+    def requestline(self):
+        return "%s %s %s"%(self.method, self.path, self.version)
+
+
+def parse_head(head, max_line_size=8192, max_headers=100):
+    """
+    Parses the request line and the headers of a request
+
+    @param head: The head of the request, without the empty line that ends it
+    @rtype: L{RequestHead}
+    @raise HTTPError: If the request is malformed or too large
+    """
+    lines = head.split("\r\n")
+    line = lines[0]
+    if len(line) > max_line_size:
+        raise HTTPError(414)
+    parts = line.split(" ")
+    if len(parts) != 3 or not parts[0] or not parts[1]:
+        raise HTTPError(400)
+    method, path, version = parts
+    if version[:5] != "HTTP/" or version[6:7] != "." or not version[5:6].isdigit():
+        raise HTTPError(400)
+    if version[5] != "1":
+        raise HTTPError(505)
+    if len(lines) > max_headers + 1:
+        raise HTTPError(431)
+    return RequestHead(method, path, version, parse_headers(lines[1:]))
+
+
+def parse_headers(lines):
+    """
+    Parses header lines
+
+    @rtype: L{Headers}
+    @raise HTTPError: If a line is malformed
+    """
+    headers = Headers()
+    for line in lines:
+        name, sep, value = line.partition(":")
+        # Folded lines are obsolete, and names can't contain whitespace
+        if not sep or not name or " " in name or "\t" in name:
+            raise HTTPError(400)
+        name = name.lower()
+        value = value.strip()
+        if dict.__contains__(headers, name):
+            value = dict.__getitem__(headers, name) + ", " + value
+        dict.__setitem__(headers, name, value)
+    return headers
+
+
+class RequestParser(object):
+    """
+    An incremental parser of HTTP/1.1 requests. The data of a connection is
+    fed to it as it's received, and it returns the requests that have been
+    completed. The head of a request is parsed once the empty line that
+    ends it has been received, its body is read with the Content-Length or
+    the chunked transfer encoding into a L{RequestBody}.
+
+    The parser can't be used after it has raised an L{HTTPError}, the
+    connection has to be closed.
+
+    @param max_body_size: Larger bodies raise HTTPError(413)
+    @param spool_threshold: See L{RequestBody}
+    """
+    max_line_size = 8192
+    """The longest request line, or chunk size line"""
+    max_head_size = 65536
+    """The largest request line and headers"""
+    max_headers = 100
+    def __init__(self, max_body_size, spool_threshold):
+        self.max_body_size = max_body_size
+        self.spool_threshold = spool_threshold
+        self.head = None
+        self.body = None
+        self.continue_wanted = False
+        self._buffer = ""
+        # How far the buffer has been searched for the end of the head
+        self._searched = 0
+        self._remaining = 0
+        self._state = self._read_head
+
+    def feed(self, data):
+        """
+        Parses data
+
+        @return: A list of (L{RequestHead}, body) of the requests that were
+        completed, the body is a str or a file (see L{RequestBody.getvalue})
+        @raise HTTPError: If a request is malformed or too large, the
+        requests before it that were completed are in its requests attribute
+        """
+        if self._buffer:
+            self._buffer = self._buffer + data
+        else:
+            self._buffer = data
+        requests = []
+        try:
+            while self._buffer and self._state(requests):
+                pass
+        except HTTPError, e:
+            e.requests = requests
+            raise
+        return requests
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def _error(self, code):
+        self.close()
+        return HTTPError(code, self.head)
+
+    def _complete(self, requests, body=""):
+        if self.body is not None:
+            body = self.body.getvalue()
+        requests.append((self.head, body))
+        self.head = None
+        self.body = None
+        self.continue_wanted = False
+        self._state = self._read_head
+        return True
+
+    def _line(self):
+        """Returns the next line from the buffer, None if it hasn't been received yet"""
+        i = self._buffer.find("\r\n")
+        if i == -1:
+            if len(self._buffer) > self.max_line_size:
+                raise self._error(400)
+            return None
+        line = self._buffer[:i]
+        self._buffer = self._buffer[i+2:]
+        return line
+
+    def _read_head(self, requests):
+        if self._searched == 0:
+            # Stray line breaks between pipelined requests
+            self._buffer = self._buffer.lstrip("\r\n")
+        i = self._buffer.find("\r\n\r\n", self._searched)
+        if i == -1:
+            if len(self._buffer) > self.max_head_size:
+                raise self._error(431)
+            self._searched = max(0, len(self._buffer) - 3)
+            return False
+        head = self._buffer[:i]
+        self._buffer = self._buffer[i+4:]
+        self._searched = 0
+        if len(head) > self.max_head_size:
+            raise self._error(431)
+        self.head = parse_head(head, self.max_line_size, self.max_headers)
+        headers = self.head.headers
+        self.continue_wanted = (self.head.version == "HTTP/1.1" and
+                                headers.get("expect", "").lower() == "100-continue")
+        encoding = headers.get("transfer-encoding")
+        if encoding is not None:
+            if encoding.split(",")[-1].strip().lower() != "chunked":
+                raise self._error(501)
+            self.body = RequestBody(self.spool_threshold)
+            self._state = self._read_chunk_size
+            return True
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            # Negative or malformed, or repeated
+            raise self._error(400)
+        length = int(length)
+        if length > self.max_body_size:
+            raise self._error(413)
+        if length <= 0:
+            self.continue_wanted = False
+            return self._complete(requests)
+        self.body = RequestBody(self.spool_threshold)
+        self._remaining = length
+        self._state = self._read_body
+        return True
+
+    def _read_data(self):
+        """Moves up to the remaining bytes of the buffer to the body, returns True when they have all been read"""
+        if len(self._buffer) <= self._remaining:
+            data, self._buffer = self._buffer, ""
+        else:
+            data = self._buffer[:self._remaining]
+            self._buffer = self._buffer[self._remaining:]
+        self.body.write(data)
+        self._remaining -= len(data)
+        return self._remaining == 0
+
+    def _read_body(self, requests):
+        if not self._read_data():
+            return False
+        return self._complete(requests)
+
+    def _read_chunk_size(self, requests):
+        line = self._line()
+        if line is None:
+            return False
+        try:
+            size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise self._error(400)
+        if size == 0:
+            self._state = self._read_trailer
+        elif size < 0:
+            raise self._error(400)
+        elif self.body.size + size > self.max_body_size:
+            raise self._error(413)
+        else:
+            self._remaining = size
+            self._state = self._read_chunk
+        return True
+
+    def _read_chunk(self, requests):
+        if not self._read_data():
+            return False
+        self._state = self._read_chunk_end
+        return True
+
+    def _read_chunk_end(self, requests):
+        if len(self._buffer) < 2:
+            return False
+        if self._buffer[:2] != "\r\n":
+            raise self._error(400)
+        self._buffer = self._buffer[2:]
+        self._state = self._read_chunk_size
+        return True
+
+    def _read_trailer(self, requests):
+        line = self._line()
+        if line is None:
+            return False
+        if not line:
+            return self._complete(requests)
+        return True
+
+
+def _alternatives(pattern):
+    """True if a regex has a | outside of groups"""
+    depth = 0
+    escaped = in_class = False
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+    return False
+
+
+def _literal_prefix(pattern):
+    """Returns the literal text that all the matches of a regex start with"""
+    if _alternatives(pattern):
+        return ""
+    prefix = []
+    for c in pattern.lstrip("^"):
+        if c in ".^$[]()|\\":
+            break
+        if c in "*+?{":
+            # The previous character is optional or repeated
+            return "".join(prefix[:-1])
+        prefix.append(c)
+    return "".join(prefix)
+
+
+class RouteTable(object):
+    """
+    The handlers of the urls, tried in order. The routes are indexed by
+    the first few characters of the literal text at the start of their
+    regexes, so only the routes that a path can match are tried, and the
+    whole literal text is checked with str.startswith before a regex is
+    matched.
+
+    A handler class with a true reusable attribute is constructed once,
+    and its instance handles all the requests to its urls, so it mustn't
+    keep the state of a request in its attributes. The others are
+    constructed for each request.
+
+    @param urlhandlers: list of (regex, handler class) tuples
+    @param context: Passed to the constructors of the handlers
+    """
+    def __init__(self, urlhandlers, context):
+        self.context = context
+        self.routes = []
+        instances = {}
+        for r, cls in urlhandlers:
+            instance = None
+            if getattr(cls, "reusable", False):
+                if cls not in instances:
+                    instances[cls] = cls(context)
+                instance = instances[cls]
+            self.routes.append((_literal_prefix(r), re.compile(r), cls, instance))
+        self.key_size = min([len(route[0]) for route in self.routes] or [0])
+        self._index = {}
+        for route in self.routes:
+            self._index.setdefault(route[0][:self.key_size], []).append(route)
+
+    def match(self, path):
+        """Returns (handler, match object), or (None, None) if no route matches path"""
+        for prefix, regex, cls, instance in self._index.get(path[:self.key_size], ()):
+            if path.startswith(prefix):
+                m = regex.match(path)
+                if m is not None:
+                    if instance is None:
+                        return cls(self.context), m
+                    return instance, m
+        return None, None
+
+
+_date = [None, None]
+
+def http_date():
+    """Returns the current time for a Date header, it's only formatted once a second"""
+    now = int(time.time())
+    if _date[0] != now:
+        _date[:] = [now, email.utils.formatdate(now, usegmt=True)]
+    return _date[1]
+
+
+class AsyncHTTPRequestHandler(asyncore.dispatcher):
     """
     An asynchronous HTTP request handler inspired somewhat by the
     http://code.activestate.com/recipes/440665-asynchronous-http-server/
     recipe.
+
+    Connections are persistent unless the client asks otherwise (or is
+    a HTTP/1.0 client that doesn't ask for keep-alive). Pipelined requests
+    are dispatched as soon as they are received, but the responses are
+    sent in request order.
+
+    The requests are parsed by a L{RequestParser}. Their bodies can be at
+    most L{AsyncHTTPServer.max_body_size} bytes. A request that can't be
+    parsed is answered with an error, and the connection is closed.
+
+    The output queue holds the strs and buffers of the responses as they
+    are, and each is sent from an offset with buffer(), without copying
+    it. Small ones are joined with L{coalesce}, and file regions and
+    streamed bodies are read as they are sent. A response body that isn't
+    a str, buffer, list or L{FileRegion} is an iterable that is streamed
+    with the chunked transfer encoding.
     """
 
     server_version = "Tangled/" + __version__
+    protocol_version = "HTTP/1.1"
     methods = ["HEAD", "GET", "POST", "PUT", "DELETE", "TRACE", "OPTIONS", "CONNECT", "PATCH"]
-
-    class Pusher(object):
-        def __init__(self, obj):
-            self.obj = obj
-        def write(self, data):
-            self.obj.push(data)
+    recv_size = 65536
+    send_size = 65536
 
     def __init__(self, conn, addr, server):
-        asynchat.async_chat.__init__(self, conn)
+        asyncore.dispatcher.__init__(self, conn)
         self.client_address = addr
-        self.connection = conn
         self.server = server
-        self.urlhandlers = self.server.urlhandlers
-        # set the terminator : when it is received, this means that the
-        # http request is complete ; control will be passed to
-        # self.found_terminator
-        self.set_terminator ('\r\n\r\n')
-        self.incoming = []
-        self.rfile = None
-        self.wfile = AsyncHTTPRequestHandler.Pusher(self)
-        self.found_terminator = self.handle_request_line
-        self.protocol_version = "HTTP/1.1"
-        self.code = None
-
-    def collect_incoming_data(self,data):
-        self.incoming.append(data)
-
-    def create_rfile(self):
-        # BaseHTTPRequestHandler expects a file like object
-        self.rfile = cStringIO.StringIO(''.join(self.incoming))
-        self.incoming = []
-        self.rfile.seek(0)
-
-    def prepare_request(self):
-        """Prepare for reading the request body"""
-        bytesremaining = int(self.headers.getheader('content-length'))
-        # set terminator to length (will read bytesremaining bytes)
-        self.set_terminator(bytesremaining)
-        self.incoming = []
-        # control will be passed to a new found_terminator
-        self.found_terminator = self.handle_request_data
-
-    def handle_junk(self):
-        pass
-
-    def handle_request_data(self):
-        """Called when a request body has been read"""
-        self.create_rfile()
-        # set up so extra data is thrown away
-        self.set_terminator(None)
-        self.found_terminator = self.handle_junk
-        # Actually handle the request
-        self.handle_request()
-
-    def finish_request(self, response):
+        self.routes = server.routes
+        self.parser = RequestParser(server.max_body_size, server.spool_threshold)
+        self.pipeline = []
+        self.closing = False
+        self.dispatching = False
+        # strs, buffers, producers and None (close), how much of the first one has been sent
+        self.producer_fifo = collections.deque()
+        self.out_offset = 0
+        self.last_activity = time.time()
+        self.server.channel_opened(self)
+
+    def handle_read(self):
+        self.last_activity = time.time()
+        data = self.recv(self.recv_size)
+        if not data or self.closing:
+            # Anything after a request that closes the connection is thrown away
+            return
+        try:
+            requests = self.parser.feed(data)
+        except HTTPError, e:
+            requests = e.requests
+            error = e
+        else:
+            error = None
+        # The responses of handlers that respond at once are sent together
+        self.dispatching = True
+        try:
+            for head, body in requests:
+                self.handle_request(head, body)
+                if head.close:
+                    self.closing = True
+                    break
+        finally:
+            self.dispatching = False
+        self.initiate_send()
+        if self.closing:
+            return
+        if error is not None:
+            self.reject_request(error)
+        elif self.parser.continue_wanted:
+            self.parser.continue_wanted = False
+            self.send_continue()
+
+    def close(self):
+        self.server.channel_closed(self)
+        self.parser.close()
+        for producer in self.producer_fifo:
+            if isinstance(producer, FileRegion):
+                producer.close()
+        self.producer_fifo.clear()
+        asyncore.dispatcher.close(self)
+
+    def writable(self):
+        return bool(self.producer_fifo) or not self.connected
+
+    def handle_write(self):
+        self.initiate_send()
+
+    def handle_close(self):
+        self.close()
+
+    def push(self, data):
+        """
+        Queues data (a str, buffer or producer) to be sent, without copying
+        it. It's sent by L{initiate_send}.
+        """
+        if data:
+            self.producer_fifo.append(data)
+
+    def close_when_done(self):
+        self.producer_fifo.append(None)
+        self.initiate_send()
+
+    def initiate_send(self):
+        fifo = self.producer_fifo
+        while fifo and self.connected:
+            first = fifo[0]
+            if first is None:
+                fifo.popleft()
+                self.handle_close()
+                return
+            if not isinstance(first, (basestring, buffer)):
+                data = first.more()
+                if fifo and fifo[0] is first:
+                    if data:
+                        fifo.appendleft(data)
+                    else:
+                        fifo.popleft()
+                continue
+            if self.out_offset == 0:
+                first = coalesce(fifo, self.send_size)
+                if not self.connected:
+                    # A producer failed
+                    return
+            size = min(len(first) - self.out_offset, self.send_size)
+            num_sent = self.send(buffer(first, self.out_offset, size))
+            self.out_offset += num_sent
+            if self.out_offset == len(first):
+                fifo.popleft()
+                self.out_offset = 0
+            if num_sent < size:
+                # Wait until the socket is writable again
+                return
+
+    def stream_failed(self):
+        log.exception("Streaming the response failed")
+        self.close()
+
+    def is_idle(self, now, timeout):
+        """True if the connection hasn't been used for timeout seconds"""
+        return (not self.pipeline and
+                not self.producer_fifo and
+                now - self.last_activity > timeout)
+
+    def send_continue(self):
+        """Tells a client that waits for it before sending the body to go ahead"""
+        if not self.pipeline:
+            self.push("HTTP/1.1 100 Continue\r\n\r\n")
+            self.initiate_send()
+
+    def reject_request(self, error):
+        """Responds to a request that can't be parsed, and closes the connection"""
+        self.closing = True
+        pending = PendingResponse(error.head)
+        pending.close = True
+        self.pipeline.append(pending)
+        self.response_ready(pending, Response(error.code))
+
+    def response_ready(self, pending, response):
         """
-        Called with the request handler's response
+        Called with the request handler's response, sends all responses
+        that are ready in request order.
+        """
+        pending.response = response
+        while self.pipeline and self.pipeline[0].response is not None:
+            pending = self.pipeline.pop(0)
+            response = pending.response
+            if (_streamed(response.data) and pending.version != "HTTP/1.1" and
+                not response.has_header("Content-Length")):
+                # The end of the body is the end of the connection
+                pending.close = True
+            if not response.has_header("Connection"):
+                if pending.close:
+                    if pending.version == "HTTP/1.1":
+                        response.headers["Connection"] = "close"
+                elif pending.version != "HTTP/1.1":
+                    response.headers["Connection"] = "keep-alive"
+            self.finish_request(pending, response)
+            if pending.close:
+                self.pipeline = []
+                self.close_when_done()
+        # The responses that are ready are sent together
+        if not self.dispatching:
+            self.initiate_send()
+        self.last_activity = time.time()
+
+    def response_failed(self, pending, failure):
+        log.error("Request handler failed: %s", failure)
+        self.response_ready(pending, Response(500))
+
+    def finish_request(self, pending, response):
+        """
+        Writes the response to a request
  
         @param response: The response to the request
         @type response: L{Response}
         """
-        self.send_response(response.code)
+        code = response.code
+        log.info('"%s" %s %s', pending.requestline, code, "-")
+        head = ["%s %d %s\r\n"%(self.protocol_version, code, httplib.responses.get(code, "")),
+                "Server: %s\r\nDate: %s\r\n"%(self.server_version, http_date())]
         for k, v in response.headers.items():
-            self.send_header(k, v)
-        if not response.data:
-            if "Content-Length" not in response.headers:
-                self.send_header("Content-Length", "0")
-            self.end_headers()
+            head.append("%s: %s\r\n"%(k, v))
+        data = response.data
+        length = response.has_header("Content-Length")
+        if not data:
+            if not length:
+                head.append("Content-Length: 0\r\n")
+            data = ()
+        elif isinstance(data, list):
+            boundary = str(uuid.uuid4())
+            head.append("Content-Type: multipart/mixed; boundary=%s\r\n"%boundary)
+            # TODO: might be a good idea to use the 'email' module to create the message..
+            multidata = []
+            for part in data:
+                multidata.append("\r\n--%s\r\nContent-Type: text/plain\r\n\r\n"%boundary)
+                multidata.append(part)
+            multidata.append("\r\n--%s--\r\n"%boundary)
+            head.append("Content-Length: %d\r\n"%sum([len(part) for part in multidata]))
+            # The parts may be buffers, they're sent as they are
+            data = multidata
+        elif _streamed(data):
+            encode = not length and pending.version == "HTTP/1.1"
+            if encode:
+                head.append("Transfer-Encoding: chunked\r\n")
+            data = [StreamProducer(data, encode, self.stream_failed)]
         else:
-            if isinstance(response.data, list):
-                boundary = str(uuid.uuid4())
-                self.send_header("Content-Type", "multipart/mixed; boundary=%s"%boundary)
-                # TODO: might be a good idea to use the 'email' module to create the message..
-                multidata = []
-                for data in response.data:
-                    multidata.append("\r\n--%s\r\n"%boundary)
-                    multidata.append("Content-Type: text/plain\r\n\r\n")
-                    multidata.append(data)
-                multidata.append("\r\n--%s--\r\n"%boundary)
-                multidata = "".join(multidata)
-                self.send_header("Content-Length", len(multidata))
-                self.end_headers()
-                self.push(multidata)
-            else:
-                if "Content-Length" not in response.headers:
-                    self.send_header("Content-Length", "%d"%len(response.data))
-                self.end_headers()
-                self.push(response.data)
-
-        self.close_when_done()
+            if not length:
+                head.append("Content-Length: %d\r\n"%len(data))
+            data = [data]
+        head.append("\r\n")
+        self.push("".join(head))
+        for part in data:
+            self.push(part)
 
-    def handle_request(self):
+    def handle_request(self, head, body=""):
         """Dispatch the request to a handler"""
-        for r, cls in self.urlhandlers:
-            m = re.match(r, self.path)
-            if m is not None:
-                try:
-                    h = cls(self.server.context)
-                    handler = getattr(h, "do_" + self.command)
-                    d = handler(Request(self.client_address,
-                                        self.command,
-                                        self.path,
-                                        self.headers,
-                                        self.rfile.read(),
-                                        m.groups()))
-                    d.add_callback(self.finish_request)
-                except AttributeError:
-                    raise
-                    # Method not supported
-                    self.send_header("Allow", ", ".join([method for method in self.methods if hasattr(h, "do_" + method)]))
-                    self.send_error(405)
-                    self.end_headers()
-                    self.close_when_done()
-                return
-        # No match found, send 404
-        self.send_error(404)
-        self.end_headers()
-        self.close_when_done()
-
-    def handle_request_line(self):
-        """Called when the http request line and headers have been received"""
-        # prepare attributes needed in parse_request()
-        self.create_rfile()
-        self.raw_requestline = self.rfile.readline()
-        self.parse_request()
-
-        if self.command in ["PUT", "POST"]:
-            # Wait for the data to come in before processing the request
-            self.prepare_request()
-        else:
-            self.handle_request()
-
-    def log_message(self, format, *args):
-        log.info(format, *args)
+        pending = PendingResponse(head)
+        self.pipeline.append(pending)
+        h, m = self.routes.match(head.path)
+        if h is None:
+            # No match found, send 404
+            self.response_ready(pending, Response(404))
+            return
+        handler = getattr(h, "do_" + head.method, None)
+        if handler is None:
+            # Method not supported
+            allow = ", ".join([method for method in self.methods if hasattr(h, "do_" + method)])
+            self.response_ready(pending, Response(405, {"Allow": allow}))
+            return
+        d = handler(Request(self.client_address, head.method, head.path, head.headers, body, m.groups()))
+        d.add_callbacks(functools.partial(self.response_ready, pending),
+                        functools.partial(self.response_failed, pending))
 
-    def request_handled(self, response):
-        self.send_response(response.code)
-        for k, v in response.headers.items():
-            self.send_header(k, v)
-        self.end_headers()
-        if self.data:
-            self.push(data)
-        self.close_when_done()
 
-    def request_error(self, error):
-        self.send_error(error)
-        self.close_when_done()
+def _streamed(data):
+    """True if a response body is an iterable to stream"""
+    return bool(data) and not isinstance(data, (basestring, buffer, list, FileRegion))
 
 
 class AsyncHTTPServer(asyncore.dispatcher):
@@ -215,23 +912,51 @@ class AsyncHTTPServer(asyncore.dispatcher):
     Cobbled together from various sources, most of them state that they
     copied from the Medusa http server..    
     """
-    def __init__(self, address, context, urlhandlers):
+    idle_timeout = 60.0
+    max_body_size = 64 * 1024 * 1024
+    """Requests with larger bodies get 413 Request Entity Too Large"""
+    spool_threshold = 1024 * 1024
+    """Request bodies larger than this are written to temporary files while they're received"""
+
+    def __init__(self, address, context, urlhandlers, reactor=None):
         """
         @param address: Tuple of address, port
         @param context: Something that gets passed to the handler's constructor for each request
         @param urlhandlers: list of (regex, handler) tuples. 
+        @param reactor: If provided, idle connections are closed after L{idle_timeout} seconds
+        @type reactor: L{core.Reactor}
 
         A handler needs to have a constructor that accepts the context object, 
-        and a do_* method for each HTTP verb it wants to handle.
+        and a do_* method for each HTTP verb it wants to handle. A handler
+        that doesn't keep any state of a request in its attributes can set
+        reusable = True, then it's only constructed once (see L{RouteTable}).
         """
         self.context = context
-        self.urlhandlers = [(re.compile(r), h) for r, h in urlhandlers]
+        self.routes = RouteTable(urlhandlers, context)
         self.address = address
+        self.reactor = reactor
+        self.channels = set()
         asyncore.dispatcher.__init__(self)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind(self.address)
         self.listen(5)
+        if self.reactor is not None:
+            self.reactor.call_later(self.close_idle, self.idle_timeout / 2)
+
+    def channel_opened(self, channel):
+        self.channels.add(channel)
+
+    def channel_closed(self, channel):
+        self.channels.discard(channel)
+
+    def close_idle(self):
+        """Closes the connections that have been idle for too long"""
+        now = time.time()
+        for c in [c for c in self.channels if c.is_idle(now, self.idle_timeout)]:
+            log.debug("Closing idle connection from %s", c.client_address)
+            c.close()
+        self.reactor.call_later(self.close_idle, self.idle_timeout / 2)
 
     def handle_accept(self):
         try:
@@ -246,8 +971,251 @@ class AsyncHTTPServer(asyncore.dispatcher):
         # on the incoming connection
         AsyncHTTPRequestHandler(conn, addr, self)
 
+class TestServer(unittest.TestCase):
+    def _feed(self, parser, data, step=None):
+        requests = []
+        step = step or len(data)
+        for i in range(0, len(data), step):
+            requests.extend(parser.feed(data[i:i+step]))
+        return requests
+
+    def test_parse_split(self):
+        data = ("PUT /store/a HTTP/1.1\r\nHost: x\r\nX-Thing: 1\r\nx-thing: 2\r\n"
+                "Content-Length: 5\r\n\r\nhello")
+        for step in (1, 7, len(data)):
+            parser = RequestParser(1024, 1024)
+            requests = self._feed(parser, data, step)
+            self.assertEqual(len(requests), 1)
+            head, body = requests[0]
+            self.assertEqual((head.method, head.path, head.version), ("PUT", "/store/a", "HTTP/1.1"))
+            self.assertEqual(head.headers["X-THING"], "1, 2")
+            self.assertEqual(head.headers.getheader("host"), "x")
+            self.assertTrue("content-LENGTH" in head.headers)
+            self.assertFalse(head.close)
+            self.assertEqual(body, "hello")
+
+    def test_parse_pipelined(self):
+        data = ("GET /a HTTP/1.1\r\n\r\n"
+                "\r\nPUT /b HTTP/1.0\r\nContent-Length: 3\r\n\r\nabc"
+                "PUT /c HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                "3;ext=1\r\nabc\r\n2\r\nde\r\n0\r\nTrailer: x\r\n\r\n"
+                "GET /d HTTP/1.1\r\nConnection: close\r\n\r\n")
+        for step in (1, 5, len(data)):
+            requests = self._feed(RequestParser(1024, 1024), data, step)
+            self.assertEqual([(h.path, body) for h, body in requests],
+                             [("/a", ""), ("/b", "abc"), ("/c", "abcde"), ("/d", "")])
+            self.assertEqual([h.close for h, body in requests], [False, True, False, True])
+
+    def test_parse_spooled(self):
+        parser = RequestParser(1024, 10)
+        head, body = parser.feed("PUT /a HTTP/1.1\r\nContent-Length: 20\r\n\r\n" + "x" * 20)[0]
+        self.assertEqual(body.read(), "x" * 20)
+        body.close()
+
+    def test_continue(self):
+        parser = RequestParser(1024, 1024)
+        self.assertEqual(parser.feed("PUT /a HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: 3\r\n\r\n"), [])
+        self.assertTrue(parser.continue_wanted)
+        self.assertEqual(len(parser.feed("abc")), 1)
+        self.assertFalse(parser.continue_wanted)
+        # The body came with the head
+        parser.feed("PUT /a HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: 3\r\n\r\nabc")
+        self.assertFalse(parser.continue_wanted)
+        parser.feed("PUT /a HTTP/1.0\r\nExpect: 100-continue\r\nContent-Length: 3\r\n\r\n")
+        self.assertFalse(parser.continue_wanted)
+
+    def test_parse_errors(self):
+        cases = [("PUT /a HTTP/1.1\r\nContent-Length: -5\r\n\r\n", 400),
+                 ("PUT /a HTTP/1.1\r\nContent-Length: abc\r\n\r\n", 400),
+                 ("PUT /a HTTP/1.1\r\nContent-Length: 3\r\nContent-Length: 3\r\n\r\n", 400),
+                 ("GARBAGE\r\n\r\n", 400),
+                 ("GET /a\r\n\r\n", 400),
+                 ("GET /a HTTPS/1.1\r\n\r\n", 400),
+                 ("GET /a HTTP/2.0\r\n\r\n", 505),
+                 ("GET /a HTTP/1.1\r\nHost: x\r\n folded\r\n\r\n", 400),
+                 ("GET /a HTTP/1.1\r\nHost : x\r\n\r\n", 400),
+                 ("GET /a HTTP/1.1\r\nNo colon\r\n\r\n", 400),
+                 ("PUT /a HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n", 501),
+                 ("PUT /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n", 400),
+                 ("PUT /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabcX\r\n", 400),
+                 ("PUT /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" + "1" * 9000, 400),
+                 ("PUT /a HTTP/1.1\r\nContent-Length: 1025\r\n\r\n", 413),
+                 ("PUT /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n400\r\n" + "x" * 1024 + "\r\n1\r\n", 413),
+                 ("GET /" + "a" * 9000 + " HTTP/1.1\r\n\r\n", 414),
+                 ("GET /a HTTP/1.1\r\n" + "X-A: b\r\n" * 101 + "\r\n", 431),
+                 ("GET /a HTTP/1.1\r\n" + "X-A: %s\r\n" % ("b" * 1000) * 70, 431)]
+        for data, code in cases:
+            parser = RequestParser(1024, 1024)
+            try:
+                self._feed(parser, data)
+            except HTTPError, e:
+                self.assertEqual(e.code, code, data[:60])
+            else:
+                self.fail("No error for %r" % data[:60])
+
+    def test_error_after_requests(self):
+        parser = RequestParser(1024, 1024)
+        try:
+            parser.feed("GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nPUT /c HTTP/1.1\r\nContent-Length: -5\r\n\r\n")
+        except HTTPError, e:
+            self.assertEqual(e.code, 400)
+            self.assertEqual([h.path for h, body in e.requests], ["/a", "/b"])
+            self.assertEqual(e.head.path, "/c")
+        else:
+            self.fail("No error")
+
+    def test_literal_prefix(self):
+        for pattern, prefix in [(r"/store(?:\?.*)?$", "/store"),
+                                (r"/store/([^?]*)", "/store/"),
+                                (r"^/admin/(.*)", "/admin/"),
+                                (r"/ab?c", "/a"),
+                                (r"/ab{2}", "/a"),
+                                (r"/a\.b", "/a"),
+                                (r"/a|/b", ""),
+                                (r"(?i)/a", ""),
+                                (r"/x[|]y", "/x"),
+                                (r"/x[|]y|z", "")]:
+            self.assertEqual(_literal_prefix(pattern), prefix, pattern)
+
+    def test_routes(self):
+        class Handler(object):
+            reusable = True
+            def __init__(self, context):
+                self.context = context
+        class PerRequest(object):
+            def __init__(self, context):
+                self.context = context
+        patterns = [r"/store(?:\?.*)?$", r"/store/([^?]*)", r"/st", r"/a/b", r"/a", r"/a/(.*)",
+                    r"/ab?c", r"/x|/y", r"/_merkle/(\d+)/(\d+)", r"(?i)/CASE"]
+        urlhandlers = [(p, type("H%d" % i, (Handler,), {})) for i, p in enumerate(patterns)]
+        urlhandlers.append((r"/per/(.*)", PerRequest))
+        table = RouteTable(urlhandlers, "context")
+        compiled = [(re.compile(r), h) for r, h in urlhandlers]
+        paths = ["/store", "/store?prefix=a", "/store/key", "/stx", "/st", "/a/b", "/a/c", "/a",
+                 "/ac", "/abc", "/y", "/x", "/_merkle/1/2", "/_merkle/a", "/case", "/", "", "/per/1"]
+        for path in paths:
+            expected = None
+            for r, h in compiled:
+                m = r.match(path)
+                if m is not None:
+                    expected = (h, m.groups())
+                    break
+            h, m = table.match(path)
+            if expected is None:
+                self.assertEqual((h, m), (None, None), path)
+            else:
+                self.assertEqual((type(h), m.groups()), expected, path)
+                self.assertEqual(h.context, "context")
+        # Reusable handlers are constructed once
+        self.assertTrue(table.match("/a/b")[0] is table.match("/a/b")[0])
+        self.assertFalse(table.match("/per/1")[0] is table.match("/per/1")[0])
+
+
+class TestRequestHandler(unittest.TestCase):
+    class Server(object):
+        max_body_size = 1024
+        spool_threshold = 1024
+        def __init__(self, urlhandlers):
+            self.routes = RouteTable(urlhandlers, self)
+            self.pending = {}
+        def channel_opened(self, channel):
+            pass
+        def channel_closed(self, channel):
+            pass
+
+    class Handler(object):
+        """Answers /slow/name when the test fires its Deferred, and /echo at once"""
+        reusable = True
+        def __init__(self, server):
+            self.server = server
+        def do_GET(self, request):
+            if request.groups[0] == "echo":
+                return core.succeed(Response(200, None, request.path))
+            d = self.server.pending[request.groups[1]] = core.Deferred()
+            return d
+        def do_PUT(self, request):
+            return core.succeed(Response(201, {"content-length": "2"}, request.data[:2]))
+
+    def setUp(self):
+        self.server = self.Server([(r"/(slow|echo)/?(.*)", self.Handler)])
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(0.2)
+        self.channel = AsyncHTTPRequestHandler(self.sock, ("127.0.0.1", 1), self.server)
+
+    def tearDown(self):
+        self.channel.close()
+        self.peer.close()
+
+    def _send(self, data):
+        self.peer.sendall(data)
+        self.channel.handle_read()
+
+    def _receive(self):
+        """Returns the responses sent, and True if the connection was closed"""
+        data = ""
+        while True:
+            try:
+                d = self.peer.recv(65536)
+            except socket.timeout:
+                return data, False
+            if not d:
+                return data, True
+            data = data + d
+
+    def _statuses(self, data):
+        return re.findall(r"HTTP/1\.1 (\d+) ", data)
+
+    def test_pipelining_order(self):
+        self._send("GET /slow/1 HTTP/1.1\r\n\r\nGET /echo HTTP/1.1\r\n\r\nGET /slow/2 HTTP/1.1\r\n\r\n")
+        self.server.pending["2"].callback(Response(202, None, "two"))
+        self.assertEqual(self._receive(), ("", False))
+        self.server.pending["1"].callback(Response(201, None, "one"))
+        data, closed = self._receive()
+        self.assertEqual(self._statuses(data), ["201", "200", "202"])
+        self.assertTrue(data.index("one") < data.index("/echo") < data.index("two"))
+        self.assertFalse(closed)
+
+    def test_keep_alive(self):
+        self._send("GET /echo HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+        data, closed = self._receive()
+        self.assertTrue("Connection: keep-alive\r\n" in data)
+        self.assertFalse(closed)
+        self._send("GET /echo HTTP/1.1\r\nConnection: close\r\n\r\nGET /echo HTTP/1.1\r\n\r\n")
+        data, closed = self._receive()
+        self.assertEqual(self._statuses(data), ["200"])
+        self.assertTrue("Connection: close\r\n" in data)
+        self.assertTrue(closed)
+
+    def test_http10_closes(self):
+        self._send("GET /echo HTTP/1.0\r\n\r\n")
+        data, closed = self._receive()
+        self.assertEqual(self._statuses(data), ["200"])
+        self.assertTrue(closed)
+
+    def test_error_closes(self):
+        self._send("GET /echo HTTP/1.1\r\n\r\nPUT /echo HTTP/1.1\r\nContent-Length: -5\r\n\r\nGET /echo HTTP/1.1\r\n\r\n")
+        data, closed = self._receive()
+        self.assertEqual(self._statuses(data), ["200", "400"])
+        self.assertTrue(closed)
+
+    def test_not_found_and_not_allowed(self):
+        self._send("GET /nope HTTP/1.1\r\n\r\nDELETE /echo HTTP/1.1\r\n\r\n")
+        data, closed = self._receive()
+        self.assertEqual(self._statuses(data), ["404", "405"])
+        self.assertTrue("Allow: GET, PUT\r\n" in data)
+
+    def test_continue_and_content_length(self):
+        self._send("PUT /echo HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: 5\r\n\r\n")
+        self.assertEqual(self._receive(), ("HTTP/1.1 100 Continue\r\n\r\n", False))
+        self._send("hello")
+        data, closed = self._receive()
+        self.assertEqual(self._statuses(data), ["201"])
+        # The handler's content-length isn't repeated
+        self.assertEqual(data.lower().count("content-length"), 1)
+        self.assertTrue(data.endswith("\r\n\r\nhe"))
+
+
 if __name__=="__main__":
-    import core
     class MultiPartHandler(object):
         def __init__(self, context):
             pass
@@ -258,6 +1226,14 @@ if __name__=="__main__":
             pass
         def do_GET(self, request):
             return core.succeed(Response(200, None, "elephant\ngiraffe\nlion"))
-    server = AsyncHTTPServer(("localhost", 8080), None, [("/multipart", MultiPartHandler), ("/normal", NormalHandler)])
+    class StreamHandler(object):
+        def __init__(self, context):
+            pass
+        def do_GET(self, request):
+            return core.succeed(Response(200, None, iter(["elephant\n", "giraffe\n", "lion"])))
+        def do_PUT(self, request):
+            return core.succeed(Response(200, None, "%d bytes\n"%len(request.data)))
+    server = AsyncHTTPServer(("localhost", 8080), None, [("/multipart", MultiPartHandler), ("/normal", NormalHandler),
+                                                         ("/stream", StreamHandler)])
     asyncore.loop()
 
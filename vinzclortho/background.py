@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Scheduling of background work (handoff, hint replay, anti-entropy and
+read-repair), so that it doesn't take the bandwidth and the workers away
+from the requests of the clients.
+"""
+
+import collections
+import functools
+import time
+import unittest
+
+import tangled.core as tc
+
+class BackgroundScheduler(object):
+    """
+    Node wide limits for background work.
+
+    The bytes sent by background work go through a token bucket, that is
+    refilled with L{rate} bytes per second and holds at most L{burst} bytes.
+    The number of partitions transferred at the same time is limited to
+    L{max_transfers}.
+
+    @param reactor: Used to wait for tokens
+    @param rate: Bytes per second, None for no limit
+    @param max_transfers: How many partitions can be transferred at once, None for no limit
+    @param clock: Returns the current time, for tests
+    """
+    def __init__(self, reactor, rate=None, max_transfers=2, clock=time.time):
+        self.reactor = reactor
+        self.clock = clock
+        self.rate = None
+        self.burst = 0
+        self.max_transfers = max_transfers
+        self.transfers = 0
+        self.throttled = 0
+        self.bytes = 0
+        self._tokens = 0
+        self._updated = clock()
+        self._waiting = collections.deque()
+        self._queued_transfers = collections.deque()
+        self._timer = False
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Changes the rate (bytes per second, None or 0 for no limit)"""
+        self._refill()
+        self.rate = rate or None
+        # One second worth of sending
+        self.burst = self.rate or 0
+        self._tokens = min(self._tokens, self.burst)
+        self._release()
+
+    def set_max_transfers(self, max_transfers):
+        """Changes how many partitions can be transferred at once (None or 0 for no limit)"""
+        self.max_transfers = max_transfers or None
+        self._start_transfers()
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def throttle(self, nbytes):
+        """
+        Returns a L{tangled.core.Deferred} that is called back when nbytes
+        may be sent. Bigger sends than L{burst} are let through when the
+        bucket is full, and then the following sends have to wait longer.
+        """
+        self.bytes = self.bytes + nbytes
+        d = tc.Deferred()
+        self._waiting.append((nbytes, d))
+        self._release()
+        return d
+
+    def _release(self):
+        if self.rate is None:
+            ready = list(self._waiting)
+            self._waiting.clear()
+            for nbytes, d in ready:
+                d.callback(nbytes)
+            return
+        self._refill()
+        while self._waiting:
+            nbytes, d = self._waiting[0]
+            needed = min(nbytes, self.burst)
+            if self._tokens < needed:
+                self.throttled = self.throttled + 1
+                if not self._timer:
+                    self._timer = True
+                    self.reactor.call_later(self._timeout, (needed - self._tokens) / float(self.rate))
+                return
+            self._waiting.popleft()
+            self._tokens = self._tokens - nbytes
+            d.callback(nbytes)
+
+    def _timeout(self):
+        self._timer = False
+        self._release()
+
+    def transfer(self, func):
+        """
+        Calls func when fewer than L{max_transfers} transfers are going on.
+        func should return a Deferred, and the transfer is over when that is
+        called back (or errbacked).
+
+        @return: A Deferred with the result of func's Deferred
+        """
+        d = tc.Deferred()
+        self._queued_transfers.append((func, d))
+        self._start_transfers()
+        return d
+
+    def _start_transfers(self):
+        while self._queued_transfers and (self.max_transfers is None or self.transfers < self.max_transfers):
+            func, d = self._queued_transfers.popleft()
+            self.transfers = self.transfers + 1
+            try:
+                result = func()
+            except:
+                result = tc.fail(tc.Failure())
+            result.add_both(functools.partial(self._transfer_done, d))
+
+    def _transfer_done(self, d, result):
+        self.transfers = self.transfers - 1
+        if isinstance(result, tc.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+        self._start_transfers()
+
+    def stats(self):
+        """Returns a dict of the settings and counters"""
+        return {"rate": self.rate or 0,
+                "max_transfers": self.max_transfers or 0,
+                "transfers": self.transfers,
+                "queued_transfers": len(self._queued_transfers),
+                "waiting": len(self._waiting),
+                "throttled": self.throttled,
+                "bytes": self.bytes}
+
+
+class TestBackgroundScheduler(unittest.TestCase):
+    class Reactor(object):
+        def __init__(self):
+            self.calls = []
+
+        def call_later(self, func, timeout):
+            self.calls.append((timeout, func))
+
+    def setUp(self):
+        self.now = 0.0
+        self.reactor = self.Reactor()
+
+    def _clock(self):
+        return self.now
+
+    def test_unlimited(self):
+        s = BackgroundScheduler(self.reactor, clock=self._clock)
+        done = []
+        s.throttle(1000000).add_callback(done.append)
+        self.assertEqual(done, [1000000])
+        self.assertEqual(self.reactor.calls, [])
+
+    def test_rate(self):
+        s = BackgroundScheduler(self.reactor, 1000, clock=self._clock)
+        done = []
+        # The bucket starts empty
+        s.throttle(500).add_callback(done.append)
+        s.throttle(500).add_callback(done.append)
+        self.assertEqual(done, [])
+        self.assertEqual(len(self.reactor.calls), 1)
+        self.assertAlmostEqual(self.reactor.calls[0][0], 0.5)
+        self.now = 0.5
+        self.reactor.calls.pop()[1]()
+        self.assertEqual(done, [500])
+        self.now = 1.0
+        self.reactor.calls.pop()[1]()
+        self.assertEqual(done, [500, 500])
+        # Larger than the burst, sent when the bucket is full
+        s.throttle(5000).add_callback(done.append)
+        self.now = 2.0
+        self.reactor.calls.pop()[1]()
+        self.assertEqual(done[-1], 5000)
+        s.set_rate(None)
+        s.throttle(1).add_callback(done.append)
+        self.assertEqual(done[-1], 1)
+
+    def test_transfers(self):
+        s = BackgroundScheduler(self.reactor, max_transfers=2, clock=self._clock)
+        started = []
+        finished = []
+        def transfer(n):
+            d = tc.Deferred()
+            started.append((n, d))
+            return d
+        for n in range(4):
+            s.transfer(functools.partial(transfer, n)).add_callback(finished.append)
+        self.assertEqual([n for n, d in started], [0, 1])
+        started[0][1].callback("a")
+        self.assertEqual(finished, ["a"])
+        self.assertEqual([n for n, d in started], [0, 1, 2])
+        s.set_max_transfers(None)
+        self.assertEqual([n for n, d in started], [0, 1, 2, 3])
+        self.assertEqual(s.stats()["transfers"], 3)
+
+if __name__=="__main__":
+    unittest.main()
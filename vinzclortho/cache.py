@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+A cache of resolved values for the coordinator of reads, so that reads of
+hot keys don't have to go to the replicas (and decode their versions)
+every time.
+"""
+
+import time
+import unittest
+
+import vectorclock
+
+class _Entry(object):
+    __slots__ = ("key", "vc", "value", "expires", "size", "prev", "next")
+    def __init__(self, key, vc, value, expires, size):
+        self.key = key
+        self.vc = vc
+        self.value = value
+        self.expires = expires
+        self.size = size
+        self.prev = None
+        self.next = None
+
+
+class Cache(object):
+    """
+    A bounded LRU cache of (vector clock, value) pairs, where the entries
+    expire after L{ttl} seconds.
+
+    Writes that go through this node invalidate the keys with
+    L{invalidate}, the TTL bounds how stale an entry can be when other
+    nodes coordinate the writes.
+
+    A read that will fill the cache starts with L{begin}, and ends with
+    L{end}. If the key is invalidated in between, the value it read may
+    already be old and isn't cached.
+
+    @param max_entries: The maximum number of keys in the cache
+    @param ttl: Seconds an entry is used for
+    @param clock: Returns the current time, for tests
+    """
+    entry_overhead = 200
+    """Approximate bytes used by an entry, besides the key and the value"""
+    clock_overhead = 80
+    """Approximate bytes used by each entry of a vector clock"""
+
+    def __init__(self, max_entries, ttl, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = {}
+        # The most recently used entry is _head.next, the least recently used _head.prev
+        self._head = _Entry(None, None, None, None, 0)
+        self._head.prev = self._head.next = self._head
+        # key -> [reads, generation of the last invalidation]
+        self._reading = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _link(self, entry):
+        head = self._head
+        entry.prev = head
+        entry.next = head.next
+        head.next.prev = entry
+        head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self.bytes = self.bytes - entry.size
+
+    def get(self, key):
+        """Returns the (vc, value) of key, or None if it isn't cached"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        if entry.expires <= self.clock():
+            self._remove(entry)
+            self.expirations = self.expirations + 1
+            self.misses = self.misses + 1
+            return None
+        self._unlink(entry)
+        self._link(entry)
+        self.hits = self.hits + 1
+        return entry.vc, entry.value
+
+    def begin(self, key):
+        """Returns the token to pass to L{end} when the read of key is done"""
+        reading = self._reading.get(key)
+        if reading is None:
+            self._reading[key] = [1, 0]
+        else:
+            reading[0] = reading[0] + 1
+        return self._generation
+
+    def end(self, key, token, resolved=None):
+        """
+        Ends a read started with L{begin}, and caches its result unless
+        the key was invalidated during the read.
+
+        @param resolved: The (vc, value) that was read, None if the read failed
+        """
+        reading = self._reading[key]
+        reading[0] = reading[0] - 1
+        if reading[0] == 0:
+            del self._reading[key]
+        if resolved is not None and reading[1] <= token:
+            self.put(key, resolved[0], resolved[1])
+
+    def put(self, key, vc, value):
+        """
+        Caches value, unless the cached version of key is newer than vc
+        """
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if (entry.expires > now and entry.vc.descends_from(vc) and entry.vc != vc):
+                return
+            self._remove(entry)
+        size = self.entry_overhead + len(key) + len(value) + self.clock_overhead * len(vc._clocks)
+        entry = _Entry(key, vc, value, now + self.ttl, size)
+        self._entries[key] = entry
+        self._link(entry)
+        self.bytes = self.bytes + size
+        while len(self._entries) > self.max_entries:
+            self._remove(self._head.prev)
+            self.evictions = self.evictions + 1
+
+    def invalidate(self, key):
+        """Removes key, and keeps the reads of it that are going on from caching what they read"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._remove(entry)
+            self.invalidations = self.invalidations + 1
+        reading = self._reading.get(key)
+        if reading is not None:
+            self._generation = self._generation + 1
+            reading[1] = self._generation
+
+    def clear(self):
+        """Removes all entries"""
+        for entry in self._entries.values():
+            self._remove(entry)
+
+    def stats(self):
+        """Returns a dict of the settings and counters"""
+        lookups = self.hits + self.misses
+        hit_percent = 0
+        if lookups:
+            hit_percent = self.hits * 100 // lookups
+        return {"max_entries": self.max_entries,
+                "ttl_ms": int(self.ttl * 1000),
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_percent": hit_percent,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations}
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = Cache(2, 1.0, lambda: self.now)
+
+    def vc(self, *names):
+        vc = vectorclock.VectorClock()
+        for name in names:
+            vc.increment(name)
+        return vc
+
+    def test_get_put(self):
+        c = self.cache
+        self.assertEqual(c.get("a"), None)
+        vc = self.vc("x")
+        c.put("a", vc, "1")
+        self.assertEqual(c.get("a"), (vc, "1"))
+        self.assertEqual((c.hits, c.misses), (1, 1))
+        self.assertEqual(c.stats()["hit_percent"], 50)
+        self.assertTrue(c.bytes > 0)
+
+    def test_lru(self):
+        c = self.cache
+        c.put("a", self.vc("x"), "1")
+        c.put("b", self.vc("x"), "2")
+        c.get("a")
+        c.put("c", self.vc("x"), "3")
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get("b"), None)
+        self.assertNotEqual(c.get("a"), None)
+        self.assertNotEqual(c.get("c"), None)
+        self.assertEqual(c.evictions, 1)
+        c.clear()
+        self.assertEqual((len(c), c.bytes), (0, 0))
+
+    def test_ttl(self):
+        c = self.cache
+        c.put("a", self.vc("x"), "1")
+        self.now = self.now + 0.5
+        self.assertNotEqual(c.get("a"), None)
+        self.now = self.now + 0.5
+        self.assertEqual(c.get("a"), None)
+        self.assertEqual((len(c), c.bytes, c.expirations), (0, 0, 1))
+
+    def test_newer_version_kept(self):
+        c = self.cache
+        old = self.vc("x")
+        new = self.vc("x", "x")
+        c.put("a", new, "2")
+        c.put("a", old, "1")
+        self.assertEqual(c.get("a"), (new, "2"))
+        c.put("a", self.vc("x", "x", "x"), "3")
+        self.assertEqual(c.get("a")[1], "3")
+
+    def test_invalidate(self):
+        c = self.cache
+        c.put("a", self.vc("x"), "1")
+        c.invalidate("a")
+        self.assertEqual(c.get("a"), None)
+        self.assertEqual((len(c), c.bytes), (0, 0))
+
+    def test_invalidated_during_read(self):
+        c = self.cache
+        token = c.begin("a")
+        c.invalidate("a")
+        c.end("a", token, (self.vc("x"), "old"))
+        self.assertEqual(c.get("a"), None)
+        # A read that started after the write is cached
+        token = c.begin("a")
+        c.end("a", token, (self.vc("x", "x"), "new"))
+        self.assertEqual(c.get("a")[1], "new")
+        # Failed reads aren't
+        token = c.begin("b")
+        c.end("b", token)
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual(c._reading, {})
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+A blocking client for the batch and scan APIs of a Vinz Clortho cluster
+(POST and GET /store), for bulk loaders and scripts that read, write or
+list many keys.
+"""
+
+import base64
+import httplib
+import json
+import urllib
+import unittest
+
+class BatchError(Exception):
+    """The batch request failed as a whole"""
+    pass
+
+
+class Result(object):
+    """
+    The result for one key of a batch.
+
+    @ivar status: The HTTP status the key would have got by itself (200, 300, 404, 503)
+    @ivar context: The context to send with the next write of the key, or None
+    @ivar values: The values of a read, more than one if there are concurrent
+    versions (None for deleted ones)
+    """
+    def __init__(self, key, status, context=None, values=None):
+        self.key = key
+        self.status = status
+        self.context = context
+        self.values = values or []
+
+    @property
+    def ok(self):
+        return self.status in (200, 300)
+
+    @property
+    def value(self):
+        """The value of a read, if there is exactly one version"""
+        if len(self.values) == 1:
+            return self.values[0]
+        return None
+
+    def __repr__(self):
+        return "Result(%r, %d)"%(self.key, self.status)
+
+
+def encode_batch(get=(), put=(), delete=()):
+    """
+    Returns the JSON body of a batch request
+
+    @param get: The keys to read
+    @param put: (key, value, context) tuples, context can be None
+    @param delete: (key, context) tuples
+    """
+    body = {}
+    if get:
+        body["get"] = list(get)
+    if put:
+        body["put"] = [_op(key, context, value) for key, value, context in put]
+    if delete:
+        body["delete"] = [_op(key, context) for key, context in delete]
+    return json.dumps(body)
+
+def _op(key, context, value=None):
+    op = {"key": key}
+    if value is not None:
+        op["value"] = base64.b64encode(value)
+    if context is not None:
+        op["context"] = context
+    return op
+
+def decode_results(data):
+    """Returns a dict of "get", "put" and "delete" to lists of L{Result}s, from a batch response body"""
+    body = json.loads(data)
+    results = {}
+    for op in ("get", "put", "delete"):
+        results[op] = [_result(r) for r in body.get(op, [])]
+    return results
+
+def _value(v):
+    if v is None:
+        return None
+    return base64.b64decode(v)
+
+def _result(r):
+    values = [_value(v) for v in r.get("values", [])]
+    return Result(r["key"].encode("utf-8"), r["status"], r.get("context"), values)
+
+def _items(items):
+    if isinstance(items, dict):
+        return items.items()
+    return items
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+class Client(object):
+    """
+    Reads and writes many keys with few requests. Any node of the cluster
+    can be used. The keys are sent L{batch_size} at a time.
+
+    @param address: host:port of a node
+    @param client_id: Identifies the client in the vector clocks of the values
+    @param timeout: Milliseconds the node may spend on a batch, None for its default
+    """
+    batch_size = 1000
+    def __init__(self, address, client_id=None, timeout=None):
+        self.address = address
+        self.client_id = client_id
+        self.timeout = timeout
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.client_id is not None:
+            headers["X-VinzClortho-ClientId"] = self.client_id
+        if self.timeout is not None:
+            headers["X-VinzClortho-Timeout"] = "%d"%self.timeout
+        if self._conn is None:
+            self._conn = httplib.HTTPConnection(self.address)
+        try:
+            self._conn.request(method, path, body, headers)
+            response = self._conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, IOError):
+            self.close()
+            raise
+        if response.status != 200:
+            raise BatchError("%s %s failed (%d)"%(method, path, response.status))
+        return data
+
+    def _post(self, body):
+        return self._request("POST", "/store", body, {"Content-Type": "application/json"})
+
+    def _get(self, query):
+        return self._request("GET", "/store?" + urllib.urlencode(sorted(query.items())))
+
+    def batch(self, get=(), put=(), delete=()):
+        """Makes one batch request, see L{encode_batch} and L{decode_results}"""
+        return decode_results(self._post(encode_batch(get, put, delete)))
+
+    def multi_get(self, keys):
+        """Returns a dict of key to L{Result}"""
+        results = {}
+        for chunk in _chunks(list(keys), self.batch_size):
+            for r in self.batch(get=chunk)["get"]:
+                results[r.key] = r
+        return results
+
+    def multi_put(self, items):
+        """
+        Writes the values, and returns a dict of key to L{Result}
+
+        @param items: A dict of key to value, or a list of (key, value) or (key, value, context) tuples
+        """
+        results = {}
+        put = [tuple(item) + (None,) * (3 - len(item)) for item in _items(items)]
+        for chunk in _chunks(put, self.batch_size):
+            for r in self.batch(put=chunk)["put"]:
+                results[r.key] = r
+        return results
+
+    def multi_delete(self, keys):
+        """
+        Deletes the keys, and returns a dict of key to L{Result}
+
+        @param keys: A list of keys, or of (key, context) tuples
+        """
+        results = {}
+        delete = [isinstance(k, tuple) and k or (k, None) for k in keys]
+        for chunk in _chunks(delete, self.batch_size):
+            for r in self.batch(delete=chunk)["delete"]:
+                results[r.key] = r
+        return results
+
+
+    def scan(self, prefix=None, start=None, end=None, values=True, r=None, page_size=None):
+        """
+        Yields a L{Result} for each key that starts with prefix, or from
+        start up to end, in order. The keys are fetched page_size at a time
+        (L{batch_size} by default).
+
+        @param values: If the values are fetched, or only the keys and contexts
+        @param r: How many replicas of each partition to read, 1 by default
+        """
+        query = {"limit": page_size or self.batch_size}
+        for name, value in (("prefix", prefix), ("start", start), ("end", end), ("r", r)):
+            if value is not None:
+                query[name] = value
+        if not values:
+            query["values"] = 0
+        while True:
+            page = json.loads(self._get(query))
+            for item in page["items"]:
+                yield _result(dict(item, status=200))
+            if "continuation" not in page:
+                break
+            query["continuation"] = page["continuation"]
+
+
+class TestClient(unittest.TestCase):
+    class Client(Client):
+        batch_size = 2
+        def __init__(self):
+            Client.__init__(self, "localhost:8080")
+            self.bodies = []
+
+        def _post(self, body):
+            self.bodies.append(json.loads(body))
+            body = json.loads(body)
+            response = {}
+            response["get"] = [{"key": k, "status": 200, "context": "c", "values": [base64.b64encode("v" + k)]}
+                               for k in body.get("get", [])]
+            response["put"] = [{"key": op["key"], "status": 200} for op in body.get("put", [])]
+            response["delete"] = [{"key": op["key"], "status": 503} for op in body.get("delete", [])]
+            return json.dumps(response)
+
+        def _get(self, query):
+            self.bodies.append(dict(query))
+            keys = ["a", "b", "c"]
+            if "continuation" in query:
+                keys = keys[keys.index(query["continuation"]) + 1:]
+            keys = keys[:query["limit"]]
+            page = {"items": [{"key": k, "context": "c", "values": [base64.b64encode("v" + k)]} for k in keys]}
+            if len(keys) == query["limit"]:
+                page["continuation"] = keys[-1]
+            return json.dumps(page)
+
+    def test_encode(self):
+        body = json.loads(encode_batch(["a"], [("b", "\x00\xff", None), ("c", "", "ctx")], [("d", "ctx")]))
+        self.assertEqual(body["get"], ["a"])
+        self.assertEqual(body["put"], [{"key": "b", "value": base64.b64encode("\x00\xff")},
+                                       {"key": "c", "value": "", "context": "ctx"}])
+        self.assertEqual(body["delete"], [{"key": "d", "context": "ctx"}])
+
+    def test_decode(self):
+        data = json.dumps({"get": [{"key": "a", "status": 300, "context": "ctx",
+                                    "values": [base64.b64encode("1"), None]},
+                                   {"key": "b", "status": 404},
+                                   {"key": "c", "status": 200, "values": [""]}]})
+        results = decode_results(data)
+        a, b, c = results["get"]
+        self.assertEqual((a.key, a.status, a.context, a.values, a.value), ("a", 300, "ctx", ["1", None], None))
+        self.assertTrue(a.ok)
+        self.assertFalse(b.ok)
+        self.assertEqual(b.values, [])
+        self.assertEqual(c.value, "")
+        self.assertEqual(results["put"], [])
+
+    def test_chunks(self):
+        c = self.Client()
+        results = c.multi_get(["a", "b", "c"])
+        self.assertEqual(len(c.bodies), 2)
+        self.assertEqual(results["c"].value, "vc")
+        results = c.multi_put({"a": "1", "b": "2", "c": "3"})
+        self.assertEqual(sorted(results.keys()), ["a", "b", "c"])
+        results = c.multi_delete(["a", ("b", "ctx")])
+        self.assertEqual(c.bodies[-1]["delete"], [{"key": "a"}, {"key": "b", "context": "ctx"}])
+        self.assertEqual(results["b"].status, 503)
+
+    def test_scan(self):
+        c = self.Client()
+        results = list(c.scan(prefix="", r=2))
+        self.assertEqual([(r.key, r.value, r.context) for r in results], [("a", "va", "c"), ("b", "vb", "c"),
+                                                                            ("c", "vc", "c")])
+        self.assertEqual(c.bodies[0], {"prefix": "", "r": 2, "limit": 2})
+        self.assertEqual(c.bodies[-1]["continuation"], "b")
+        self.assertEqual(len(c.bodies), 2)
+
+if __name__=="__main__":
+    unittest.main()
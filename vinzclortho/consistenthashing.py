@@ -59,6 +59,82 @@ class Ring(object):
         self._partition_set = set(range(partitions))
         self._wanted_N = N
         self.N = len(self.nodes)
+        self._preflists = None
+
+    def __getstate__(self):
+        # The preference list table is derived data, don't gossip it
+        state = dict(self.__dict__)
+        state["_preflists"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._preflists = None
+
+    def _invalidate(self):
+        """Must be called whenever the partition ownership or N changes"""
+        self._preflists = None
+
+    def _build_preflists(self):
+        """
+        Builds a table with one (preferred, fallbacks) tuple per partition.
+        The preferred nodes are the owners of the N partitions starting at
+        the partition, the fallbacks are up to N other distinct nodes found
+        by continuing clockwise.
+        """
+        sz = self.num_partitions
+        N = self.N
+        K = 2 * N
+        # Work on node indices, comparing Nodes is slow
+        nodes = []
+        index = {}
+        owners = []
+        for n in self.partitions:
+            i = index.get(id(n))
+            if i is None:
+                i = index[id(n)] = len(nodes)
+                nodes.append(n)
+            owners.append(i)
+        # Distinct nodes met when walking clockwise from each partition,
+        # capped at K. Built backwards, the second lap fixes the wrap-around.
+        distinct = [None] * sz
+        following = ()
+        for lap in range(2):
+            for p in range(sz - 1, -1, -1):
+                i = owners[p]
+                if i in following:
+                    following = (i,) + tuple([i_ for i_ in following if i_ != i])
+                else:
+                    following = ((i,) + following)[:K]
+                distinct[p] = following
+        # Identical entries are shared to keep the table compact
+        interned = {}
+        table = []
+        wrapped = owners + owners[:N]
+        for p in range(sz):
+            preferred = tuple(wrapped[p:p + N])
+            fallbacks = tuple([i for i in distinct[(p + N) % sz]
+                               if i not in preferred][:N])
+            entry = interned.get((preferred, fallbacks))
+            if entry is None:
+                entry = (tuple([nodes[i] for i in preferred]),
+                         tuple([nodes[i] for i in fallbacks]))
+                interned[(preferred, fallbacks)] = entry
+            table.append(entry)
+        return table
+
+    def preference_list(self, partition, n=None):
+        """
+        Returns tuple of (preferred, fallbacks) for a partition. If n is
+        given and less than N, only the first n of the N preferred nodes are
+        preferred, and the others come first among the fallbacks.
+        """
+        if self._preflists is None:
+            self._preflists = self._build_preflists()
+        preferred, fallbacks = self._preflists[partition % self.num_partitions]
+        if n is None or n >= len(preferred):
+            return preferred, fallbacks
+        return preferred[:n], preferred[n:] + fallbacks
 
     def _walk_cw(self, start):
         """A generator that iterates all partitions, starting at the partition provided"""
@@ -120,9 +196,11 @@ class Ring(object):
         n2.claim.sort()
         self.partitions[p2] = n1
         self.partitions[p1] = n2
+        self._invalidate()
 
     def fix_constraint(self):
         # Check that replicas are on separate nodes
+        self._invalidate()
         for p in range(self.num_partitions):
             node = self.partitions[p]
             rep = [self.partitions[p_] for p_ in self._replicated_in(p)]
@@ -154,6 +232,7 @@ class Ring(object):
         by stealing/giving partitions at random
         """
         log.info("Updating node %s with claim %s (%s) of %s. Force=%s", node, claim, (self.num_partitions // len(self.nodes)), self.num_partitions, force)
+        self._invalidate()
         node.wanted = claim
         claim = claim or (self.num_partitions // len(self.nodes))
         unwanted = self.unwanted(node.claim)
@@ -197,6 +276,7 @@ class Ring(object):
         self.nodes.append(node)
         log.info("Node %s added, ring now has %d nodes.", node, len(self.nodes))
         self.N = min(len(self.nodes), self._wanted_N)
+        self._invalidate()
         self.update_node(node, claim)
         if not self.ok():
             self.fix_constraint()
@@ -206,6 +286,7 @@ class Ring(object):
         del self.nodes[self.nodes.index(node)]
         log.info("Node %s added, ring now has %d nodes.", node, len(self.nodes))
         self.N = min(len(self.nodes), self._wanted_N)
+        self._invalidate()
         if not self.ok():
             self.fix_constraint()
 
@@ -216,10 +297,12 @@ class Ring(object):
     def partition_to_node(self, partition):
         return self.partitions[partition]
 
-    def preferred(self, key):
-        """Returns tuple of (preferred, fallbacks)"""
-        cwnodelist = [self.partitions[p] for p in self._walk_cw(self.key_to_partition(key))]
-        return cwnodelist[:self.N], cwnodelist[self.N:]
+    def preferred(self, key, n=None):
+        """
+        Returns tuple of (preferred, fallbacks), see L{preference_list}. The
+        tuples are shared between calls, so don't modify them.
+        """
+        return self.preference_list(self.key_to_partition(key), n)
 
 class TestConsistentHashing(unittest.TestCase):
     def test_new(self):
@@ -286,6 +369,35 @@ class TestConsistentHashing(unittest.TestCase):
         preferred, fallbacks = r.preferred("foo")
         self.assertEqual(len(preferred), 3)
         self.assertTrue(p in preferred[0].claim)
+        # Fewer replicas, the others are fallbacks
+        self.assertEqual(r.preferred("foo", 3), (preferred, fallbacks))
+        self.assertEqual(r.preferred("foo", 5), (preferred, fallbacks))
+        self.assertEqual(r.preferred("foo", 1), (preferred[:1], preferred[1:] + fallbacks))
+
+    def test_preferred_table(self):
+        n = Node("localhost", 8080)
+        r = Ring(64, n, 3)
+        for i in range(8):
+            r.add_node(Node("node_%d"%i, 8080))
+        for p in range(64):
+            cwnodelist = [r.partitions[p_] for p_ in r._walk_cw(p)]
+            preferred, fallbacks = r.preference_list(p)
+            self.assertEqual(list(preferred), cwnodelist[:3])
+            distinct = []
+            for n_ in cwnodelist[3:]:
+                if n_ not in preferred and n_ not in distinct:
+                    distinct.append(n_)
+            self.assertEqual(list(fallbacks), distinct[:3])
+
+    def test_preferred_table_rebuilt(self):
+        n = Node("localhost", 8080)
+        r = Ring(64, n, 3)
+        self.assertEqual(len(r.preferred("foo")[0]), 1)
+        r.add_node(Node("node_1", 8080))
+        r.add_node(Node("node_2", 8080))
+        preferred, fallbacks = r.preferred("foo")
+        self.assertEqual(len(preferred), 3)
+        self.assertTrue(r.key_to_partition("foo") in preferred[0].claim)
 
     def test_replicated(self):
         n = Node("localhost", 8080)
@@ -4,19 +4,36 @@
 # See LICENSE for details.
 
 import functools
+import heapq
+import itertools
 import cPickle as pickle
-import base64
 import bz2
+import base64
+import json
 import optparse
 import random
 import platform
 import collections
 import sys
+import time
+import glob
+import os
+import urlparse
+import urllib
+import multiprocessing
+import shutil
+import tempfile
+import unittest
 import store
 import tangled.core as tc
 import tangled.client
 import tangled.server as ts
 import vectorclock
+import envelope
+import merkle
+import background
+import cache
+import latency
 import consistenthashing as chash
 
 import logging
@@ -25,68 +42,500 @@ log = logging.getLogger("vinzclortho.core")
 class InvalidContext(Exception):
     pass
 
+class DeadlineExceeded(Exception):
+    pass
+
+def _before_deadline(deadline, func):
+    """Calls func, unless the deadline has passed already"""
+    if time.time() > deadline:
+        raise DeadlineExceeded
+    return func()
+
+def _cancel_timer(timer, result):
+    """A callback/errback that cancels a timer that isn't needed anymore"""
+    timer.cancel()
+    return result
+
+def encode(vc, value):
+    """Encodes a vector clock and a value the way they are kept in the stores"""
+    return envelope.encode(vc, value)
+
+def decode(blob):
+    """Decodes a value encoded by L{encode} into a (vectorclock, value) tuple"""
+    return envelope.decode(blob)
+
+def digest(blob):
+    """Returns the digest of a value encoded by L{encode}, see L{envelope.digest}"""
+    return envelope.digest(blob)
+
+def resolve_encoded(a, b):
+    """A resolver for L{store.Store.multi_put} that works on encoded values"""
+    return encode(*vectorclock.resolve_list_extend([decode(a), decode(b)]))
+
+def _merge_kvlists(kvlists):
+    values = {}
+    for kvlist in kvlists:
+        values.update(kvlist)
+    return values
+
+def _first_batch(store_, threshold):
+    kvlist, iterator = store_.iterate(store_.get_iterator(), threshold)
+    return kvlist
+
+def worker_pool_size(persistent, store_type):
+    """
+    Returns a suitable number of threads for the workers. Python threads
+    only run in parallel while they wait for I/O, so stores that wait for
+    the disk get more of them.
+    """
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 2
+    if not persistent:
+        return cpus
+    if store_type == "log":
+        # Reads are mostly served from the page cache
+        return 2 * cpus
+    return min(64, 4 * cpus)
+
+def _timeout_header(request):
+    """Returns the deadline given by the X-VinzClortho-Timeout header (in ms), or None"""
+    try:
+        return time.time() + float(request.headers["X-VinzClortho-Timeout"]) / 1000
+    except (KeyError, ValueError):
+        return None
+
+def _deadline(request, timeout):
+    """Returns the deadline of a client request, given by the X-VinzClortho-Timeout header or timeout seconds from now"""
+    deadline = _timeout_header(request)
+    if deadline is None:
+        deadline = time.time() + timeout
+    return deadline
+
+def _quorum_overrides(request):
+    """
+    Returns the (R, W) asked for by a client request, with the r and w query
+    parameters or the X-VinzClortho-R and X-VinzClortho-W headers. They are
+    None if not given.
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(request.path).query)
+    values = []
+    for name in ("r", "w"):
+        value = query.get(name, [None])[0]
+        if value is None:
+            value = request.headers.get("X-VinzClortho-" + name.upper())
+        if value is not None:
+            value = int(value)
+        values.append(value)
+    return tuple(values)
+
+def _copy_response(response):
+    """Returns a copy of response, for another request (the server adds headers to it)"""
+    return ts.Response(response.code, dict(response.headers), response.data)
+
+def _prefix_end(prefix):
+    """Returns the smallest key after all the keys that start with prefix, None if there is none"""
+    prefix = prefix.rstrip("\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _merge_sorted(kvlists, limit):
+    """Merges sorted key/value lists with different keys into one, of at most limit items"""
+    return list(itertools.islice(heapq.merge(*kvlists), limit))
+
+def _client_id(request):
+    """Returns the X-VinzClortho-ClientId header, or the address of the client if it isn't given"""
+    try:
+        return request.headers["X-VinzClortho-ClientId"]
+    except KeyError:
+        return request.client_address
+
+
+READ_MODES = ("all", "adaptive")
+"""
+How reads are sent to the replicas: to all of them at once, or to the R
+fastest first (see L{StoreHandler})
+"""
+
+class Quorum(object):
+    """
+    The number of replicas of a key (N), and how many of them must answer a
+    read (R) or acknowledge a write (W) before the client gets its response.
+
+    @raise ValueError: Unless 1 <= R <= N and 1 <= W <= N
+    """
+    def __init__(self, n, r, w):
+        if not (1 <= r <= n and 1 <= w <= n):
+            raise ValueError("R and W must be between 1 and N (N=%d, R=%d, W=%d)"%(n, r, w))
+        self.n = n
+        self.r = r
+        self.w = w
+
+    def __str__(self):
+        return "N=%d,R=%d,W=%d"%(self.n, self.r, self.w)
+
+    def override(self, r=None, w=None):
+        """Returns a Quorum with the same N, and r and w instead of R and W if given"""
+        if r is None:
+            r = self.r
+        if w is None:
+            w = self.w
+        return Quorum(self.n, r, w)
+
+def parse_quorum(spec):
+    """
+    Parses [PREFIX=]N,R,W into a (prefix, L{Quorum}) tuple, the prefix is
+    None if not given
+
+    @raise ValueError: If spec isn't valid
+    """
+    prefix = None
+    if "=" in spec:
+        prefix, spec = spec.rsplit("=", 1)
+    n, r, w = [int(v) for v in spec.split(",")]
+    return prefix, Quorum(n, r, w)
+
+
+class SingleFlight(object):
+    """
+    Merges concurrent calls for the same key: the calls made while the
+    first one is in flight wait for it, and get its result too.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.merged = 0
+        self._waiting = {}
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def call(self, key, func, copy=tc.passthru):
+        """
+        Returns a Deferred with the result of func(), or of the call for key in flight
+
+        @param func: Returns a Deferred
+        @param copy: Returns the copy of the result to give to each caller
+        """
+        d = tc.Deferred()
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            self.merged = self.merged + 1
+            waiting.append(d)
+            return d
+        self.calls = self.calls + 1
+        waiting = [d]
+        self._waiting[key] = waiting
+        func().add_both(functools.partial(self._done, key, waiting, copy))
+        return d
+
+    def forget(self, key):
+        """The calls for key made from now on don't wait for the one in flight"""
+        self._waiting.pop(key, None)
+
+    def _done(self, key, waiting, copy, result):
+        if self._waiting.get(key) is waiting:
+            del self._waiting[key]
+        for d in waiting:
+            if isinstance(result, tc.Failure):
+                d.errback(result)
+            else:
+                d.callback(copy(result))
+
+    def stats(self):
+        return {"calls": self.calls, "merged": self.merged, "in_flight": len(self._waiting)}
+
+
+class RepairQueue(object):
+    """
+    Debounces the read-repair writes. Writes are sent L{delay} seconds
+    after they are queued, and writes of the same key to the same replica
+    in the meantime are merged into one. A write that is the same as the
+    one being sent is dropped.
+
+    @param scheduler: Throttles the writes, they are background work
+    @type scheduler: L{background.BackgroundScheduler}
+    """
+    delay = 0.05
+    def __init__(self, reactor, scheduler):
+        self.reactor = reactor
+        self.scheduler = scheduler
+        self.repairs = 0
+        self.merged = 0
+        self._pending = {}
+        self._sending = {}
+        self._timer = None
+
+    def _id(self, key, replica):
+        # The remote storages are created for each request
+        return key, getattr(replica, "address", replica)
+
+    def add(self, key, replica, blob):
+        """Queues a write of blob (see L{encode}) to replica"""
+        id_ = self._id(key, replica)
+        if self._sending.get(id_) == blob:
+            self.merged = self.merged + 1
+            return
+        pending = self._pending.get(id_)
+        if pending is not None:
+            self.merged = self.merged + 1
+            if pending[2] != blob:
+                pending[2] = resolve_encoded(pending[2], blob)
+            return
+        self._pending[id_] = [key, replica, blob]
+        if self._timer is None:
+            self._timer = self.reactor.call_later(self._flush, self.delay)
+
+    def _flush(self):
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        for id_, (key, replica, blob) in pending.items():
+            self.repairs = self.repairs + 1
+            self._sending[id_] = blob
+            d = self.scheduler.throttle(len(blob))
+            d.add_callback(lambda nbytes, key=key, replica=replica, blob=blob: replica.put(key, blob))
+            d.add_both(functools.partial(self._sent, id_, blob))
+
+    def _sent(self, id_, blob, result):
+        if self._sending.get(id_) is blob:
+            del self._sending[id_]
+        if isinstance(result, tc.Failure):
+            log.info("Read-repair of %s failed: %s", id_, result)
+
+    def stats(self):
+        return {"repairs": self.repairs, "merged": self.merged, "pending": len(self._pending)}
+
 
 class LocalStorage(object):
     """
     A wrapper that makes calls to a L{store.Store} be executed by a worker, and return L{tangled.core.Deferred}'s
+
+    @param durability: One of L{store.DURABILITY_MODES}. With L{store.GROUP}, writes are
+    acknowledged when the sync of their batch is done. With L{store.BUFFERED}, writes are
+    acknowledged immediately, and synced within L{buffered_sync_interval} seconds.
+    @param store_type: One of L{store.STORE_TYPES}, used if persistent
     """
-    def __init__(self, worker, name, partition, persistent):
+    buffered_sync_interval = 1.0
+    region_size = 65536
+    """Values at least this large are sent straight from the files of the stores that keep them in files"""
+    def __init__(self, worker, name, partition, persistent, durability=store.SYNC, store_type="bdb"):
         self.worker = worker
         self.name = name
         self.partition = partition
+        self.durability = durability
+        self._group = None
+        self._group_timer = None
+        # Built when first needed, and then kept up to date by the writes (in the worker)
+        self._merkle = None
         if persistent:
-            self._store = store.BerkeleyDBStore("vc_store_" + name + ".db")
+            self._store = store.create(store_type, name, durability)
+            if durability == store.GROUP:
+                self._group = store.GroupCommit()
+            elif durability == store.BUFFERED:
+                self._group = store.GroupCommit(self.buffered_sync_interval, sys.maxint)
         else:
             self._store = store.DictStore()
 
     def __str__(self):
         return "LocalStorage(%s)"%self.name
 
-    def get(self, key):
-        return self.worker.defer(functools.partial(self._store.get, key))
+    def _defer(self, func, deadline, priority=tc.FOREGROUND):
+        if deadline is not None:
+            # Don't bother if the requester has given up already
+            func = functools.partial(_before_deadline, deadline, func)
+        return self.worker.defer(func, priority)
 
-    def put(self, key, value):
-        return self.worker.defer(functools.partial(self._store.put, key, value))
+    def _write(self, func, deadline=None, priority=tc.FOREGROUND):
+        d = self._defer(func, deadline, priority)
+        if self._group is not None:
+            d.add_callback(self._group_wait)
+        return d
 
-    def multi_put(self, kvlist, resolver):
-        return self.worker.defer(functools.partial(self._store.multi_put, kvlist, resolver))
+    def _group_wait(self, result):
+        """Adds a completed write to the open batch, and waits for the sync unless buffered"""
+        waiter = None
+        if self.durability == store.GROUP:
+            waiter = tc.Deferred()
+        if self._group.add((waiter, result)):
+            self._group_timer = self.worker.reactor.call_later(functools.partial(self._group_timeout,
+                                                                                 self._group.batch),
+                                                               self._group.window)
+        if self._group.full():
+            self._group_sync()
+        return waiter or result
+
+    def _group_timeout(self, batch):
+        # The batch may have been synced already because it was full
+        if batch == self._group.batch:
+            self._group_sync()
+
+    def _group_sync(self):
+        if self._group_timer is not None:
+            # Not needed if the batch was synced because it was full
+            self._group_timer.cancel()
+            self._group_timer = None
+        pending = self._group.take()
+        # The writes in the batch are done, and the worker executes in order
+        d = self.worker.defer(self._store.sync)
+        d.add_both(functools.partial(self._group_synced, pending))
+
+    def _group_synced(self, pending, result):
+        for waiter, value in pending:
+            if waiter is None:
+                continue
+            if isinstance(result, tc.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(value)
+
+    def merge(self):
+        """Lets the store reclaim space, see L{store.Store.merge}"""
+        return self.worker.defer(self._store.merge, tc.BACKGROUND)
+
+    # These are executed by the worker
+
+    def _tree(self):
+        if self._merkle is None:
+            tree = merkle.MerkleTree()
+            iterator = self._store.get_iterator()
+            while True:
+                kvlist, iterator = self._store.iterate(iterator, 1048576)
+                if not kvlist:
+                    break
+                for k, v in kvlist:
+                    tree.update(k, v)
+            self._merkle = tree
+        return self._merkle
+
+    def _refresh_tree(self, keys):
+        if self._merkle is None:
+            return
+        for k in keys:
+            try:
+                self._merkle.update(k, self._store.get(k))
+            except KeyError:
+                self._merkle.remove(k)
+
+    def _tracked_put(self, key, value):
+        self._store.put(key, value)
+        if self._merkle is not None:
+            self._merkle.update(key, value)
+
+    def _tracked_delete(self, key):
+        self._store.delete(key)
+        if self._merkle is not None:
+            self._merkle.remove(key)
+
+    def _tracked_multi_put(self, kvlist, resolver):
+        self._store.multi_put(kvlist, resolver)
+        self._refresh_tree([k for k, v in kvlist])
+
+    def _tracked_delete_unchanged(self, kvlist):
+        deleted = self._store.delete_unchanged(kvlist)
+        self._refresh_tree([k for k, v in kvlist])
+        return deleted
+
+    def _merkle_level(self, level, nodes):
+        return self._tree().level(level, nodes)
+
+    def _merkle_items(self, buckets):
+        kvlist = []
+        for k in self._tree().keys(buckets):
+            try:
+                kvlist.append((k, str(self._store.get(k))))
+            except KeyError:
+                pass
+        return kvlist
 
-    def delete(self, key):
-        return self.worker.defer(functools.partial(self._store.delete, key))
+    def merkle_level(self, level, nodes=None):
+        """Returns a Deferred with the digests of the nodes of a level of the partition's L{merkle.MerkleTree}"""
+        return self.worker.defer(functools.partial(self._merkle_level, level, nodes), tc.BACKGROUND)
 
-    def _iterate_result(self, first, threshold, callback, result):
-        kvlist, iterator = result
-        if kvlist:
-            callback(kvlist)
-            d = self.worker.defer(functools.partial(self._store.iterate, iterator, threshold))
-            d.add_callbacks(functools.partial(self._iterate_result, False, threshold, callback), self._iterate_error)
-        else:
-            if first:
-                callback(kvlist)
+    def merkle_items(self, buckets):
+        """Returns a Deferred with the key/val tuples in the buckets (leaves) of the partition's Merkle tree"""
+        return self.worker.defer(functools.partial(self._merkle_items, buckets), tc.BACKGROUND)
 
-    def _iterate_error(self, failure):
-        failure.raise_exception()
+    def get(self, key, deadline=None):
+        return self._defer(functools.partial(self._store.get, key), deadline)
+
+    def _get_digest(self, key):
+        return digest(self._store.get(key))
 
-    def _iterator_ready(self, threshold, callback, iterator):
-        d = self.worker.defer(functools.partial(self._store.iterate, iterator, threshold))
-        d.add_callbacks(functools.partial(self._iterate_result, True, threshold, callback), self._iterate_error)
+    def _get_region(self, key):
+        region = self._store.get_file_region(key, self.region_size)
+        if region is None:
+            return self._store.get(key)
+        return ts.FileRegion(*region)
 
-    def get_all(self, threshold, callback):
-        """This will call callback multiple times with a list of key/val tuples.
-        The callback will be called whenever threshold bytes is accumulated
-        (and also when all key/val tuples have been gathered). If the storage
-        is empty, the callback will be called with an empty list.
+    def get_region(self, key, deadline=None):
+        """
+        Returns a Deferred with the value of key, or with a L{ts.FileRegion}
+        of it if it's large and the store keeps it in a file, to respond with
+        """
+        return self._defer(functools.partial(self._get_region, key), deadline)
 
-        This does *not* return a Deferred!
+    def _scan(self, start, inclusive, end, limit, digests):
+        kvlist = self._store.scan(start, end, limit, inclusive)
+        if digests:
+            return [(k, digest(v)) for k, v in kvlist]
+        return kvlist
+
+    def scan(self, start, inclusive, end, limit, digests=False, deadline=None):
         """
-        d = self.worker.defer(self._store.get_iterator)
-        d.add_callbacks(functools.partial(self._iterator_ready, threshold, callback), self._iterate_error)
+        Returns a Deferred with the key/val tuples of the keys from start up
+        to end, in order, see L{store.Store.scan}
+
+        @param digests: Return the digests of the values instead (see L{digest})
+        """
+        return self._defer(functools.partial(self._scan, start, inclusive, end, limit, digests), deadline)
+
+    def get_digest(self, key, deadline=None):
+        """Returns a Deferred with the digest of the value of key, see L{digest}"""
+        return self._defer(functools.partial(self._get_digest, key), deadline)
+
+    def multi_get(self, keys, deadline=None):
+        """Returns a Deferred with the key/val tuples of the keys that were found, see L{store.Store.multi_get}"""
+        return self._defer(functools.partial(self._store.multi_get, keys), deadline)
+
+    def put(self, key, value, deadline=None):
+        return self._write(functools.partial(self._tracked_put, key, value), deadline)
+
+    def multi_put(self, kvlist, resolver, deadline=None, priority=tc.FOREGROUND):
+        return self._write(functools.partial(self._tracked_multi_put, kvlist, resolver), deadline, priority)
+
+    def delete_unchanged(self, kvlist):
+        return self._write(functools.partial(self._tracked_delete_unchanged, kvlist), None, tc.BACKGROUND)
+
+    def get_batch(self, threshold):
+        """Returns a Deferred that is called back with about threshold bytes worth of key/val tuples"""
+        return self.worker.defer(functools.partial(_first_batch, self._store, threshold), tc.BACKGROUND)
+
+    def delete(self, key, deadline=None):
+        return self._write(functools.partial(self._tracked_delete, key), deadline)
+
+    def get_iterator(self, start=None, ordered=False):
+        """Returns a Deferred with an iterator for L{iterate}, see L{store.Store.get_iterator}"""
+        return self.worker.defer(functools.partial(self._store.get_iterator, start, ordered), tc.BACKGROUND)
+
+    def iterate(self, iterator, threshold):
+        """Returns a Deferred with about threshold bytes worth of key/val tuples and the new iterator"""
+        return self.worker.defer(functools.partial(self._store.iterate, iterator, threshold), tc.BACKGROUND)
 
 
 class RemoteStorage(object):
-    """A wrapper object that makes remote stores accessible just like local ones"""
-    def __init__(self, address):
+    """
+    A wrapper object that makes remote stores accessible just like local ones
+
+    @param pool: The pool of connections to use for the requests
+    @type pool: L{tangled.client.ConnectionPool}
+    @param latency: Keeps track of the latency of the reads, if given
+    @type latency: L{latency.ReplicaLatency}
+    """
+    def __init__(self, address, pool, latency=None):
         self.address = address
+        self.pool = pool
+        self.latency = latency
 
     def __str__(self):
         return "RemoteStorage((%s, %d))"%self.address
@@ -104,27 +553,87 @@ class RemoteStorage(object):
             raise KeyError
 
 
-    def get(self, key):
+    def _request(self, path, command="GET", data="", deadline=None, headers=None):
         host, port = self.address
-        d = tangled.client.request("http://%s:%d/_localstore/%s"%(host, port, key))
+        headers = headers or {}
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return tc.fail(DeadlineExceeded())
+            # The remote node can drop the request if it expires before it's handled
+            headers["X-VinzClortho-Timeout"] = "%d"%(timeout * 1000)
+        return self.pool.request("http://%s:%d%s"%(host, port, path), command, data, headers, timeout)
+
+    def _read(self, key, deadline, headers=None):
+        if self.latency is not None:
+            started = self.latency.start(self.address)
+        d = self._request("/_localstore/" + key, deadline=deadline, headers=headers)
         d.add_callback(self._ok_get)
+        if self.latency is not None:
+            d.add_both(functools.partial(self.latency.done, self.address, started))
         return d
 
-    def put(self, key, value):
-        host, port = self.address
-        d = tangled.client.request("http://%s:%d/_localstore/%s"%(host, port, key), "PUT", value)
+    def get(self, key, deadline=None):
+        return self._read(key, deadline)
+
+    def get_digest(self, key, deadline=None):
+        """Returns a Deferred with the digest of the value of key, see L{digest}"""
+        return self._read(key, deadline, {"X-VinzClortho-Digest": "1"})
+
+    def put(self, key, value, deadline=None):
+        d = self._request("/_localstore/" + key, "PUT", value, deadline)
         d.add_callback(self._ok)
         return d
 
-    def delete(self, key):
-        host, port = self.address
-        d = tangled.client.request("http://%s:%d/_localstore/%s"%(host, port, key), "DELETE")
+    def delete(self, key, deadline=None):
+        d = self._request("/_localstore/" + key, "DELETE", deadline=deadline)
+        d.add_callback(self._ok)
+        return d
+
+    def _ok_multi(self, result):
+        if result.status == 200:
+            return pickle.loads(result.data)
+        else:
+            raise KeyError
+
+    def _multi(self, command, items, deadline):
+        d = self._request("/_localstore", "POST", pickle.dumps((command, items), pickle.HIGHEST_PROTOCOL), deadline)
+        d.add_callback(self._ok_multi)
+        return d
+
+    def multi_get(self, keys, deadline=None):
+        """Returns a Deferred with a dict of the values of the keys that the remote node has"""
+        return self._multi("get", keys, deadline)
+
+    def multi_put(self, kvlist, deadline=None):
+        """Puts the key/val tuples on the remote node, with one request"""
+        return self._multi("put", kvlist, deadline)
+
+    def scan(self, partitions, start, inclusive, end, limit, digests=False, deadline=None):
+        """Scans the partitions on the remote node, see L{VinzClortho.local_scan}"""
+        return self._multi("scan", (partitions, start, inclusive, end, limit, digests), deadline)
+
+    def put_hint(self, owner, key, value, deadline=None):
+        """
+        Stores the value on the remote node on behalf of owner, until owner can be reached
+
+        @param owner: The address of the node that the value is intended for
+        @type owner: tuple of (host, port)
+        """
+        d = self._request("/_hint/" + key, "PUT", value, deadline,
+                          {"X-VinzClortho-Owner": "%s:%d"%owner})
         d.add_callback(self._ok)
         return d
 
 
 class LocalStoreHandler(object):
-    """The request handler for requests to /_localstore/somekey"""
+    """
+    The request handler for requests to /_localstore/somekey. A GET with
+    the X-VinzClortho-Digest header returns the digest of the value, large
+    values are sent from the storage files (see L{LocalStorage.get_region}).
+    """
+    reusable = True
     def __init__(self, context):
         self.parent = context
 
@@ -134,24 +643,127 @@ class LocalStoreHandler(object):
     def _ok(self, result):
         return ts.Response(200)
 
-    def _error(self, result):
+    def _error(self, failure):
+        if failure.check(DeadlineExceeded):
+            return ts.Response(503)
         return ts.Response(404)
 
     def do_GET(self, request):
         key = request.groups[0]
-        d = self.parent.local_get(key)
+        deadline = _timeout_header(request)
+        if deadline is not None and deadline <= time.time():
+            return tc.succeed(ts.Response(503))
+        if request.headers.get("X-VinzClortho-Digest"):
+            d = self.parent.local_get_digest(key, deadline)
+        else:
+            d = self.parent.local_get_region(key, deadline)
         d.add_callbacks(self._ok_get, self._error)
         return d
 
     def do_PUT(self, request):
         key = request.groups[0]
-        d = self.parent.local_put(key, request.data)
+        deadline = _timeout_header(request)
+        if deadline is not None and deadline <= time.time():
+            return tc.succeed(ts.Response(503))
+        d = self.parent.local_put(key, request.data, deadline)
         d.add_callbacks(self._ok, self._error)
         return d
 
     def do_DELETE(self, request):
         key = request.groups[0]
-        d = self.parent.local_delete(key)
+        deadline = _timeout_header(request)
+        if deadline is not None and deadline <= time.time():
+            return tc.succeed(ts.Response(503))
+        d = self.parent.local_delete(key, deadline)
+        d.add_callbacks(self._ok, self._error)
+        return d
+
+    do_PUSH = do_PUT
+
+
+class LocalBatchHandler(object):
+    """
+    The request handler for requests to /_localstore, the gets or puts of many
+    keys with one request. The body is a pickled tuple of "get" and a list of
+    keys, or "put" and a list of key/val tuples. The response to a get is a
+    pickled dict of the values of the keys that were found.
+
+    It also handles scans, where the body is "scan" and the arguments of
+    L{VinzClortho.local_scan}, and the response the pickled key/val list.
+    """
+    reusable = True
+    def __init__(self, context):
+        self.parent = context
+
+    def _ok_get(self, values):
+        # The stores may return buffers
+        values = dict([(k, str(v)) for k, v in values.items()])
+        return ts.Response(200, None, pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+
+    def _ok_put(self, result):
+        return ts.Response(200, None, pickle.dumps(None))
+
+    def _ok_scan(self, kvlist):
+        kvlist = [(k, str(v)) for k, v in kvlist]
+        return ts.Response(200, None, pickle.dumps(kvlist, pickle.HIGHEST_PROTOCOL))
+
+    def _error(self, failure):
+        if failure.check(DeadlineExceeded):
+            return ts.Response(503)
+        log.error("Batch failed: %s", failure)
+        return ts.Response(500)
+
+    def do_POST(self, request):
+        try:
+            command, items = pickle.loads(request.data)
+        except Exception:
+            return tc.succeed(ts.Response(400))
+        deadline = _timeout_header(request)
+        if deadline is not None and deadline <= time.time():
+            return tc.succeed(ts.Response(503))
+        if command == "get":
+            d = self.parent.local_multi_get(items, deadline)
+            d.add_callbacks(self._ok_get, self._error)
+        elif command == "put":
+            d = self.parent.local_multi_put(items, tc.FOREGROUND, None, deadline)
+            d.add_callbacks(self._ok_put, self._error)
+        elif command == "scan":
+            partitions, start, inclusive, end, limit, digests = items
+            d = self.parent.local_scan(partitions, start, inclusive, end, limit, digests, deadline)
+            d.add_callbacks(self._ok_scan, self._error)
+        else:
+            return tc.succeed(ts.Response(400))
+        return d
+
+
+class HintHandler(object):
+    """
+    The request handler for requests to /_hint/somekey. The value is stored on
+    behalf of the node given by the X-VinzClortho-Owner header, and is handed
+    off to it when it becomes reachable.
+    """
+    reusable = True
+    def __init__(self, context):
+        self.parent = context
+
+    def _ok(self, result):
+        return ts.Response(200)
+
+    def _error(self, failure):
+        if failure.check(DeadlineExceeded):
+            return ts.Response(503)
+        return ts.Response(500)
+
+    def do_PUT(self, request):
+        key = request.groups[0]
+        try:
+            owner = split_str_addr(request.headers["X-VinzClortho-Owner"])
+        except (KeyError, ValueError):
+            return tc.succeed(ts.Response(400))
+        deadline = _timeout_header(request)
+        if deadline is not None and deadline <= time.time():
+            return tc.succeed(ts.Response(503))
+        d = self.parent.put_hint(owner, key, request.data, deadline)
         d.add_callbacks(self._ok, self._error)
         return d
 
@@ -162,25 +774,43 @@ class StoreHandler(object):
     """
     The request handler for requests to /store/somekey. Implements the state 
     machines for quorum reads and writes. It also handles read-repair.
+
+    The client gets its response as soon as the quorum of the key (see
+    L{VinzClortho.quorum}) is reached. The requests to the other replicas
+    go on, and are used for read-repair. Concurrent GETs of a key (that
+    don't ask for an R) share one read, see L{SingleFlight}.
+
+    In the adaptive read mode, only the R fastest replicas (see
+    L{latency.ReplicaLatency}) are read from at first. The next one is read
+    from when one of them fails, and all the others if the quorum isn't
+    reached within the hedge delay. Once the client has its response, the
+    replicas that weren't read from are asked for digests of their
+    versions, and only get the value if theirs is older (read-repair).
     """
-    W = 2
-    R = 2
     def __init__(self, context):
         self.parent = context
         self.results = []
         self.failed = []
+        self.quorum = None
+        self.resolved = None
+        self.unread = []
+        self.digests = []
+        self.skipped = 0
 
     def _encode(self, vc, value):
-        return bz2.compress(pickle.dumps((vc, value)))
+        return encode(vc, value)
 
     def _decode(self, blob):
-        return pickle.loads(bz2.decompress(blob))
+        return decode(blob)
 
     def _vc_to_context(self, vc):
-        return base64.b64encode(bz2.compress(pickle.dumps(vc)))
+        return envelope.encode_context(vc)
 
     def _context_to_vc(self, context):
-        return pickle.loads(bz2.decompress(base64.b64decode(context)))
+        return envelope.decode_context(context)
+
+    def _decode_digest(self, data):
+        return envelope.decode_digest(data)
 
     def _extract(self, request):
         """This returns a tuple with the following:
@@ -189,51 +819,93 @@ class StoreHandler(object):
           vectorclock (or None if context not provided)
           client id (or address if not provided)
         """
-        try:
-            client = request.headers["X-VinzClortho-ClientId"]
-        except KeyError:
-            # Use the address as client id, if not provided
-            client = request.client_address
         try:
             vc = self._context_to_vc(request.headers["X-VinzClortho-Context"])
         except KeyError:
             vc = None
-        return request.groups[0], vc, client
+        return request.groups[0], vc, _client_id(request)
+
+    def _deadline(self, request):
+        return _deadline(request, self.parent.request_timeout)
+
+    def _request_quorum(self, key, request):
+        """Returns the quorum of key, with the R and W the request asks for (see L{_quorum_overrides})"""
+        r, w = _quorum_overrides(request)
+        return self.parent.quorum(key).override(r, w)
 
     def _resolve(self):
         return vectorclock.resolve_list_extend([result for replica, result in self.results])
 
     def _read_repair(self, result):
-        if len(self.results) + len(self.failed) == len(self.replicas):
+        if len(self.results) + len(self.failed) + len(self.digests) + self.skipped == len(self.replicas):
             resolved = self._resolve()
             if resolved is None:
                 # No replicas probably
                 return
             vc_final, value_final = resolved
+            digests = []
+            newer = []
+            for replica, vc in self.digests:
+                if vc is not None and not vc_final.descends_from(vc):
+                    newer.append(replica)
+                else:
+                    digests.append((replica, vc))
+            if newer:
+                # They have versions that weren't read, read them and start over
+                self.digests = digests
+                for replica in newer:
+                    self._read(replica)
+                return
             for replica, result in self.results:
                 vc, value = result
                 if vc_final.descends_from(vc) and not vc.descends_from(vc_final):
                     log.info("Read-repair needed for %s", replica)
-                    d = replica.put(self.key, self._encode(vc_final, value_final))
+                    self._repair(replica, self._encode(vc_final, value_final))
             for replica, result in self.failed:
                 log.info("Read-repair of failed node %s", replica)
-                d = replica.put(self.key, self._encode(vc_final, value_final))
+                self._repair(replica, self._encode(vc_final, value_final))
+            for replica, vc in self.digests:
+                if vc is None or not vc.descends_from(vc_final):
+                    log.info("Read-repair needed for %s", replica)
+                    self._repair(replica, self._encode(vc_final, value_final))
+
+    def _repair(self, replica, blob):
+        # Background work, the client has its answer already
+        self.parent.repairs.add(self.key, replica, blob)
 
     def _read_quorum_acheived(self):
-        return len(self.results) >= self.R
+        return len(self.results) >= self.quorum.r
 
     def _write_quorum_acheived(self):
-        return len(self.results) >= self.W
+        return len(self.results) >= self.quorum.w
 
     def _all_received(self):
         return len(self.results) + len(self.failed) == len(self.replicas)
 
+    def _start(self, key, deadline):
+        """Sets up the response and the deadline for the request"""
+        self.key = key
+        self.response = tc.Deferred()
+        self.deadline = deadline
+        timer = self.parent.reactor.call_later(self._deadline_passed, max(0.0, self.deadline - time.time()))
+        self.response.add_both(functools.partial(_cancel_timer, timer))
+
+    def _deadline_passed(self):
+        if not self.response.called:
+            log.info("Deadline passed for %s", self.key)
+            self._respond_error()
+
     def _respond_error(self):
         if self.response.called:
             return
-        self.response.callback(ts.Response(404))
+        if time.time() >= self.deadline:
+            self.response.callback(ts.Response(503))
+        else:
+            self.response.callback(ts.Response(404))
 
     def _respond_ok(self):
+        if self.response.called:
+            return
         self.response.callback(ts.Response(200))
 
     def _respond_get_ok(self):
@@ -245,6 +917,8 @@ class StoreHandler(object):
         code = 200
         if isinstance(value, list):
             code = 300
+        else:
+            self.resolved = resolved
         self.response.callback(ts.Response(code, {"X-VinzClortho-Context": context}, value))
 
     def _get_ok(self, replica, result):
@@ -262,20 +936,109 @@ class StoreHandler(object):
 
     def _fail(self, replica, result):
         self.failed.append((replica, result))
-        if self._all_received():
+        if self.unread and not self.response.called:
+            # Read from the next replica instead
+            self._read(self.unread.pop(0))
+        elif self._all_received():
             self._respond_error()
 
-    def do_GET(self, request):
-        self.response = tc.Deferred()
-        self.key = request.groups[0]
-        self.replicas = self.parent.get_replicas(self.key)
-        for r in self.replicas:
-            d = r.get(self.key)
-            d.add_callbacks(functools.partial(self._get_ok, r),
-                            functools.partial(self._fail, r))
+    def _read(self, replica):
+        d = replica.get(self.key, self.deadline)
+        d.add_callbacks(functools.partial(self._get_ok, replica),
+                        functools.partial(self._fail, replica))
+        d.add_both(self._read_repair)
+
+    def _hedge(self):
+        if self.response.called or not self.unread:
+            return
+        log.debug("Hedging the read of %s", self.key)
+        self.parent.latency.hedges = self.parent.latency.hedges + 1
+        unread, self.unread = self.unread, []
+        for r in unread:
+            self._read(r)
+
+    def _digest_ok(self, replica, data):
+        self.digests.append((replica, self._decode_digest(data)))
+
+    def _digest_failed(self, replica, failure):
+        self.digests.append((replica, None))
+
+    def _read_digests(self, response):
+        """Asks the replicas that weren't read from for digests, for read-repair"""
+        unread, self.unread = self.unread, []
+        deadline = time.time() + self.parent.request_timeout
+        for r in unread:
+            if self.parent.latency.overloaded(getattr(r, "address", None)):
+                # Anti-entropy will repair it if needed
+                self.skipped = self.skipped + 1
+                self._read_repair(None)
+                continue
+            self.parent.latency.digests = self.parent.latency.digests + 1
+            d = r.get_digest(self.key, deadline)
+            d.add_callbacks(functools.partial(self._digest_ok, r),
+                            functools.partial(self._digest_failed, r))
             d.add_both(self._read_repair)
+        return response
+
+    def _adaptive_get(self):
+        ranked = self.parent.latency.rank(self.replicas)
+        self.unread = ranked[self.quorum.r:]
+        timer = self.parent.reactor.call_later(self._hedge, self.parent.latency.hedge_delay())
+        self.response.add_both(functools.partial(_cancel_timer, timer))
+        self.response.add_both(self._read_digests)
+        for r in ranked[:self.quorum.r]:
+            self._read(r)
+
+    def _cached(self, cache_, token, response):
+        cache_.end(self.key, token, self.resolved)
+        return response
+
+    def get(self, key, deadline, replicas=None, quorum=None, cached=True, adaptive=None):
+        """
+        Reads key from the replicas, and resolves the versions once R of
+        them have answered
+
+        @param replicas: The storages to read from, the preferred replicas of the key if not given
+        @param quorum: The L{Quorum} to use, the one of the key if not given
+        @param cached: If the value in the cache of the node (if any) can be used
+        @param adaptive: If the R fastest replicas are read from first, the read mode of the node if not given
+        @return: A Deferred with the L{ts.Response}
+        """
+        cache_ = self.parent.cache
+        if cache_ is not None and cached:
+            hit = cache_.get(key)
+            if hit is not None:
+                vc, value = hit
+                return tc.succeed(ts.Response(200, {"X-VinzClortho-Context": self._vc_to_context(vc)}, value))
+        self._start(key, deadline)
+        if cache_ is not None:
+            self.response.add_both(functools.partial(self._cached, cache_, cache_.begin(key)))
+        self.quorum = quorum or self.parent.quorum(key)
+        self.replicas = replicas or self.parent.get_replicas(key)
+        if adaptive is None:
+            adaptive = self.parent.read_mode == "adaptive"
+        if adaptive and len(self.replicas) > self.quorum.r:
+            self._adaptive_get()
+        else:
+            for r in self.replicas:
+                self._read(r)
         return self.response
 
+    def do_GET(self, request):
+        key = request.groups[0]
+        try:
+            r, w = _quorum_overrides(request)
+            quorum = self.parent.quorum(key).override(r, w)
+        except ValueError:
+            return tc.succeed(ts.Response(400))
+        deadline = self._deadline(request)
+        if r is not None:
+            # Asking for an R means asking for the replicas to be read
+            return self.get(key, deadline, quorum=quorum, cached=False)
+        # Concurrent reads of the key share the requests to the replicas
+        return self.parent.reads.call(key, functools.partial(self.get, key, deadline, quorum=quorum),
+                                      _copy_response)
+
     def _ok(self, replica, result):
         self.results.append((replica, result))
         if self._write_quorum_acheived():
@@ -283,37 +1046,478 @@ class StoreHandler(object):
         elif self._all_received():
             self._respond_error()
 
-    def do_PUT(self, request):
-        self.response = tc.Deferred()
-        key, vc, client = self._extract(request)
-        self.replicas = self.parent.get_replicas(key)
+    def _put_failed(self, replica, value, failure):
+        """
+        Writes the value as a hint to the next fallback node, if the
+        preferred replica couldn't be reached (sloppy quorum)
+        """
+        # Only the remote replicas have an address
+        if getattr(replica, "address", None) is None or not self.fallbacks:
+            return self._fail(replica, failure)
+        fallback = self.fallbacks.pop(0)
+        log.info("Hinted handoff of %s for %s to %s", self.key, replica, fallback)
+        # A replica that doesn't answer fails at the deadline of the request,
+        # so the hint gets a budget of its own
+        d = fallback.put_hint(replica.address, self.key, value, time.time() + self.parent.request_timeout)
+        d.add_callbacks(functools.partial(self._ok, fallback),
+                        functools.partial(self._hint_failed, replica, value))
+
+    def _hint_failed(self, replica, value, failure):
+        """Tries the next fallback node, unless the hint ran out of time"""
+        if failure.check(DeadlineExceeded, tangled.client.TimeoutError):
+            return self._fail(replica, failure)
+        return self._put_failed(replica, value, failure)
+
+    def put(self, key, vc, client, value, deadline, replicas=None, quorum=None):
+        """
+        Writes a new version of key to the replicas, and answers once W of
+        them have acknowledged it
+
+        @param vc: The vector clock of the version the client has seen, or None
+        @param client: The id of the client, that the vector clock is incremented for
+        @param value: The value, None to delete
+        @param replicas: The storages to write to, the preferred replicas of the key if not given
+        @param quorum: The L{Quorum} to use, the one of the key if not given
+        @return: A Deferred with the L{ts.Response}
+        """
+        self._start(key, deadline)
+        self.quorum = quorum or self.parent.quorum(key)
+        self.parent.invalidate_cached([key])
         vc = vc or vectorclock.VectorClock()
         vc.increment(client)
-        value = self._encode(vc, request.data)
+        value = self._encode(vc, value)
+        self.replicas = replicas or self.parent.get_replicas(key)
+        self.fallbacks = self.parent.get_fallbacks(key)
         for r in self.replicas:
-            d = r.put(key, value)
+            d = r.put(key, value, self.deadline)
             d.add_callbacks(functools.partial(self._ok, r),
-                            functools.partial(self._fail, r))
+                            functools.partial(self._put_failed, r, value))
         return self.response
 
+    def do_PUT(self, request):
+        key, vc, client = self._extract(request)
+        try:
+            quorum = self._request_quorum(key, request)
+        except ValueError:
+            return tc.succeed(ts.Response(400))
+        return self.put(key, vc, client, request.data, self._deadline(request), quorum=quorum)
+
     def do_DELETE(self, request):
-        self.response = tc.Deferred()
         key, vc, client = self._extract(request)
-        self.replicas = self.parent.get_replicas(key)
-        vc = vc or vectorclock.VectorClock()
-        vc.increment(client)
-        value = self._encode(vc, None)
-        for r in self.replicas:
-            # delete is handled as a put of None
-            d = r.put(key, value)
-            d.add_callbacks(functools.partial(self._ok, r),
-                            functools.partial(self._fail, r))
-        return self.response
+        try:
+            quorum = self._request_quorum(key, request)
+        except ValueError:
+            return tc.succeed(ts.Response(400))
+        # delete is handled as a put of None
+        return self.put(key, vc, client, None, self._deadline(request), quorum=quorum)
 
     do_PUSH = do_PUT
 
+class StoreBatch(object):
+    """
+    Stands in for the replicas on one node during a batch request. The gets
+    and puts are collected until L{flush}, and then made with one call to
+    the node. Calls made after that (like read-repair) are made right away.
+
+    @param multi_get: Called with a list of keys and the deadline, returns a Deferred with a dict of the values found
+    @param multi_put: Called with a list of key/val tuples and the deadline, returns a Deferred
+    @param address: The address of the node, None for this node
+    """
+    def __init__(self, multi_get, multi_put, address=None):
+        self.address = address
+        self._multi_get = multi_get
+        self._multi_put = multi_put
+        self._gets = []
+        self._puts = []
+        self._flushed = False
+
+    def __str__(self):
+        if self.address is None:
+            return "StoreBatch(local)"
+        return "StoreBatch((%s, %d))"%self.address
+
+    def get(self, key, deadline=None):
+        d = tc.Deferred()
+        self._gets.append((key, deadline, d))
+        if self._flushed:
+            self.flush()
+        return d
+
+    def put(self, key, value, deadline=None):
+        d = tc.Deferred()
+        self._puts.append((key, value, deadline, d))
+        if self._flushed:
+            self.flush()
+        return d
+
+    def flush(self):
+        """Makes the calls collected so far"""
+        self._flushed = True
+        gets, self._gets = self._gets, []
+        puts, self._puts = self._puts, []
+        if gets:
+            # The calls of a batch have the same deadline
+            d = self._multi_get([key for key, deadline, waiter in gets], deadline=gets[0][1])
+            d.add_both(functools.partial(self._got, gets))
+        if puts:
+            d = self._multi_put([(key, value) for key, value, deadline, waiter in puts], deadline=puts[0][2])
+            d.add_both(functools.partial(self._put_done, puts))
+
+    def _got(self, gets, result):
+        for key, deadline, waiter in gets:
+            if isinstance(result, tc.Failure):
+                waiter.errback(result)
+            elif key in result:
+                waiter.callback(result[key])
+            else:
+                waiter.errback(tc.Failure(KeyError(key)))
+
+    def _put_done(self, puts, result):
+        for key, value, deadline, waiter in puts:
+            if isinstance(result, tc.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(None)
+
+class BatchHandler(object):
+    """
+    The request handler for requests to /store, that get, put and delete
+    many keys with one request. The body is a JSON object like::
+
+      {"get": ["key1", "key2"],
+       "put": [{"key": "key3", "value": "base64 of the value", "context": "..."}],
+       "delete": [{"key": "key4", "context": "..."}]}
+
+    Each key is handled by a L{StoreHandler}, so the quorums are per key.
+    The keys are grouped by the nodes of their replicas, and each node gets
+    one request for the gets and one for the puts, see L{StoreBatch}.
+    """
+    max_keys = 10000
+    def __init__(self, context):
+        self.parent = context
+        self._batches = {}
+
+    def _batch(self, node):
+        address = (node.host, node.port)
+        try:
+            return self._batches[address]
+        except KeyError:
+            if address == self.parent.address:
+                batch = StoreBatch(self.parent.local_multi_get,
+                                   functools.partial(self.parent.local_multi_put, priority=tc.FOREGROUND,
+                                                     resolver=None))
+            else:
+                remote = RemoteStorage(address, self.parent.pool)
+                batch = StoreBatch(remote.multi_get, remote.multi_put, address)
+            self._batches[address] = batch
+            return batch
+
+    def _replicas(self, key, quorum):
+        preferred, fallbacks = self.parent.ring.preferred(key, quorum.n)
+        return [self._batch(n) for n in preferred]
+
+    def _quorum(self, key, overrides):
+        """Returns the quorum of key with the R and W of the request, or None if they aren't valid for the key"""
+        try:
+            return self.parent.quorum(key).override(*overrides)
+        except ValueError:
+            return None
+
+    def _key(self, key):
+        if not isinstance(key, basestring):
+            raise ValueError("Keys must be strings")
+        return key.encode("utf-8")
+
+    def _context(self, op):
+        if op.get("context") is None:
+            return None
+        return envelope.decode_context(str(op["context"]))
+
+    def _parse(self, data):
+        """Returns lists of the keys to get, and of (key, vc, value) tuples to put and delete"""
+        body = json.loads(data)
+        if not isinstance(body, dict):
+            raise ValueError("The body must be an object")
+        gets = [self._key(k) for k in body.get("get", [])]
+        puts = [(self._key(op["key"]), self._context(op), base64.b64decode(op["value"]))
+                for op in body.get("put", [])]
+        deletes = [(self._key(op["key"]), self._context(op), None) for op in body.get("delete", [])]
+        return gets, puts, deletes
+
+    def _value(self, value):
+        if value is None:
+            # A deleted sibling
+            return None
+        return base64.b64encode(str(value))
+
+    def _get_result(self, key, response):
+        result = {"key": key, "status": response.code}
+        if "X-VinzClortho-Context" in response.headers:
+            result["context"] = response.headers["X-VinzClortho-Context"]
+        if response.code in (200, 300):
+            values = response.data
+            if not isinstance(values, list):
+                values = [values]
+            result["values"] = [self._value(v) for v in values]
+        return result
+
+    def _write_result(self, key, response):
+        return {"key": key, "status": response.code}
+
+    def _respond(self, results):
+        gets, puts, deletes = results
+        body = json.dumps({"get": gets, "put": puts, "delete": deletes})
+        return ts.Response(200, {"Content-Type": "application/json"}, body)
+
+    def do_GET(self, request):
+        return ScanHandler(self.parent).do_GET(request)
+
+    def do_POST(self, request):
+        try:
+            gets, puts, deletes = self._parse(request.data)
+        except (ValueError, TypeError, KeyError, AttributeError, envelope.InvalidEnvelope):
+            return tc.succeed(ts.Response(400))
+        if len(gets) + len(puts) + len(deletes) > self.max_keys:
+            return tc.succeed(ts.Response(413))
+        try:
+            overrides = _quorum_overrides(request)
+        except ValueError:
+            return tc.succeed(ts.Response(400))
+        deadline = _deadline(request, self.parent.request_timeout)
+        client = _client_id(request)
+        results = []
+        for key in gets:
+            quorum = self._quorum(key, overrides)
+            if quorum is None:
+                d = tc.succeed(ts.Response(400))
+            else:
+                # The batches don't do digests
+                d = StoreHandler(self.parent).get(key, deadline, self._replicas(key, quorum), quorum,
+                                                  overrides[0] is None, False)
+            d.add_callback(functools.partial(self._get_result, key))
+            results.append(d)
+        get_results = tc.gather_results(results)
+        writes = []
+        for ops in (puts, deletes):
+            results = []
+            for key, vc, value in ops:
+                quorum = self._quorum(key, overrides)
+                if quorum is None:
+                    d = tc.succeed(ts.Response(400))
+                else:
+                    d = StoreHandler(self.parent).put(key, vc, client, value, deadline,
+                                                      self._replicas(key, quorum), quorum)
+                d.add_callback(functools.partial(self._write_result, key))
+                results.append(d)
+            writes.append(tc.gather_results(results))
+        for batch in self._batches.values():
+            batch.flush()
+        d = tc.gather_results([get_results] + writes)
+        d.add_callback(self._respond)
+        return d
+
+class Scan(object):
+    """
+    One page of a scan. Each partition is read from r of its preferred
+    replicas (the next one if a replica fails), with one request to each
+    node. The sorted lists of the nodes are merged, and the versions of
+    each key resolved.
+
+    Each node returns at most limit keys, so the keys after the last one of
+    a node that returned limit keys may be missing. The page ends there,
+    and the next one starts after the last key of the page.
+    """
+    def __init__(self, parent, start, inclusive, end, limit, r, values, deadline):
+        self.parent = parent
+        self.start = start
+        self.inclusive = inclusive
+        self.end = end
+        self.limit = limit
+        self.r = r
+        self.values = values
+        self.deadline = deadline
+        self.kvlists = []
+        self.pending = 0
+        self.candidates = {}
+        self.result = tc.Deferred()
+
+    def run(self):
+        """
+        Returns a Deferred with a tuple of a list of (key, (vc, value)),
+        and the last key of the page if there may be more
+        """
+        ring = self.parent.ring
+        nodes = collections.defaultdict(list)
+        for p in range(ring.num_partitions):
+            preferred, fallbacks = ring.preference_list(p)
+            for node in preferred[:self.r]:
+                nodes[node].append(p)
+            self.candidates[p] = list(preferred[self.r:])
+        self._request_all(nodes)
+        return self.result
+
+    def _request_all(self, nodes):
+        # Not done before all the requests have been made, even if some are answered right away
+        self.pending = self.pending + 1
+        for node, partitions in nodes.items():
+            self._request(node, partitions)
+        self.pending = self.pending - 1
+        self._check_done()
+
+    def _request(self, node, partitions):
+        self.pending = self.pending + 1
+        if node.host == self.parent.host and node.port == self.parent.port:
+            d = self.parent.local_scan(partitions, self.start, self.inclusive, self.end, self.limit,
+                                       not self.values, self.deadline)
+        else:
+            storage = RemoteStorage((node.host, node.port), self.parent.pool)
+            d = storage.scan(partitions, self.start, self.inclusive, self.end, self.limit,
+                             not self.values, self.deadline)
+        d.add_callbacks(self._ok, functools.partial(self._fail, node, partitions))
+
+    def _ok(self, kvlist):
+        self.pending = self.pending - 1
+        self.kvlists.append(kvlist)
+        self._check_done()
+
+    def _fail(self, node, partitions, failure):
+        self.pending = self.pending - 1
+        log.info("Scan of %s failed: %s", node, failure)
+        nodes = collections.defaultdict(list)
+        for p in partitions:
+            if not self.candidates[p]:
+                if not self.result.called:
+                    self.result.errback(failure)
+                return
+            nodes[self.candidates[p].pop(0)].append(p)
+        self._request_all(nodes)
+
+    def _check_done(self):
+        if self.pending == 0 and not self.result.called:
+            self.result.callback(self._merge())
+
+    def _version(self, blob):
+        if self.values:
+            return decode(blob)
+        vc = envelope.decode_digest(blob)
+        if vc is None:
+            return None, None
+        return vc, ""
+
+    def _merge(self):
+        watermark = None
+        for kvlist in self.kvlists:
+            if len(kvlist) == self.limit and (watermark is None or kvlist[-1][0] < watermark):
+                watermark = kvlist[-1][0]
+        items = []
+        last = watermark
+        for key, group in itertools.groupby(heapq.merge(*self.kvlists), lambda kv: kv[0]):
+            if watermark is not None and key > watermark:
+                break
+            # Like a read, deleted versions are left out
+            versions = [version for version in [self._version(blob) for k, blob in group]
+                        if version[1] is not None]
+            if versions:
+                items.append((key, vectorclock.resolve_list(versions)))
+            if len(items) == self.limit:
+                last = key
+                break
+        return items, last
+
+
+class ScanHandler(object):
+    """
+    The request handler for scans, GET /store?prefix=... or
+    /store?start=...&end=... (see L{Scan}). Returns JSON like the batches
+    (see L{BatchHandler}), with the keys in order, and the continuation
+    token to pass to get the next page, if there may be more.
+
+    The page is streamed with the chunked transfer encoding, about
+    L{stream_size} bytes at a time, so a page of large values isn't
+    encoded into one string.
+    """
+    max_limit = 10000
+    default_limit = 1000
+    stream_size = 65536
+    def __init__(self, context):
+        self.parent = context
+
+    def _parse(self, query):
+        def get(name, default=None):
+            return query.get(name, [default])[0]
+        prefix = get("prefix")
+        start = get("start")
+        end = get("end")
+        if prefix is not None:
+            if start is not None or end is not None:
+                raise ValueError("prefix can't be combined with start or end")
+            start, end = prefix, _prefix_end(prefix)
+        limit = int(get("limit", self.default_limit))
+        r = int(get("r", 1))
+        if not (1 <= limit <= self.max_limit and 1 <= r <= self.parent.N):
+            raise ValueError("Invalid limit or r")
+        values = get("values", "1") != "0"
+        inclusive = True
+        continuation = get("continuation")
+        if continuation is not None:
+            start = base64.urlsafe_b64decode(continuation)
+            inclusive = False
+        return start, inclusive, end, limit, r, values
+
+    def _item(self, key, resolved, values):
+        vc, value = resolved
+        item = {"key": key, "context": envelope.encode_context(vc)}
+        if values:
+            if not isinstance(value, list):
+                value = [value]
+            item["values"] = [base64.b64encode(str(v)) for v in value]
+        return item
+
+    def _body(self, values, items, last):
+        """Yields the JSON of the page, the items are encoded as they are sent"""
+        parts = ['{"items": [']
+        size = 0
+        for i, (key, resolved) in enumerate(items):
+            if i:
+                parts.append(", ")
+            item = json.dumps(self._item(key, resolved, values))
+            parts.append(item)
+            size = size + len(item)
+            if size >= self.stream_size:
+                yield "".join(parts)
+                parts = []
+                size = 0
+        parts.append("]")
+        if last is not None:
+            parts.append(', "continuation": %s'%json.dumps(base64.urlsafe_b64encode(last)))
+        parts.append("}")
+        yield "".join(parts)
+
+    def _respond(self, values, result):
+        items, last = result
+        return ts.Response(200, {"Content-Type": "application/json"}, self._body(values, items, last))
+
+    def _error(self, failure):
+        if failure.check(DeadlineExceeded):
+            return ts.Response(503)
+        log.error("Scan failed: %s", failure)
+        return ts.Response(503)
+
+    def do_GET(self, request):
+        query = urlparse.parse_qs(urlparse.urlparse(request.path).query, keep_blank_values=True)
+        try:
+            start, inclusive, end, limit, r, values = self._parse(query)
+        except (ValueError, TypeError):
+            return tc.succeed(ts.Response(400))
+        deadline = _deadline(request, self.parent.request_timeout)
+        d = Scan(self.parent, start, inclusive, end, limit, r, values, deadline).run()
+        d.add_callbacks(functools.partial(self._respond, values), self._error)
+        return d
+
+
 class MetaDataHandler(object):
     """The request handler for requests to /_metadata. Used when gossiping."""
+    reusable = True
     def __init__(self, context):
         self.context = context
 
@@ -331,20 +1535,307 @@ class HandoffHandler(object):
     The request handler for requests to /_handoff. This is used to send 
     a partition to its new owner.
     """
+    reusable = True
     def __init__(self, context):
         self.context = context
 
     def _put_complete(self, result):
         return ts.Response(200, None, None)
 
+    def _put_failed(self, failure):
+        log.error("Handoff failed: %s", failure)
+        return ts.Response(500, None, None)
+
     def do_PUT(self, request):
         kvlist = pickle.loads(bz2.decompress(request.data))
         if not kvlist:
             return tc.succeed(ts.Response(200, None, None))
-        d = self.context.local_multi_put(kvlist)
-        d.add_both(self._put_complete)
+        d = self.context.local_multi_put(kvlist, tc.BACKGROUND)
+        d.add_callbacks(self._put_complete, self._put_failed)
         return d
 
+class MerkleHandler(object):
+    """
+    The request handler for requests to /_merkle/partition/level?nodes=1,2,3.
+    Returns the digests (16 bytes each) of the nodes of a level of the Merkle
+    tree of a partition, or all nodes of the level if nodes isn't given.
+    """
+    reusable = True
+    def __init__(self, context):
+        self.context = context
+
+    def _ok(self, digests):
+        return ts.Response(200, None, "".join(digests))
+
+    def _error(self, failure):
+        log.error("Merkle tree request failed: %s", failure)
+        return ts.Response(500)
+
+    def do_GET(self, request):
+        partition, level = int(request.groups[0]), int(request.groups[1])
+        storage = self.context.partition_storage(partition)
+        if storage is None or level > merkle.DEPTH:
+            return tc.succeed(ts.Response(404))
+        nodes = None
+        query = urlparse.parse_qs(urlparse.urlparse(request.path).query)
+        if "nodes" in query:
+            try:
+                nodes = [int(n) for n in query["nodes"][0].split(",") if n]
+            except ValueError:
+                return tc.succeed(ts.Response(400))
+            if [n for n in nodes if n < 0 or n >= 1 << level]:
+                return tc.succeed(ts.Response(400))
+        d = storage.merkle_level(level, nodes)
+        d.add_callbacks(self._ok, self._error)
+        return d
+
+class MerkleExchange(object):
+    """
+    Compares the Merkle tree of a partition with the one of another replica,
+    descending L{step} levels at a time into the subtrees that differ, and
+    sends the local key/values of the differing leaves to the other replica.
+    Keys that only the other replica has are sent when it does the same.
+
+    @param pool: The pool of connections to use for the requests
+    @param scheduler: Throttles the sending
+    @type scheduler: L{background.BackgroundScheduler}
+    @param replicated: Called with a key and the address of the other replica,
+    returns False if the key shouldn't be sent there (because it has fewer replicas)
+    """
+    step = 5
+    chunk_size = 1048576
+    def __init__(self, storage, partition, address, pool, timeout, scheduler, replicated=None):
+        self.storage = storage
+        self.partition = partition
+        self.address = address
+        self.pool = pool
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.replicated = replicated
+        self.result = tc.Deferred()
+        self.sent = 0
+
+    def run(self):
+        """Returns a Deferred that is called back with the number of keys sent"""
+        self._compare(0, [0])
+        return self.result
+
+    def _fail(self, failure):
+        if not self.result.called:
+            self.result.errback(failure)
+
+    def _remote_level(self, level, nodes):
+        url = "http://%s:%d/_merkle/%d/%d?nodes=%s"%(self.address + (self.partition, level, ",".join(map(str, nodes))))
+        d = self.pool.request(url, timeout=self.timeout)
+        d.add_callback(self._parse_level)
+        return d
+
+    def _parse_level(self, response):
+        if response.status != 200:
+            raise KeyError("Merkle tree not available (%s)"%response.status)
+        data = response.data
+        return [data[i:i+16] for i in range(0, len(data), 16)]
+
+    def _compare(self, level, nodes):
+        d = tc.gather_results([self.storage.merkle_level(level, nodes), self._remote_level(level, nodes)])
+        d.add_callbacks(functools.partial(self._compared, level, nodes), self._fail)
+
+    def _compared(self, level, nodes, result):
+        local, remote = result
+        nodes = merkle.differing(nodes, local, remote)
+        if not nodes:
+            self.result.callback(self.sent)
+        elif level == merkle.DEPTH:
+            d = self.storage.merkle_items(nodes)
+            d.add_callback(self._replicated)
+            d.add_callbacks(self._send, self._fail)
+        else:
+            step = min(self.step, merkle.DEPTH - level)
+            self._compare(level + step, merkle.children(nodes, step))
+
+    def _replicated(self, kvlist):
+        if self.replicated is None:
+            return kvlist
+        return [(k, v) for k, v in kvlist if self.replicated(k, self.address)]
+
+    def _send(self, kvlist):
+        if not kvlist:
+            self.result.callback(self.sent)
+            return
+        # Send about chunk_size bytes at a time
+        tot = 0
+        for i, (k, v) in enumerate(kvlist):
+            tot = tot + len(k) + len(v)
+            if tot >= self.chunk_size:
+                break
+        chunk, rest = kvlist[:i+1], kvlist[i+1:]
+        data = bz2.compress(pickle.dumps(chunk))
+        d = self.scheduler.throttle(len(data))
+        d.add_callback(functools.partial(self._request, data))
+        d.add_callbacks(functools.partial(self._sent, chunk, rest), self._fail)
+
+    def _request(self, data, nbytes):
+        url = "http://%s:%d/_handoff"%self.address
+        return self.pool.request(url, command="PUT", data=data, timeout=self.timeout)
+
+    def _sent(self, chunk, rest, response):
+        if response.status != 200:
+            return self._fail(tc.Failure(KeyError("Handoff failed (%s)"%response.status)))
+        self.sent = self.sent + len(chunk)
+        self._send(rest)
+
+class Handoff(object):
+    """
+    Streams a partition to the node that has taken it over, in chunks of
+    about L{chunk_size} bytes. At most L{window} chunks are in flight, so a
+    large partition doesn't flood the receiver. A chunk that isn't
+    acknowledged is sent again, up to L{retries} times, and after that the
+    handoff fails.
+
+    The last key of the chunks that have all been acknowledged is saved in
+    cursor_file, so that an interrupted handoff continues from there the next
+    time, also after a restart. Resending a chunk is harmless, since the receiver resolves the
+    values with the vector clocks.
+
+    @param address: The address of the receiver
+    @param pool: The pool of connections to use for the requests
+    @param scheduler: Throttles the sending
+    @type scheduler: L{background.BackgroundScheduler}
+    @param cursor_file: Where to save the position, or None
+    """
+    window = 4
+    chunk_size = 1048576
+    retries = 3
+    retry_delay = 1.0
+    def __init__(self, storage, address, pool, scheduler, timeout, cursor_file=None):
+        self.storage = storage
+        self.address = address
+        self.pool = pool
+        self.scheduler = scheduler
+        self.reactor = scheduler.reactor
+        self.timeout = timeout
+        self.cursor_file = cursor_file
+        self.result = tc.Deferred()
+        self.sent = 0
+        self._iterator = None
+        self._reading = False
+        self._exhausted = False
+        self._next_seq = 0
+        self._confirmed = -1
+        self._in_flight = {}
+        self._acked = set()
+        self._last_keys = {}
+
+    def run(self):
+        """Returns a Deferred that is called back with the number of keys sent"""
+        d = self.storage.get_iterator(self._load_cursor(), True)
+        d.add_callbacks(self._iterator_ready, self._fail)
+        return self.result
+
+    def _load_cursor(self):
+        if self.cursor_file is None:
+            return None
+        try:
+            f = open(self.cursor_file, "rb")
+            try:
+                address, key = f.read().split("\n", 1)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        if split_str_addr(address) != self.address:
+            # Another node got the partition, start over
+            return None
+        log.info("Resuming handoff of %s to %s", self.storage, self.address)
+        return key
+
+    def _save_cursor(self, key):
+        if self.cursor_file is None:
+            return
+        # Losing the cursor only means that some chunks are sent again, so no fsync
+        tmp = self.cursor_file + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            f.write("%s:%d\n"%self.address + str(key))
+        finally:
+            f.close()
+        os.rename(tmp, self.cursor_file)
+
+    def _remove_cursor(self):
+        if self.cursor_file is not None and os.path.exists(self.cursor_file):
+            os.remove(self.cursor_file)
+
+    def _fail(self, failure):
+        if not self.result.called:
+            self.result.errback(failure)
+
+    def _iterator_ready(self, iterator):
+        self._iterator = iterator
+        self._fill()
+
+    def _fill(self):
+        if self.result.called or self._reading or self._exhausted:
+            return
+        if len(self._in_flight) >= self.window:
+            return
+        self._reading = True
+        d = self.storage.iterate(self._iterator, self.chunk_size)
+        d.add_callbacks(self._chunk_read, self._fail)
+
+    def _chunk_read(self, result):
+        kvlist, self._iterator = result
+        self._reading = False
+        if not kvlist:
+            self._exhausted = True
+            self._check_done()
+            return
+        seq = self._next_seq
+        self._next_seq = seq + 1
+        self._last_keys[seq] = kvlist[-1][0]
+        self._in_flight[seq] = (len(kvlist), bz2.compress(pickle.dumps(kvlist)))
+        self._send(seq, 0)
+        self._fill()
+
+    def _send(self, seq, attempt):
+        if self.result.called:
+            return
+        count, data = self._in_flight[seq]
+        d = self.scheduler.throttle(len(data))
+        d.add_callback(functools.partial(self._request, data))
+        d.add_callbacks(functools.partial(self._chunk_acked, seq, attempt),
+                        functools.partial(self._chunk_failed, seq, attempt))
+
+    def _request(self, data, nbytes):
+        url = "http://%s:%d/_handoff"%self.address
+        return self.pool.request(url, command="PUT", data=data, timeout=self.timeout)
+
+    def _chunk_acked(self, seq, attempt, response):
+        if response.status != 200:
+            return self._chunk_failed(seq, attempt, response)
+        self.sent = self.sent + self._in_flight.pop(seq)[0]
+        self._acked.add(seq)
+        cursor = None
+        while self._confirmed + 1 in self._acked:
+            self._confirmed = self._confirmed + 1
+            self._acked.remove(self._confirmed)
+            cursor = self._last_keys.pop(self._confirmed)
+        if cursor is not None:
+            self._save_cursor(cursor)
+        self._fill()
+        self._check_done()
+
+    def _chunk_failed(self, seq, attempt, result):
+        if attempt >= self.retries:
+            self._fail(tc.Failure(IOError("Handoff of %s to %s failed: %s"%(self.storage, self.address, result))))
+            return
+        log.debug("Handoff chunk %d of %s failed, retrying: %s", seq, self.storage, result)
+        self.reactor.call_later(functools.partial(self._send, seq, attempt + 1), self.retry_delay * 2 ** attempt)
+
+    def _check_done(self):
+        if self._exhausted and not self._in_flight and not self.result.called:
+            self._remove_cursor()
+            self.result.callback(self.sent)
+
 class AdminHandler(object):
     """
     The request handler for requests to /admin. Currently, these services are available:
@@ -356,7 +1847,32 @@ class AdminHandler(object):
     /admin/balance
 
     A PUT to this will make the node try to rebalance the claim of the nodes.
+
+    /admin/pool
+
+    The counters of the pool of connections to other nodes can be read using this.
+
+    /admin/background, /admin/background/rate, /admin/background/transfers
+
+    The settings and counters of the L{background.BackgroundScheduler} can be
+    read using the first. The bytes per second and the number of partitions
+    transferred at once can be written using the others (0 means no limit).
+
+    /admin/cache
+
+    The settings and counters of the L{cache.Cache} of read values can be
+    read using this (404 if the node has no cache). A PUT clears it.
+
+    /admin/latency
+
+    The latency and load of the reads from each of the other nodes, and the
+    counters of the adaptive reads, can be read using this.
+
+    /admin/reads
+
+    The counters of the merged reads and read-repair writes can be read using this.
     """
+    reusable = True
     def __init__(self, context):
         self.context = context
 
@@ -364,6 +1880,29 @@ class AdminHandler(object):
         service = request.groups[0]
         if service == "claim":
             return tc.succeed(ts.Response(200, None, str(self.context.get_claim())))
+        elif service == "pool":
+            stats = self.context.pool.stats()
+            return tc.succeed(ts.Response(200, None, "".join(["%s: %d\n"%kv for kv in sorted(stats.items())])))
+        elif service == "background":
+            stats = self.context.background.stats()
+            return tc.succeed(ts.Response(200, None, "".join(["%s: %d\n"%kv for kv in sorted(stats.items())])))
+        elif service == "background/rate":
+            return tc.succeed(ts.Response(200, None, str(self.context.background.rate or 0)))
+        elif service == "background/transfers":
+            return tc.succeed(ts.Response(200, None, str(self.context.background.max_transfers or 0)))
+        elif service == "cache" and self.context.cache is not None:
+            stats = self.context.cache.stats()
+            return tc.succeed(ts.Response(200, None, "".join(["%s: %d\n"%kv for kv in sorted(stats.items())])))
+        elif service == "latency":
+            stats = self.context.latency.stats()
+            return tc.succeed(ts.Response(200, None, "".join(["%s: %d\n"%kv for kv in sorted(stats.items())])))
+        elif service == "reads":
+            stats = {}
+            for prefix, counters in (("gets", self.context.reads.stats()),
+                                     ("repairs", self.context.repairs.stats())):
+                for name, value in counters.items():
+                    stats[prefix + " " + name] = value
+            return tc.succeed(ts.Response(200, None, "".join(["%s: %d\n"%kv for kv in sorted(stats.items())])))
         return tc.succeed(ts.Response(404))
 
     def do_PUT(self, request):
@@ -378,6 +1917,21 @@ class AdminHandler(object):
         elif service == "balance":
             self.context.balance()
             return tc.succeed(ts.Response(200))
+        elif service in ("background/rate", "background/transfers"):
+            try:
+                value = int(request.data)
+            except ValueError:
+                return tc.succeed(ts.Response(400))
+            if value < 0:
+                return tc.succeed(ts.Response(400))
+            if service == "background/rate":
+                self.context.background.set_rate(value)
+            else:
+                self.context.background.set_max_transfers(value)
+            return tc.succeed(ts.Response(200))
+        elif service == "cache" and self.context.cache is not None:
+            self.context.cache.clear()
+            return tc.succeed(ts.Response(200))
         return tc.succeed(ts.Response(404))
 
     do_PUSH = do_PUT
@@ -389,9 +1943,45 @@ class VinzClortho(object):
     """
     gossip_interval=30.0
     N=3
+    """The number of replicas, unless set by the default quorum"""
+    R=2
+    W=2
     num_partitions=512
-    worker_pool_size=10
-    def __init__(self, addr, join, claim, partitions, logfile, persistent):
+    worker_pool_size=None
+    """The number of worker threads, None to pick one with L{worker_pool_size}"""
+    connection_pool_size=8
+    connect_timeout=1.0
+    request_timeout=10.0
+    hint_interval=10.0
+    merge_interval=300.0
+    handoff_retry_interval=30.0
+    anti_entropy_interval=30.0
+    hint_batch_size=262144
+    max_body_size=64*1024*1024
+    """The largest request body (and so value) that is accepted"""
+    spool_threshold=1024*1024
+    """Request bodies larger than this are received into temporary files"""
+    routes=[(r"/store(?:\?.*)?$", BatchHandler),
+            (r"/store/([^?]*)", StoreHandler),
+            (r"/_localstore$", LocalBatchHandler),
+            (r"/_localstore/(.*)", LocalStoreHandler),
+            (r"/_hint/(.*)", HintHandler),
+            (r"/_handoff", HandoffHandler),
+            (r"/_metadata", MetaDataHandler),
+            (r"/_merkle/(\d+)/(\d+)", MerkleHandler),
+            (r"/admin/(.*)", AdminHandler)]
+    """The request handlers of the urls, see L{ts.RouteTable}"""
+    def __init__(self, addr, join, claim, partitions, logfile, persistent, durability=store.GROUP,
+                 store_type="bdb", background_rate=None, background_transfers=2, quorums=None,
+                 cache_size=0, cache_ttl=1.0, read_mode="all"):
+        """
+        @param quorums: A list of (prefix, L{Quorum}) tuples, for the keys
+        that start with prefix. The one with the prefix None is the default,
+        and its N is the number of replicas of the ring.
+        @param cache_size: The number of keys to keep in the L{cache.Cache} of read values, 0 for no cache
+        @param cache_ttl: Seconds a cached value is used for
+        @param read_mode: One of L{READ_MODES}
+        """
         # Setup logging
         logfile = logfile or "vc_log_" + addr + ".log"
         logging.basicConfig(level=logging.DEBUG,
@@ -409,46 +1999,64 @@ class VinzClortho(object):
         log.info("Starting VinzClortho")
 
         self.reactor = tc.Reactor()
-        self.workers = [tc.Worker(self.reactor, True) for i in range(self.worker_pool_size)]
+        self.workers = tc.WorkerPool(self.reactor, self.worker_pool_size or worker_pool_size(persistent, store_type))
+        self.pool = tangled.client.ConnectionPool(self.reactor, self.connection_pool_size,
+                                                  connect_timeout=self.connect_timeout)
+        self.background = background.BackgroundScheduler(self.reactor, background_rate, background_transfers)
         self.address = split_str_addr(addr)
         self.host, self.port = self.address
         self.num_partitions = partitions or self.num_partitions
         self.persistent = persistent
+        self.durability = durability
+        self.store_type = store_type
+        self._set_quorums(quorums or [])
+        self.read_mode = read_mode
+        self.latency = latency.ReplicaLatency()
+        self.reads = SingleFlight()
+        self.repairs = RepairQueue(self.reactor, self.background)
+        self.cache = None
+        if cache_size:
+            self.cache = cache.Cache(cache_size, cache_ttl)
         self._vcid = self.address
         self._storage = {}
         self._pending_shutdown_storage = {}
+        self._hints = {}
+        self._replaying = set()
+        self._anti_entropy_next = 0
         self._metadata = None
         self._node = chash.Node(self.host, self.port)
         self._claim = claim
         self.create_ring(join)
-        self._server = ts.AsyncHTTPServer(self.address, self,
-                                          [(r"/store/(.*)", StoreHandler),
-                                           (r"/_localstore/(.*)", LocalStoreHandler),
-                                           (r"/_handoff", HandoffHandler),
-                                           (r"/_metadata", MetaDataHandler),
-                                           (r"/admin/(.*)", AdminHandler)])
+        self._server = ts.AsyncHTTPServer(self.address, self, self.routes, self.reactor)
+        self._server.max_body_size = self.max_body_size
+        self._server.spool_threshold = self.spool_threshold
         self.reactor.call_later(self.check_shutdown, 30.0)
+        if self.persistent:
+            self._load_hints()
+            self._load_handoffs()
+            if self.store_type == "log":
+                self.reactor.call_later(self.merge_storage, self.merge_interval)
+        self.reactor.call_later(self.replay_hints, self.hint_interval)
+        self.reactor.call_later(self.anti_entropy, self.anti_entropy_interval)
 
     @property
     def ring(self):
         return self._metadata[1]["ring"]
 
-    def _get_worker(self, num):
-        # The idea is to get the same worker for a partition, to avoid 
-        # threading issues
-        return self.workers[num % len(self.workers)]
+    def _get_worker(self, key):
+        # The calls for a partition are executed in order, one at a time,
+        # to avoid threading issues
+        return self.workers.lane(key)
 
     def _get_replica(self, node, key):
         if node.host == self.host and node.port == self.port:
             return self.get_storage(key)
         else:
-            return RemoteStorage((node.host, node.port))
+            return RemoteStorage((node.host, node.port), self.pool, self.latency)
 
     def check_shutdown(self):
         if not self._storage and not self._pending_shutdown_storage:
-            for w in self.workers:
-                w.stop()
-                w.join()
+            self.workers.stop()
             # fugly way, but it works
             sys.exit(0)
         self.reactor.call_later(self.check_shutdown, 5.0)
@@ -468,31 +2076,205 @@ class VinzClortho(object):
         self.ring.update_node(self._node, claim, force)
         self.balance()
 
+    def _set_quorums(self, quorums):
+        self._default_quorum = Quorum(self.N, self.R, self.W)
+        self._quorums = []
+        for prefix, quorum in quorums:
+            if prefix is None:
+                self._default_quorum = quorum
+                self.N = quorum.n
+            else:
+                self._quorums.append((prefix, quorum))
+        for prefix, quorum in self._quorums:
+            if quorum.n > self.N:
+                raise ValueError("N of %s is more than %d"%(prefix, self.N))
+        # Longest prefix first
+        self._quorums.sort(key=lambda (prefix, quorum): len(prefix), reverse=True)
+
+    def quorum(self, key):
+        """Returns the L{Quorum} of the longest prefix of key that has one, or the default"""
+        for prefix, quorum in self._quorums:
+            if key.startswith(prefix):
+                return quorum
+        return self._default_quorum
+
     def get_replicas(self, key):
-        preferred, fallbacks = self.ring.preferred(key)
+        preferred, fallbacks = self.ring.preferred(key, self.quorum(key).n)
         return [self._get_replica(n, key) for n in preferred]
 
+    def get_fallbacks(self, key):
+        """Returns the nodes that hints for the key can be written to, in order"""
+        preferred, fallbacks = self.ring.preferred(key, self.quorum(key).n)
+        return [self._get_hint_replica(n) for n in fallbacks]
+
+    def replicated_on(self, key, address):
+        """Returns True if the node at address is one of the replicas of key"""
+        preferred, fallbacks = self.ring.preferred(key, self.quorum(key).n)
+        return address in [(n.host, n.port) for n in preferred]
+
+    def _get_hint_replica(self, node):
+        if node.host == self.host and node.port == self.port:
+            return self
+        else:
+            return RemoteStorage((node.host, node.port), self.pool)
+
+    def _hint_storage_name(self, owner):
+        return "hints-%s:%d@%s:%d"%(owner + self.address)
+
+    def get_hint_storage(self, owner):
+        """Returns the storage for the hints intended for owner"""
+        try:
+            return self._hints[owner]
+        except KeyError:
+            s = self._create_storage(self._get_worker(owner), self._hint_storage_name(owner), None)
+            self._hints[owner] = s
+            return s
+
+    def _load_hints(self):
+        """Opens the hint storages left by a previous run"""
+        prefix = "vc_store_hints-"
+        suffix = "@%s:%d."%self.address
+        for filename in glob.glob(prefix + "*" + suffix + "*"):
+            owner = split_str_addr(filename[len(prefix):filename.rindex(suffix)])
+            log.info("Found hints for %s", owner)
+            self.get_hint_storage(owner)
+
+    def put_hint(self, owner, key, value, deadline=None):
+        """Stores a hint on this node, see L{RemoteStorage.put_hint}"""
+        s = self.get_hint_storage(owner)
+        return s.multi_put([(key, value)], resolve_encoded, deadline)
+
+    def replay_hints(self):
+        """Hands off the stored hints to their owners, one batch at a time"""
+        for owner in self._hints.keys():
+            if owner not in self._replaying:
+                self._replaying.add(owner)
+                self._replay_next(owner)
+        self.reactor.call_later(self.replay_hints, self.hint_interval)
+
+    def _replay_next(self, owner):
+        d = self._hints[owner].get_batch(self.hint_batch_size)
+        d.add_callbacks(functools.partial(self._replay_batch, owner),
+                        functools.partial(self._replay_error, owner))
+
+    def _replay_batch(self, owner, kvlist):
+        if not kvlist:
+            self._replaying.discard(owner)
+            return
+        data = bz2.compress(pickle.dumps(kvlist))
+        d = self.background.throttle(len(data))
+        d.add_callback(functools.partial(self._replay_request, owner, data))
+        d.add_callbacks(functools.partial(self._replay_acked, owner, kvlist),
+                        functools.partial(self._replay_error, owner))
+
+    def _replay_request(self, owner, data, nbytes):
+        url = "http://%s:%d/_handoff"%owner
+        return self.pool.request(url, command="PUT", data=data, timeout=self.request_timeout)
+
+    def _replay_acked(self, owner, kvlist, response):
+        if response.status != 200:
+            return self._replay_error(owner, response)
+        log.info("Replayed %d hints to %s", len(kvlist), owner)
+        # Only delete the hints that haven't been overwritten in the meantime
+        d = self._hints[owner].delete_unchanged(kvlist)
+        d.add_callbacks(lambda deleted: self._replay_next(owner),
+                        functools.partial(self._replay_error, owner))
+
+    def _replay_error(self, owner, result):
+        log.debug("Replay of hints to %s failed: %s", owner, result)
+        self._replaying.discard(owner)
+
+    def partition_storage(self, p):
+        """Returns the storage of a partition, or None if this node doesn't have it"""
+        return self._storage.get(p)
+
     def get_storage(self, key):
         p = self.ring.key_to_partition(key)
-        return self._storage.setdefault(p, LocalStorage(self._get_worker(p), "%d@%s:%d"%(p, self.host, self.port), p, self.persistent))
+        try:
+            return self._storage[p]
+        except KeyError:
+            s = self._create_storage(self._get_worker(p), "%d@%s:%d"%(p, self.host, self.port), p)
+            self._storage[p] = s
+            return s
 
-    def local_get(self, key):
+    def _create_storage(self, worker, name, partition):
+        return LocalStorage(worker, name, partition, self.persistent, self.durability, self.store_type)
+
+    def local_get(self, key, deadline=None):
         s = self.get_storage(key)
-        return s.get(key)
+        return s.get(key, deadline)
+
+    def invalidate_cached(self, keys):
+        """
+        Removes the keys from the cache of read values, and keeps new reads
+        from waiting for the ones in flight, when they are written
+        """
+        for k in keys:
+            self.reads.forget(k)
+        if self.cache is not None:
+            for k in keys:
+                self.cache.invalidate(k)
 
-    def local_put(self, key, value):
+    def local_get_digest(self, key, deadline=None):
         s = self.get_storage(key)
-        return s.put(key, value)
+        return s.get_digest(key, deadline)
 
-    def local_multi_put(self, kvlist):
-        def resolve(a, b):
-            return vectorclock.resolve_list_extend([a, b])
-        s = self.get_storage(kvlist[0][0])
-        return s.multi_put(kvlist, resolve)
+    def local_get_region(self, key, deadline=None):
+        """Returns a Deferred with the value of key, or a L{ts.FileRegion} of it, see L{LocalStorage.get_region}"""
+        s = self.get_storage(key)
+        return s.get_region(key, deadline)
 
-    def local_delete(self, key):
+    def local_scan(self, partitions, start, inclusive, end, limit, digests=False, deadline=None):
+        """
+        Returns a Deferred with the key/val tuples of the keys from start up
+        to end in the partitions that this node has, in order, at most limit
+        of them. The partitions are scanned in their own workers.
+
+        @param digests: Return the digests of the values instead (see L{digest})
+        """
+        scans = []
+        for p in partitions:
+            s = self.partition_storage(p)
+            if s is not None:
+                scans.append(s.scan(start, inclusive, end, limit, digests, deadline))
+        d = tc.gather_results(scans)
+        d.add_callback(lambda kvlists: _merge_sorted(kvlists, limit))
+        return d
+
+    def local_put(self, key, value, deadline=None):
+        self.invalidate_cached([key])
+        s = self.get_storage(key)
+        return s.put(key, value, deadline)
+
+    def local_multi_get(self, keys, deadline=None):
+        """
+        Returns a Deferred with a dict of the values of the keys that were
+        found. The keys of each partition are read by one call in its worker.
+        """
+        per_partition = collections.defaultdict(list)
+        for k in keys:
+            per_partition[self.ring.key_to_partition(k)].append(k)
+        d = tc.gather_results([self.get_storage(ks[0]).multi_get(ks, deadline) for ks in per_partition.values()])
+        d.add_callback(_merge_kvlists)
+        return d
+
+    def local_multi_put(self, kvlist, priority=tc.FOREGROUND, resolver=resolve_encoded, deadline=None):
+        """
+        Puts the key/val tuples, with one call in the worker of each
+        partition. The values are resolved with the current ones by
+        resolver, or replace them if it's None.
+        """
+        self.invalidate_cached([k for k, v in kvlist])
+        per_partition = collections.defaultdict(list)
+        for k, v in kvlist:
+            per_partition[self.ring.key_to_partition(k)].append((k, v))
+        return tc.gather_results([self.get_storage(kvs[0][0]).multi_put(kvs, resolver, deadline, priority)
+                                  for kvs in per_partition.values()])
+
+    def local_delete(self, key, deadline=None):
+        self.invalidate_cached([key])
         s = self.get_storage(key)
-        return s.delete(key)
+        return s.delete(key, deadline)
 
     def create_ring(self, join):
         if join:
@@ -510,7 +2292,8 @@ class VinzClortho(object):
         if self.update_meta(meta):
             log.info("Update gossip @ %s", address)
             url = "http://%s:%d/_metadata"%address
-            d = tangled.client.request(url, command="PUT", data=bz2.compress(pickle.dumps(self._metadata)))
+            d = self.pool.request(url, command="PUT", data=bz2.compress(pickle.dumps(self._metadata)),
+                                  timeout=self.request_timeout)
             d.add_both(self.gossip_sent)
         else:
             self.schedule_gossip()
@@ -579,36 +2362,140 @@ class VinzClortho(object):
         address = a or self.random_other_node_address()
         if address is not None:
             log.debug("Gossip with %s", address)
-            d = tangled.client.request("http://%s:%d/_metadata"%address)
+            d = self.pool.request("http://%s:%d/_metadata"%address, timeout=self.request_timeout)
             d.add_callbacks(functools.partial(self.gossip_received, address), self.gossip_error)
             return d
 
+    def anti_entropy(self):
+        """
+        Synchronizes one of the partitions this node replicates with the other
+        replicas, see L{MerkleExchange}. The partitions take turns.
+        """
+        if self._metadata is None:
+            self.reactor.call_later(self.anti_entropy, self.anti_entropy_interval)
+            return
+        partitions = sorted((set(self._node.claim) | self.ring.replicated(self._node)) & set(self._storage))
+        if not partitions:
+            self.reactor.call_later(self.anti_entropy, self.anti_entropy_interval)
+            return
+        p = partitions[self._anti_entropy_next % len(partitions)]
+        self._anti_entropy_next = self._anti_entropy_next + 1
+        preferred, fallbacks = self.ring.preference_list(p)
+        peers = [(n.host, n.port) for n in preferred if n != self._node]
+        self._exchange_next(p, peers, None)
+
+    def _exchange_next(self, partition, peers, result):
+        if isinstance(result, tc.Failure):
+            log.debug("Anti-entropy of %d failed: %s", partition, result)
+        elif result:
+            log.info("Anti-entropy sent %d keys of %d", result, partition)
+        storage = self._storage.get(partition)
+        if peers and storage is not None:
+            replicated = None
+            if self._quorums:
+                # Some keys may have fewer replicas than the partition
+                replicated = self.replicated_on
+            exchange = MerkleExchange(storage, partition, peers.pop(), self.pool, self.request_timeout,
+                                      self.background, replicated)
+            d = self.background.transfer(exchange.run)
+            d.add_both(functools.partial(self._exchange_next, partition, peers))
+        else:
+            self.reactor.call_later(self.anti_entropy, self.anti_entropy_interval)
+
+    def merge_storage(self):
+        """Lets the stores of the partitions and hints reclaim space, one at a time"""
+        storages = self._storage.values() + self._hints.values()
+        self._merge_next(storages, None)
+
+    def _merge_next(self, storages, result):
+        if isinstance(result, tc.Failure):
+            log.error("Merge failed: %s", result)
+        if storages:
+            d = storages.pop().merge()
+            d.add_both(functools.partial(self._merge_next, storages))
+        else:
+            self.reactor.call_later(self.merge_storage, self.merge_interval)
+
     def update_storage(self):
         """Creates storages (if necessary) for all claimed partitions"""
         for p in self._node.claim:
             if p not in self._storage:
-                self._storage[p] = LocalStorage(self._get_worker(p), "%d@%s:%d"%(p, self.host, self.port), p, self.persistent)
+                self._storage[p] = self._create_storage(self._get_worker(p), "%d@%s:%d"%(p, self.host, self.port), p)
 
-    def _partial_handoff(self, node, partition, kvlist):
-        if not kvlist:
-            # TODO: remove the db file etc
-            log.debug("Shutdown partition %s", partition)
-            del self._pending_shutdown_storage[partition]
-        else:
-            url = "http://%s:%d/_handoff"%(node.host, node.port)
-            d = tangled.client.request(url, command="PUT", data=bz2.compress(pickle.dumps(kvlist)))
-            log.info("Handoff %d items from %s to %s", len(kvlist), partition, node)
+    def _handoff_cursor_file(self, partition):
+        if not self.persistent:
+            return None
+        return "vc_handoff_%d@%s:%d"%(partition, self.host, self.port)
+
+    def _load_handoffs(self):
+        """
+        Reopens the storages of the partitions that a previous run didn't
+        finish handing off, so that L{check_handoff} resumes them from their
+        cursors
+        """
+        prefix = "vc_handoff_"
+        suffix = "@%s:%d"%self.address
+        for filename in glob.glob(prefix + "*" + suffix):
+            p = int(filename[len(prefix):-len(suffix)])
+            if p not in self._storage:
+                log.info("Found unfinished handoff of %d", p)
+                self._storage[p] = self._create_storage(self._get_worker(p), "%d@%s:%d"%(p, self.host, self.port), p)
 
     def do_handoff(self, node, partitions, result):
         log.debug("Handing off %s", partitions)
         for p in partitions:
-            s = self._storage[p]
-            self._pending_shutdown_storage[p] = s
-            del self._storage[p]
-            # Send the partitions in 1MB chunks
-            s.get_all(1048576, functools.partial(self._partial_handoff, node, p))
+            self._pending_shutdown_storage[p] = self._storage.pop(p)
+            # The scheduler limits how many partitions are transferred at once
+            d = self.background.transfer(functools.partial(self._start_handoff, node, p))
+            d.add_both(functools.partial(self._handoff_done, node, p))
         return result
 
+    def _start_handoff(self, node, partition):
+        h = Handoff(self._pending_shutdown_storage[partition], (node.host, node.port), self.pool,
+                    self.background, self.request_timeout, self._handoff_cursor_file(partition))
+        return h.run()
+
+    def _handoff_done(self, node, partition, result):
+        s = self._pending_shutdown_storage.pop(partition)
+        if isinstance(result, tc.Failure):
+            log.error("Handoff of %s to %s failed: %s", partition, node, result)
+            # Take it back
+            current = self._storage.setdefault(partition, s)
+            if current is s:
+                self.reactor.call_later(self.check_handoff, self.handoff_retry_interval)
+            else:
+                # Writes have opened a new storage in the meantime, which gets what's left
+                log.info("Moving %s into %s", s, current)
+                done = tc.Deferred()
+                done.add_both(self._copy_done)
+                d = s.get_iterator()
+                d.add_callback(functools.partial(self._copy_next, s, current, done))
+                d.add_errback(done.errback)
+        else:
+            # TODO: remove the db file etc
+            log.info("Handed off %d items from %s to %s", result, partition, node)
+
+    def _copy_next(self, source, target, done, iterator):
+        """Copies the rest of source into target, one chunk at a time, and calls back done"""
+        d = source.iterate(iterator, Handoff.chunk_size)
+        d.add_callback(functools.partial(self._copy_chunk, source, target, done))
+        d.add_errback(done.errback)
+
+    def _copy_chunk(self, source, target, done, result):
+        kvlist, iterator = result
+        if not kvlist:
+            done.callback(source)
+            return
+        d = target.multi_put(kvlist, resolve_encoded, None, tc.BACKGROUND)
+        d.add_callback(lambda ignore: self._copy_next(source, target, done, iterator))
+        return d
+
+    def _copy_done(self, result):
+        if isinstance(result, tc.Failure):
+            log.error("Moving a partition that wasn't handed off failed: %s", result)
+        # The moved keys are handed off with the rest
+        self.reactor.call_later(self.check_handoff, self.handoff_retry_interval)
+
     def _handoff_error(self, failure):
         failure.raise_exception()
 
@@ -621,7 +2508,7 @@ class VinzClortho(object):
             handoff_per_node[n].append(p)
         for n, plist in handoff_per_node.items():
             # request the metadata to see if it's alive
-            d = tangled.client.request("http://%s:%d/_metadata"%(n.host, n.port))
+            d = self.pool.request("http://%s:%d/_metadata"%(n.host, n.port), timeout=self.request_timeout)
             d.add_callbacks(functools.partial(self.do_handoff, n, plist), self._handoff_error)
 
     def run(self):
@@ -649,10 +2536,761 @@ def main():
                       help="Number of partitions in the hash ring")
     parser.add_option("-l", "--logfile", dest="logfile", metavar="FILE",
                       help="Use FILE as logfile")
+    parser.add_option("-d", "--durability", dest="durability", type="choice",
+                      choices=store.DURABILITY_MODES, default=store.GROUP,
+                      help="When writes are made durable: %s (default: %%default)"%", ".join(store.DURABILITY_MODES))
+    parser.add_option("-s", "--store", dest="store_type", type="choice",
+                      choices=store.STORE_TYPES, default="bdb",
+                      help="The type of store to use: %s (default: %%default)"%", ".join(store.STORE_TYPES))
+    parser.add_option("--background-rate", dest="background_rate", type="int", metavar="BYTES",
+                      help="Limit handoff, hint replay, anti-entropy and read-repair to BYTES per second")
+    parser.add_option("--background-transfers", dest="background_transfers", type="int", default=2,
+                      help="Number of partitions to transfer at once (default: %default)")
+    parser.add_option("-q", "--quorum", dest="quorums", action="append", default=[], metavar="[PREFIX=]N,R,W",
+                      help="The number of replicas, and the read and write quorums, of the keys that start "
+                      "with PREFIX, or of all other keys (default: %d,%d,%d). Can be given several times"
+                      %(VinzClortho.N, VinzClortho.R, VinzClortho.W))
+    parser.add_option("--cache-size", dest="cache_size", type="int", default=0,
+                      help="Number of read values to cache, 0 for no cache (default: %default)")
+    parser.add_option("--cache-ttl", dest="cache_ttl", type="float", default=1.0,
+                      help="Seconds a cached value is used for (default: %default)")
+    parser.add_option("--read-mode", dest="read_mode", choices=READ_MODES, default="all",
+                      help="Read from all replicas at once (all), or from the R fastest first, and from "
+                      "the others if they are late (adaptive) (default: %default)")
     (options, args) = parser.parse_args()
-
-    vc = VinzClortho(options.address, options.join, options.claim, options.partitions, options.logfile, True)
+    try:
+        quorums = [parse_quorum(spec) for spec in options.quorums]
+    except ValueError, e:
+        parser.error("Invalid quorum: %s"%e)
+
+    vc = VinzClortho(options.address, options.join, options.claim, options.partitions, options.logfile, True,
+                     options.durability, options.store_type, options.background_rate,
+                     options.background_transfers, quorums, options.cache_size, options.cache_ttl,
+                     options.read_mode)
     vc.run()
 
+class TestStoreHandler(unittest.TestCase):
+    class Parent(object):
+        request_timeout = 10.0
+        def __init__(self, replicas, fallbacks):
+            self.reactor = tc.Reactor()
+            self.replicas = replicas
+            self.fallbacks = fallbacks
+        def quorum(self, key):
+            return Quorum(1, 1, 1)
+        def invalidate_cached(self, keys):
+            pass
+        def get_replicas(self, key):
+            return self.replicas
+        def get_fallbacks(self, key):
+            return list(self.fallbacks)
+
+    class Pool(object):
+        """Answers the requests with status, and records them"""
+        def __init__(self, status=200):
+            self.status = status
+            self.requests = []
+        def request(self, url, command, data, headers, timeout):
+            self.requests.append((url, timeout))
+            response = tangled.client.Response(None)
+            response.status = self.status
+            return tc.succeed(response)
+
+    class Blackhole(object):
+        """A replica that doesn't answer, its put fails at the deadline"""
+        address = ("localhost", 18090)
+        def put(self, key, value, deadline):
+            return tc.fail(DeadlineExceeded())
+
+    def test_hint_after_deadline(self):
+        pool = self.Pool()
+        parent = self.Parent([self.Blackhole()], [RemoteStorage(("localhost", 18091), pool)])
+        h = StoreHandler(parent)
+        # The replica failed when the deadline passed
+        response = h.put("key", None, "client", "value", time.time() - 1.0)
+        self.assertEqual(len(pool.requests), 1)
+        url, timeout = pool.requests[0]
+        self.assertEqual(url, "http://localhost:18091/_hint/key")
+        self.assertTrue(timeout > parent.request_timeout - 1.0)
+        self.assertEqual(response.result.code, 200)
+
+    def test_hint_out_of_time(self):
+        class Frozen(RemoteStorage):
+            def put_hint(self, owner, key, value, deadline=None):
+                self.deadline = deadline
+                return tc.fail(DeadlineExceeded())
+        pool = self.Pool()
+        frozen = Frozen(("localhost", 18091), pool)
+        parent = self.Parent([self.Blackhole()], [frozen, RemoteStorage(("localhost", 18092), pool)])
+        h = StoreHandler(parent)
+        h.put("key", None, "client", "value", time.time() + 1.0)
+        self.assertTrue(frozen.deadline > time.time() + 5.0)
+        # The next fallback isn't tried
+        self.assertEqual(pool.requests, [])
+        self.assertEqual(len(h.failed), 1)
+
+        # Other failures of a hint move on to the next fallback
+        h = StoreHandler(self.Parent([self.Blackhole()], [RemoteStorage(("localhost", 18091), self.Pool(500)),
+                                                          RemoteStorage(("localhost", 18092), pool)]))
+        response = h.put("key", None, "client", "value", time.time() + 1.0)
+        self.assertEqual([url for url, timeout in pool.requests], ["http://localhost:18092/_hint/key"])
+        self.assertEqual(response.result.code, 200)
+
+
+class NodeTestCase(unittest.TestCase):
+    """
+    Runs nodes in this process, with in-memory storages whose calls are
+    made right away, and a connection pool that hands the requests to the
+    nodes, so everything is done by the time a request returns
+    """
+    class Worker(object):
+        """Calls the functions right away"""
+        def __init__(self, reactor):
+            self.reactor = reactor
+        def defer(self, func, priority=tc.FOREGROUND):
+            try:
+                return tc.succeed(func())
+            except Exception:
+                return tc.fail(tc.Failure())
+
+    class Loopback(object):
+        """
+        Hands the requests to the nodes, and records them. The requests to
+        the nodes in down time out. While held is a list, the requests wait
+        in it for L{release}.
+        """
+        def __init__(self):
+            self.nodes = {}
+            self.requests = []
+            self.down = set()
+            self.held = None
+
+        def release(self, failure=None):
+            """Lets the held requests go on, or fails them with failure"""
+            held, self.held = self.held, None
+            for d, args in held:
+                if failure is None:
+                    self._send(*args).add_callbacks(d.callback, d.errback)
+                else:
+                    d.errback(failure)
+
+        def call(self, node, command, path, data="", headers=None):
+            """Returns a Deferred with the L{ts.Response} of node"""
+            handler, m = node._routes.match(path)
+            h = ts.Headers()
+            for k, v in (headers or {}).items():
+                h[k] = v
+            request = ts.Request(("localhost", 0), command, path, h, data, m.groups())
+            return getattr(handler, "do_" + command)(request)
+
+        def _response(self, address, response):
+            result = tangled.client.Response(address)
+            result.status = response.code
+            if isinstance(response.data, (basestring, buffer)):
+                result.data = str(response.data)
+            else:
+                result.data = "".join(response.data)
+            return result
+
+        def request(self, url, command="GET", data="", headers=None, timeout=None):
+            address, path = tangled.client.split_url(url)
+            self.requests.append((address, command, path))
+            if self.held is not None:
+                d = tc.Deferred()
+                self.held.append((d, (address, command, path, data, headers)))
+                return d
+            return self._send(address, command, path, data, headers)
+
+        def _send(self, address, command, path, data, headers):
+            if address in self.down:
+                return tc.fail(tc.Failure(tangled.client.TimeoutError()))
+            d = self.call(self.nodes[address], command, path, data, headers)
+            d.add_callback(functools.partial(self._response, address))
+            return d
+
+    def _cluster(self, count, quorum=None, partitions=8, quorums=None):
+        """Returns count nodes, with the default quorum (N=count, R=W=1 if not given)"""
+        quorum = quorum or Quorum(count, 1, 1)
+        reactor = tc.Reactor()
+        self.addCleanup(reactor._trigger.close)
+        self.pool = self.Loopback()
+        ring_nodes = [chash.Node("localhost", 18090 + i) for i in range(count)]
+        ring = chash.Ring(partitions, ring_nodes[0], quorum.n)
+        for n in ring_nodes[1:]:
+            ring.add_node(n)
+        # Round robin, so that the replicas of a partition are on different nodes
+        for n in ring_nodes:
+            n.claim = []
+        for p in range(partitions):
+            ring.partitions[p] = ring_nodes[p % count]
+            ring_nodes[p % count].claim.append(p)
+        ring._invalidate()
+        metadata = (vectorclock.VectorClock(), {"ring": ring})
+        worker = self.Worker(reactor)
+        nodes = []
+        for n in ring_nodes:
+            node = VinzClortho.__new__(VinzClortho)
+            node.host, node.port = node.address = (n.host, n.port)
+            node._node = n
+            node._metadata = metadata
+            node.reactor = reactor
+            node.pool = self.pool
+            node.background = background.BackgroundScheduler(reactor)
+            node.persistent = False
+            node.durability = store.SYNC
+            node.store_type = None
+            node._set_quorums([(None, quorum)] + (quorums or []))
+            node.read_mode = "all"
+            node.latency = latency.ReplicaLatency()
+            node.reads = SingleFlight()
+            node.repairs = RepairQueue(reactor, node.background)
+            node.cache = None
+            node._storage = {}
+            node._pending_shutdown_storage = {}
+            node._hints = {}
+            node._get_worker = lambda key: worker
+            node._routes = ts.RouteTable(VinzClortho.routes, node)
+            self.pool.nodes[node.address] = node
+            nodes.append(node)
+        return nodes
+
+    def _result(self, d):
+        """The result of a Deferred that has been called"""
+        self.assertTrue(d.called)
+        return d.result
+
+
+class TestHandoff(NodeTestCase):
+    def test_failed_handoff(self):
+        node = VinzClortho.__new__(VinzClortho)
+        node.reactor = tc.Reactor()
+        node.handoff_retry_interval = 30.0
+        worker = self.Worker(node.reactor)
+        old = LocalStorage(worker, "old", 3, False)
+        new = LocalStorage(worker, "new", 3, False)
+        vc = vectorclock.VectorClock()
+        vc.increment("a")
+        for i in range(20):
+            old._store.put("key_%d"%i, encode(vc, "old_%d"%i))
+        newer = vc.clone()
+        newer.increment("b")
+        new._store.put("key_0", encode(newer, "new_0"))
+
+        # Taken back, there is no other storage
+        node._storage = {}
+        node._pending_shutdown_storage = {3: old}
+        node._handoff_done(None, 3, tc.Failure(IOError()))
+        self.assertTrue(node._storage[3] is old)
+
+        # A write opened a new storage for the partition while the handoff was going on
+        Handoff.chunk_size, chunk_size = 100, Handoff.chunk_size
+        try:
+            node._storage = {3: new}
+            node._pending_shutdown_storage = {3: old}
+            node._handoff_done(None, 3, tc.Failure(IOError()))
+        finally:
+            Handoff.chunk_size = chunk_size
+        self.assertTrue(node._storage[3] is new)
+        self.assertEqual(len(new._store._store), 20)
+        self.assertEqual(str(decode(new._store.get("key_0"))[1]), "new_0")
+        self.assertEqual(str(decode(new._store.get("key_19"))[1]), "old_19")
+        node.reactor._trigger.close()
+
+    def test_load_handoffs(self):
+        node = VinzClortho.__new__(VinzClortho)
+        node.host, node.port = node.address = ("localhost", 18090)
+        node._storage = {}
+        node._get_worker = lambda p: None
+        node._create_storage = lambda worker, name, partition: name
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(directory)
+            for name in ("vc_handoff_5@localhost:18090", "vc_handoff_6@localhost:18090.tmp",
+                         "vc_handoff_7@localhost:18091"):
+                open(name, "wb").close()
+            node._load_handoffs()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+        self.assertEqual(node._storage, {5: "5@localhost:18090"})
+
+
+class TestBatch(NodeTestCase):
+    def _batch(self, node, body, path="/store", headers=None):
+        """Returns the status, and the results of the batch by operation and key"""
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        response = self._result(self.pool.call(node, "POST", path, body, headers))
+        if response.code != 200:
+            return response.code, None
+        results = json.loads(response.data)
+        return 200, dict([(op, dict([(r["key"], r) for r in results[op]])) for op in results])
+
+    def _statuses(self, results, op):
+        return dict([(k, r["status"]) for k, r in results[op].items()])
+
+    def test_batch(self):
+        nodes = self._cluster(3, Quorum(3, 2, 2))
+        node = nodes[0]
+        status, results = self._batch(node, {"put": [{"key": k, "value": base64.b64encode("value_" + k)}
+                                                     for k in ("a", "b", "c")]})
+        self.assertEqual(status, 200)
+        self.assertEqual(self._statuses(results, "put"), {"a": 200, "b": 200, "c": 200})
+        # One request per node for the puts
+        remote = [r for r in self.pool.requests if r[2] == "/_localstore"]
+        self.assertEqual(sorted(remote), sorted(set(remote)))
+        self.assertEqual(len(remote), 2)
+
+        # Gets, puts and deletes in one batch
+        del self.pool.requests[:]
+        status, results = self._batch(node, {"get": ["a", "missing"],
+                                             "put": [{"key": "d", "value": base64.b64encode("value_d")}],
+                                             "delete": [{"key": "b", "context": results["put"]["b"].get("context")}]})
+        self.assertEqual(self._statuses(results, "get"), {"a": 200, "missing": 404})
+        self.assertEqual(results["get"]["a"]["values"], [base64.b64encode("value_a")])
+        self.assertTrue("context" in results["get"]["a"])
+        self.assertEqual(self._statuses(results, "put"), {"d": 200})
+        self.assertEqual(self._statuses(results, "delete"), {"b": 200})
+        # One request per node for the gets, and one for the puts and deletes
+        self.assertEqual(len([r for r in self.pool.requests if r[2] == "/_localstore"]), 4)
+
+        status, results = self._batch(nodes[1], {"get": ["a", "b", "c", "d"]})
+        self.assertEqual(self._statuses(results, "get"), {"a": 200, "b": 200, "c": 200, "d": 200})
+        # Deleted, like a read of the key by itself
+        self.assertEqual(results["get"]["b"]["values"], [""])
+        self.assertEqual(results["get"]["c"]["values"], [base64.b64encode("value_c")])
+
+    def test_siblings(self):
+        nodes = self._cluster(2, Quorum(2, 2, 1))
+        # Concurrent writes
+        for node, client in zip(nodes, ("x", "y")):
+            vc = vectorclock.VectorClock()
+            vc.increment(client)
+            node.get_storage("a")._store.put("a", encode(vc, client))
+        node = nodes[0]
+        status, results = self._batch(node, {"get": ["a"]})
+        self.assertEqual(results["get"]["a"]["status"], 300)
+        self.assertEqual(sorted(results["get"]["a"]["values"]), [base64.b64encode("x"), base64.b64encode("y")])
+        # Writing with the context of both resolves them
+        context = results["get"]["a"]["context"]
+        self._batch(node, {"put": [{"key": "a", "value": base64.b64encode("z"), "context": context}]})
+        status, results = self._batch(node, {"get": ["a"]})
+        self.assertEqual(results["get"]["a"]["status"], 200)
+        self.assertEqual(results["get"]["a"]["values"], [base64.b64encode("z")])
+
+    def test_replicas_down(self):
+        nodes = self._cluster(3, Quorum(3, 2, 2))
+        self._batch(nodes[0], {"put": [{"key": "a", "value": base64.b64encode("1")}]})
+        self.pool.down.update([n.address for n in nodes[1:]])
+        status, results = self._batch(nodes[0], {"get": ["a"], "put": [{"key": "b", "value": "Mg=="}]})
+        self.assertEqual(status, 200)
+        # Not enough replicas answered
+        self.assertEqual(self._statuses(results, "get"), {"a": 404})
+        self.assertEqual(self._statuses(results, "put"), {"b": 404})
+        status, results = self._batch(nodes[0], {"get": ["a"], "put": [{"key": "b", "value": "Mg=="}]},
+                                      "/store?r=1&w=1")
+        self.assertEqual(self._statuses(results, "get"), {"a": 200})
+        self.assertEqual(self._statuses(results, "put"), {"b": 200})
+
+    def test_errors(self):
+        node = self._cluster(1)[0]
+        for body in ("{", "[]", '{"get": [1]}', '{"put": [{"key": "a"}]}', '{"put": [{"key": "a", "value": "a"}]}',
+                     '{"delete": [{"key": "a", "context": "x"}]}', '{"delete": ["a"]}'):
+            self.assertEqual(self._batch(node, body)[0], 400, body)
+        self.assertEqual(self._batch(node, {"get": ["a"]}, "/store?r=x")[0], 400)
+        BatchHandler.max_keys, max_keys = 2, BatchHandler.max_keys
+        try:
+            self.assertEqual(self._batch(node, {"get": ["a", "b"], "delete": [{"key": "c"}]})[0], 413)
+            self.assertEqual(self._batch(node, {"get": ["a"], "delete": [{"key": "c"}]})[0], 200)
+        finally:
+            BatchHandler.max_keys = max_keys
+
+    def test_quorum_per_key(self):
+        node = self._cluster(2, quorums=[("one/", Quorum(1, 1, 1))])[0]
+        # An R that a key doesn't have replicas for fails that key only
+        status, results = self._batch(node, {"get": ["one/a", "a"], "put": [{"key": "one/b", "value": "Mg=="},
+                                                                            {"key": "b", "value": "Mg=="}]},
+                                      "/store?r=2")
+        self.assertEqual(status, 200)
+        self.assertEqual(self._statuses(results, "get"), {"one/a": 400, "a": 404})
+        self.assertEqual(self._statuses(results, "put"), {"one/b": 400, "b": 200})
+
+
+class TestQuorum(NodeTestCase):
+    def test_quorum(self):
+        q = Quorum(3, 2, 1)
+        self.assertEqual((q.n, q.r, q.w), (3, 2, 1))
+        for n, r, w in ((3, 4, 1), (3, 1, 4), (3, 0, 1), (3, 1, 0)):
+            self.assertRaises(ValueError, Quorum, n, r, w)
+        self.assertEqual(str(q.override()), "N=3,R=2,W=1")
+        self.assertEqual(str(q.override(3, None)), "N=3,R=3,W=1")
+        self.assertRaises(ValueError, q.override, 4)
+        self.assertRaises(ValueError, q.override, None, 4)
+
+    def test_parse_quorum(self):
+        prefix, q = parse_quorum("3,2,2")
+        self.assertEqual((prefix, str(q)), (None, "N=3,R=2,W=2"))
+        prefix, q = parse_quorum("a=b/=1,1,1")
+        self.assertEqual((prefix, str(q)), ("a=b/", "N=1,R=1,W=1"))
+        for spec in ("3,4,2", "3,2", "3,2,2,2", "a,b,c", "user/=", ""):
+            self.assertRaises(ValueError, parse_quorum, spec)
+
+    def test_prefixes(self):
+        node = VinzClortho.__new__(VinzClortho)
+        node._set_quorums([(None, Quorum(3, 2, 2)), ("user/", Quorum(2, 1, 2)), ("user/admin/", Quorum(3, 3, 3))])
+        self.assertEqual(node.N, 3)
+        self.assertEqual(str(node.quorum("key")), "N=3,R=2,W=2")
+        self.assertEqual(str(node.quorum("user/key")), "N=2,R=1,W=2")
+        self.assertEqual(str(node.quorum("user/admin/key")), "N=3,R=3,W=3")
+        # More replicas than the ring has
+        node = VinzClortho.__new__(VinzClortho)
+        self.assertRaises(ValueError, node._set_quorums, [(None, Quorum(2, 1, 1)), ("user/", Quorum(3, 1, 1))])
+
+    def test_overrides(self):
+        def overrides(path, headers=None):
+            h = ts.Headers()
+            h.update(headers or {})
+            return _quorum_overrides(ts.Request(None, "GET", path, h, "", ()))
+        self.assertEqual(overrides("/store/key"), (None, None))
+        self.assertEqual(overrides("/store/key?r=1&w=3"), (1, 3))
+        self.assertEqual(overrides("/store/key", {"x-vinzclortho-r": "2"}), (2, None))
+        # The query parameters win
+        self.assertEqual(overrides("/store/key?w=1", {"x-vinzclortho-w": "2"}), (None, 1))
+        self.assertRaises(ValueError, overrides, "/store/key?r=one")
+        self.assertRaises(ValueError, overrides, "/store/key", {"x-vinzclortho-w": "2.5"})
+
+        node = self._cluster(3)[0]
+        for path, headers in (("/store/key?r=x", None), ("/store/key", {"X-VinzClortho-R": "two"}),
+                              ("/store/key?r=4", None), ("/store/key?r=0", None)):
+            self.assertEqual(self._result(self.pool.call(node, "GET", path, "", headers)).code, 400)
+        for path, headers in (("/store/key?w=x", None), ("/store/key", {"X-VinzClortho-W": "two"}),
+                              ("/store/key?w=4", None)):
+            for command in ("PUT", "DELETE"):
+                self.assertEqual(self._result(self.pool.call(node, command, path, "value", headers)).code, 400)
+
+    def test_replicas(self):
+        nodes = self._cluster(3, Quorum(3, 2, 2), quorums=[("one/", Quorum(1, 1, 1))])
+        node = nodes[0]
+        for key, n in (("key", 3), ("one/key", 1)):
+            replicas = node.get_replicas(key)
+            self.assertEqual(len(replicas), n)
+            # The first n of the preference list of the ring
+            preferred, fallbacks = node.ring.preference_list(node.ring.key_to_partition(key))
+            self.assertEqual([getattr(r, "address", node.address) for r in replicas],
+                             [(p.host, p.port) for p in preferred[:n]])
+            self.assertEqual(len(node.get_fallbacks(key)), len(preferred) - n + len(fallbacks))
+            self.assertEqual(self._result(self.pool.call(node, "PUT", "/store/" + key, "value")).code, 200)
+            self.assertEqual(len([nd for nd in nodes if nd.partition_storage(node.ring.key_to_partition(key))]), n)
+
+        # W=N fails when a replica is down, W=1 doesn't
+        self.pool.down.add(nodes[2].address)
+        self.assertEqual(self._result(self.pool.call(node, "PUT", "/store/key?w=3", "value")).code, 404)
+        self.assertEqual(self._result(self.pool.call(node, "PUT", "/store/key?w=1", "value")).code, 200)
+        self.assertEqual(self._result(self.pool.call(node, "GET", "/store/key?r=3")).code, 404)
+        self.assertEqual(self._result(self.pool.call(node, "GET", "/store/key?r=2")).code, 200)
+
+
+class TestSingleFlight(NodeTestCase):
+    def test_single_flight(self):
+        flight = SingleFlight()
+        pending = []
+        def func():
+            d = tc.Deferred()
+            pending.append(d)
+            return d
+        first = flight.call("a", func, list)
+        second = flight.call("a", func, list)
+        other = flight.call("b", func, list)
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(len(flight), 2)
+        pending[0].callback([1])
+        # Everyone gets a copy of the result
+        self.assertEqual(first.result, [1])
+        self.assertEqual(second.result, [1])
+        self.assertFalse(first.result is second.result)
+        self.assertFalse(other.called)
+        # Gone, the next call goes out again
+        self.assertEqual(len(flight), 1)
+        third = flight.call("a", func, list)
+        self.assertEqual(len(pending), 3)
+        self.assertEqual(flight.stats(), {"calls": 3, "merged": 1, "in_flight": 2})
+
+        # A failure goes to everyone too
+        errors = []
+        fourth = flight.call("a", func, list)
+        for d in (third, fourth):
+            d.add_errback(errors.append)
+        pending[2].errback(tc.Failure(KeyError("a")))
+        self.assertEqual([e.check(KeyError) for e in errors], [True, True])
+        self.assertEqual(len(flight), 1)
+        flight.call("a", func, list)
+        self.assertEqual(len(pending), 4)
+
+        # Calls made after forget don't wait for the one in flight
+        flight.forget("a")
+        fifth = flight.call("a", func, list)
+        self.assertEqual(len(pending), 5)
+        pending[3].callback([2])
+        self.assertFalse(fifth.called)
+        self.assertEqual(len(flight), 2)
+        pending[4].callback([3])
+        self.assertEqual(fifth.result, [3])
+        pending[1].callback([4])
+        self.assertEqual(other.result, [4])
+        self.assertEqual(len(flight), 0)
+
+    def _reads(self, key):
+        return len([r for r in self.pool.requests if r[1] == "GET" and r[2] == "/_localstore/" + key])
+
+    def test_shared_reads(self):
+        nodes = self._cluster(3, Quorum(3, 2, 2))
+        node = nodes[0]
+        self.assertEqual(self._result(self.pool.call(node, "PUT", "/store/key", "value")).code, 200)
+        self.pool.held = []
+        first = self.pool.call(node, "GET", "/store/key")
+        second = self.pool.call(node, "GET", "/store/key")
+        # One read of each replica
+        self.assertEqual(self._reads("key"), 2)
+        self.assertEqual(len(node.reads), 1)
+        self.pool.release()
+        for d in (first, second):
+            response = self._result(d)
+            self.assertEqual((response.code, str(response.data)), (200, "value"))
+        self.assertFalse(first.result is second.result)
+        self.assertEqual(len(node.reads), 0)
+        # Later reads go out again
+        self.pool.held = []
+        self.pool.call(node, "GET", "/store/key")
+        self.assertEqual(self._reads("key"), 4)
+        self.pool.release()
+        self.assertEqual(len(node.reads), 0)
+
+        # A read that asks for an R doesn't share
+        self.pool.held = []
+        first = self.pool.call(node, "GET", "/store/key")
+        second = self.pool.call(node, "GET", "/store/key?r=2")
+        self.assertEqual(self._reads("key"), 8)
+        # Neither do the reads after a write
+        self.pool.call(node, "PUT", "/store/key", "new")
+        third = self.pool.call(node, "GET", "/store/key")
+        self.assertEqual(self._reads("key"), 10)
+        self.pool.release()
+        self.assertEqual([self._result(d).code for d in (first, second, third)], [200, 200, 200])
+        self.assertEqual(str(third.result.data), "new")
+
+        # The replicas that fail fail all the reads of the key
+        self.pool.held = []
+        reads = [self.pool.call(node, "GET", "/store/key") for i in range(3)]
+        self.assertEqual(self._reads("key"), 12)
+        self.pool.release(tc.Failure(tangled.client.TimeoutError()))
+        self.assertEqual([self._result(d).code for d in reads], [404, 404, 404])
+        self.assertEqual(len(node.reads), 0)
+
+
+class TestRepairQueue(unittest.TestCase):
+    class Reactor(object):
+        def __init__(self):
+            self.calls = []
+        def call_later(self, func, timeout):
+            self.calls.append(func)
+            return func
+
+    class Scheduler(object):
+        def throttle(self, nbytes):
+            return tc.succeed(nbytes)
+
+    class Replica(object):
+        def __init__(self, address):
+            self.address = address
+            self.puts = []
+        def put(self, key, value, deadline=None):
+            d = tc.Deferred()
+            self.puts.append((key, value, d))
+            return d
+
+    def _blob(self, *clients):
+        vc = vectorclock.VectorClock()
+        for client in clients:
+            vc.increment(client)
+        return encode(vc, "+".join(clients))
+
+    def test_repairs(self):
+        reactor = self.Reactor()
+        queue = RepairQueue(reactor, self.Scheduler())
+        r1, r2 = self.Replica(("localhost", 1)), self.Replica(("localhost", 2))
+        a, b = self._blob("a"), self._blob("b")
+        queue.add("key", r1, a)
+        queue.add("key", self.Replica(("localhost", 1)), b)
+        queue.add("key", r2, a)
+        queue.add("other", r2, a)
+        # One timer for all of them
+        self.assertEqual(len(reactor.calls), 1)
+        self.assertEqual(queue.stats(), {"repairs": 0, "merged": 1, "pending": 3})
+        reactor.calls.pop()()
+        self.assertEqual(sorted([(k, str(decode(v)[1])) for k, v, d in r2.puts]), [("key", "a"), ("other", "a")])
+        # Concurrent versions are resolved into one write
+        key, value, d = r1.puts[0]
+        self.assertEqual(len(r1.puts), 1)
+        self.assertEqual(sorted([str(v) for v in decode(value)[1]]), ["a", "b"])
+        self.assertEqual(queue.repairs, 3)
+
+        # The same write as the one being sent is dropped, others wait for the timer
+        queue.add("key", r1, value)
+        self.assertEqual(queue.stats()["pending"], 0)
+        queue.add("key", r1, a)
+        self.assertEqual(queue.stats()["pending"], 1)
+        d.callback(None)
+        for key, value, d in r2.puts:
+            d.errback(tc.Failure(IOError()))
+        # Once sent, the same write can be queued again
+        queue.add("other", r2, a)
+        self.assertEqual(queue.stats()["pending"], 2)
+        reactor.calls.pop()()
+        self.assertEqual(len(r1.puts), 2)
+        self.assertEqual(len(r2.puts), 3)
+        self.assertEqual(reactor.calls, [])
+
+
+class TestScan(NodeTestCase):
+    def _merge(self, limit, *kvlists):
+        scan = Scan(None, None, True, None, limit, 1, True, None)
+        vc = vectorclock.VectorClock()
+        vc.increment("a")
+        scan.kvlists = [[(k, encode(vc, v)) for k, v in kvlist] for kvlist in kvlists]
+        items, last = scan._merge()
+        return [(k, str(v)) for k, (vc, v) in items], last
+
+    def test_merge(self):
+        # Nothing is cut off
+        self.assertEqual(self._merge(4, [("a", "1"), ("c", "3")], [("b", "2")]),
+                         ([("a", "1"), ("b", "2"), ("c", "3")], None))
+        # A full page may have more after it
+        self.assertEqual(self._merge(3, [("a", "1"), ("c", "3")], [("b", "2")]),
+                         ([("a", "1"), ("b", "2"), ("c", "3")], "c"))
+        self.assertEqual(self._merge(3, [], []), ([], None))
+        # A node that returned limit keys may have more after its last one
+        self.assertEqual(self._merge(3, [("a", "1"), ("c", "3"), ("e", "5")], [("b", "2"), ("f", "6")]),
+                         ([("a", "1"), ("b", "2"), ("c", "3")], "c"))
+        self.assertEqual(self._merge(3, [("a", "1"), ("d", "4"), ("e", "5")], [("b", None), ("c", None), ("f", "6")]),
+                         ([("a", "1"), ("d", "4"), ("e", "5")], "e"))
+        # The replicas of a partition return the same keys
+        self.assertEqual(self._merge(2, [("a", "1"), ("b", "2")], [("a", "1"), ("b", "2")], [("c", "3")]),
+                         ([("a", "1"), ("b", "2")], "b"))
+        # Deleted keys are left out, the page ends at the watermark anyway
+        self.assertEqual(self._merge(3, [("a", None), ("b", None), ("c", "3")], [("d", "4")]),
+                         ([("c", "3")], "c"))
+
+    def _page(self, node, query):
+        response = self._result(self.pool.call(node, "GET", "/store?" + query))
+        self.assertEqual(response.code, 200)
+        return json.loads("".join(response.data))
+
+    def _scan(self, node, query):
+        """Returns the keys of all the pages, and the number of pages"""
+        keys = []
+        pages = 0
+        continuation = None
+        while True:
+            q = query
+            if continuation is not None:
+                q = q + "&continuation=" + urllib.quote(continuation)
+            page = self._page(node, q)
+            pages = pages + 1
+            keys.extend([str(item["key"]) for item in page["items"]])
+            continuation = page.get("continuation")
+            if continuation is None:
+                return keys, pages
+
+    def test_pages(self):
+        nodes = self._cluster(3, Quorum(2, 1, 2), partitions=12)
+        node = nodes[0]
+        expected = ["key_%03d"%i for i in range(0, 100, 3)]
+        for key in expected + ["key_050", "other"]:
+            self.assertEqual(self._result(self.pool.call(node, "PUT", "/store/" + key, key)).code, 200)
+        self.assertEqual(self._result(self.pool.call(node, "DELETE", "/store/key_050")).code, 200)
+        self.assertEqual(len(set([node.ring.key_to_partition(k) for k in expected])) > 4, True)
+        for r in (1, 2):
+            for limit in (1, 4, 7, 100):
+                keys, pages = self._scan(nodes[r], "prefix=key_&limit=%d&r=%d"%(limit, r))
+                self.assertEqual(keys, expected)
+                self.assertTrue(pages >= len(expected) // limit)
+        self.assertEqual(self._scan(node, "start=key_010&end=key_020&limit=2")[0], ["key_012", "key_015", "key_018"])
+        page = self._page(node, "prefix=key_00&limit=2")
+        self.assertEqual([(str(item["key"]), base64.b64decode(item["values"][0])) for item in page["items"]],
+                         [("key_000", "key_000"), ("key_003", "key_003")])
+        self.assertEqual(base64.urlsafe_b64decode(str(page["continuation"])), "key_003")
+        # A node that doesn't answer is replaced by the next replica of its partitions
+        self.pool.down.add(nodes[1].address)
+        self.assertEqual(self._scan(node, "prefix=key_&limit=5")[0], expected)
+        for query in ("limit=0", "r=4", "prefix=a&start=b", "limit=x"):
+            self.assertEqual(self._result(self.pool.call(node, "GET", "/store?" + query)).code, 400)
+
+
+class TestMerkleExchange(NodeTestCase):
+    def _version(self, node, key):
+        vc, value = decode(node.get_storage(key)._store.get(key))
+        if isinstance(value, list):
+            return vc, sorted([str(v) for v in value])
+        return vc, str(value)
+
+    def _exchange(self, node, other, replicated=None):
+        """Exchanges all the partitions of node with other, returns the number of keys sent"""
+        sent = 0
+        for p, storage in sorted(node._storage.items()):
+            d = MerkleExchange(storage, p, other.address, self.pool, 10.0, node.background, replicated).run()
+            sent = sent + self._result(d)
+        return sent
+
+    def test_converge(self):
+        a, b = self._cluster(2, partitions=4)
+        def put(node, key, *clients):
+            vc = vectorclock.VectorClock()
+            for client in clients:
+                vc.increment(client)
+            node.get_storage(key).put(key, encode(vc, "+".join(clients)))
+        for i in range(100):
+            key = "key_%d"%i
+            put(a, key, "x")
+            # The same version (the clocks have timestamps)
+            b.get_storage(key).put(key, a.get_storage(key)._store.get(key))
+        for i in range(100, 110):
+            put(a, "key_%d"%i, "a")
+        for i in range(110, 115):
+            put(b, "key_%d"%i, "b")
+        # Newer on a, and concurrent versions
+        put(a, "key_10", "x", "a")
+        put(a, "key_20", "a")
+        put(b, "key_20", "b")
+        self.assertEqual(len(a._storage), 4)
+
+        self.assertEqual(self._exchange(a, b), 12)
+        self.assertEqual(self._exchange(b, a), 6)
+        for i in range(115):
+            key = "key_%d"%i
+            self.assertEqual(self._version(a, key), self._version(b, key))
+        self.assertEqual(self._version(a, "key_10")[1], "x+a")
+        self.assertEqual(self._version(a, "key_20")[1], ["a", "b"])
+        self.assertEqual(self._version(b, "key_105")[1], "a")
+        # Nothing differs anymore
+        self.assertEqual(self._exchange(a, b), 0)
+        self.assertEqual(self._exchange(b, a), 0)
+
+        # Keys that the other node doesn't replicate aren't sent
+        put(a, "key_200", "a")
+        self.assertEqual(self._exchange(a, b, lambda key, address: False), 0)
+        self.assertRaises(KeyError, self._version, b, "key_200")
+        self.assertEqual(self._exchange(a, b), 1)
+        self.assertEqual(self._version(b, "key_200")[1], "a")
+
+        # The other node has no storage for the partition
+        b._storage.clear()
+        p, storage = a._storage.items()[0]
+        d = MerkleExchange(storage, p, b.address, self.pool, 10.0, a.background).run()
+        errors = []
+        d.add_errback(errors.append)
+        self.assertTrue(errors[0].check(KeyError))
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+The binary format used to store values together with their vector clocks.
+
+An envelope looks like this (all integers are big endian)::
+
+  magic "VZ" | version (1 byte) | flags (1 byte)
+  vector clock: number of entries (2 bytes), then for each entry
+    name type (1 byte) | name length (2 bytes) | name | [port (2 bytes)]
+    timestamp (8 byte double) | counter (8 bytes)
+  value: nothing for deleted values, the raw bytes for a single value,
+    or the number of versions (4 bytes), the length of each (4 bytes) and
+    then the bytes of all the versions, for concurrent versions
+
+A digest of an envelope is its header and vector clock, without the
+value, for comparing versions without sending the values.
+
+If the flags say so, the value bytes are compressed with zlib. Values are
+returned as buffers into the envelope, so decoding doesn't copy them (unless
+they are compressed). Values stored by older versions (bz2 compressed pickles)
+can still be decoded.
+"""
+
+import struct
+import zlib
+import bz2
+import base64
+import cPickle as pickle
+import unittest
+
+import vectorclock
+
+MAGIC = "VZ"
+VERSION = 1
+
+FLAG_ZLIB = 0x01
+KIND_MASK = 0x06
+KIND_NONE = 0x00
+KIND_VALUE = 0x02
+KIND_LIST = 0x04
+
+NAME_STR = 0
+NAME_ADDRESS = 1
+NAME_PICKLE = 2
+
+compress_threshold = 4096
+"""Values at least this large are compressed, None disables compression"""
+compress_level = 1
+
+_header = struct.Struct(">2sBB")
+_count = struct.Struct(">H")
+_name = struct.Struct(">BH")
+_port = struct.Struct(">H")
+_clock = struct.Struct(">dQ")
+_length = struct.Struct(">I")
+
+class InvalidEnvelope(Exception):
+    pass
+
+def encode_vc(vc):
+    """
+    Encodes a vector clock
+
+    @type vc: L{vectorclock.VectorClock}
+    @rtype: str
+    """
+    parts = [_count.pack(len(vc._clocks))]
+    # Sorted, so that equal vector clocks are always encoded the same way
+    for name, (timestamp, counter) in sorted(vc._clocks.items()):
+        if isinstance(name, str):
+            parts.append(_name.pack(NAME_STR, len(name)))
+            parts.append(name)
+        elif isinstance(name, tuple) and len(name) == 2 and isinstance(name[0], str) and isinstance(name[1], int):
+            # Node addresses and client addresses
+            parts.append(_name.pack(NAME_ADDRESS, len(name[0])))
+            parts.append(name[0])
+            parts.append(_port.pack(name[1]))
+        else:
+            p = pickle.dumps(name, pickle.HIGHEST_PROTOCOL)
+            parts.append(_name.pack(NAME_PICKLE, len(p)))
+            parts.append(p)
+        parts.append(_clock.pack(timestamp, counter))
+    return "".join(parts)
+
+def decode_vc(data, offset=0):
+    """
+    Decodes a vector clock encoded by L{encode_vc}
+
+    @param data: str or buffer
+    @param offset: Where in data the vector clock starts
+    @return: tuple of (vectorclock, offset after the vector clock)
+    """
+    clocks = {}
+    try:
+        count, = _count.unpack_from(data, offset)
+        offset += _count.size
+        for i in xrange(count):
+            kind, length = _name.unpack_from(data, offset)
+            offset += _name.size
+            name = data[offset:offset+length]
+            if len(name) != length:
+                raise InvalidEnvelope("Truncated vector clock")
+            offset += length
+            if kind == NAME_ADDRESS:
+                port, = _port.unpack_from(data, offset)
+                offset += _port.size
+                name = (name, port)
+            elif kind == NAME_PICKLE:
+                name = pickle.loads(name)
+            clocks[name] = _clock.unpack_from(data, offset)
+            offset += _clock.size
+    except struct.error, e:
+        raise InvalidEnvelope(str(e))
+    return vectorclock.VectorClock(clocks), offset
+
+def encode(vc, value, threshold=None):
+    """
+    Encodes a vector clock and a value
+
+    @param vc: The vector clock
+    @type vc: L{vectorclock.VectorClock}
+    @param value: None (deleted), a str/buffer or a list of those (concurrent versions)
+    @param threshold: Overrides L{compress_threshold}
+    @rtype: str
+    """
+    if threshold is None:
+        threshold = compress_threshold
+    flags = 0
+    parts = []
+    if value is None:
+        flags = KIND_NONE
+        payload = ""
+    elif isinstance(value, list):
+        flags = KIND_LIST
+        parts.append(_length.pack(len(value)))
+        parts.extend([_length.pack(len(v)) for v in value])
+        payload = "".join([str(v) for v in value])
+    else:
+        flags = KIND_VALUE
+        payload = str(value)
+    if threshold is not None and len(payload) >= threshold:
+        compressed = zlib.compress(payload, compress_level)
+        if len(compressed) < len(payload):
+            flags |= FLAG_ZLIB
+            payload = compressed
+    return "".join([_header.pack(MAGIC, VERSION, flags), encode_vc(vc)] + parts + [payload])
+
+def _flags(blob):
+    """Checks the header of an envelope, and returns its flags"""
+    try:
+        magic, version, flags = _header.unpack_from(blob)
+    except struct.error, e:
+        raise InvalidEnvelope(str(e))
+    if magic != MAGIC or version != VERSION:
+        raise InvalidEnvelope("Unknown envelope %r, version %d"%(magic, version))
+    return flags
+
+def _decode_legacy(blob):
+    return pickle.loads(bz2.decompress(blob))
+
+def decode(blob):
+    """
+    Decodes a vector clock and a value encoded by L{encode}. The value
+    is returned as a buffer (or a list of buffers) into blob.
+
+    @param blob: str or buffer
+    @return: tuple of (vectorclock, value)
+    """
+    if blob[:3] == "BZh":
+        return _decode_legacy(blob)
+    flags = _flags(blob)
+    vc, offset = decode_vc(blob, _header.size)
+    kind = flags & KIND_MASK
+    if kind == KIND_NONE:
+        return vc, None
+    lengths = None
+    if kind == KIND_LIST:
+        try:
+            count, = _length.unpack_from(blob, offset)
+            lengths = struct.unpack_from(">%dI"%count, blob, offset + _length.size)
+        except struct.error, e:
+            raise InvalidEnvelope(str(e))
+        offset += _length.size * (count + 1)
+    if flags & FLAG_ZLIB:
+        blob = zlib.decompress(buffer(blob, offset))
+        offset = 0
+    if lengths is None:
+        return vc, buffer(blob, offset)
+    value = []
+    for length in lengths:
+        value.append(buffer(blob, offset, length))
+        offset += length
+    return vc, value
+
+def digest(blob):
+    """
+    Returns the digest of an envelope encoded by L{encode}
+
+    @param blob: str or buffer
+    @rtype: str
+    """
+    if blob[:3] == "BZh":
+        vc, value = _decode_legacy(blob)
+        kind = KIND_VALUE
+        if value is None:
+            kind = KIND_NONE
+        return _header.pack(MAGIC, VERSION, kind) + encode_vc(vc)
+    flags = _flags(blob)
+    vc, offset = decode_vc(blob, _header.size)
+    return _header.pack(MAGIC, VERSION, flags & KIND_MASK) + blob[_header.size:offset]
+
+def decode_digest(data):
+    """
+    Decodes a digest created by L{digest}
+
+    @return: The vector clock, or None if the value is deleted
+    """
+    flags = _flags(data)
+    if flags & KIND_MASK == KIND_NONE:
+        return None
+    vc, offset = decode_vc(data, _header.size)
+    return vc
+
+def encode_context(vc):
+    """Encodes a vector clock as a context for the clients"""
+    return base64.b64encode(encode_vc(vc))
+
+def decode_context(context):
+    """Decodes a context created by L{encode_context}, or an old style context"""
+    data = base64.b64decode(context)
+    if data[:3] == "BZh":
+        return _decode_legacy(data)
+    vc, offset = decode_vc(data)
+    if offset != len(data):
+        raise InvalidEnvelope("Trailing data in context")
+    return vc
+
+
+class TestEnvelope(unittest.TestCase):
+    def _vc(self):
+        vc = vectorclock.VectorClock()
+        vc.increment("client")
+        vc.increment(("127.0.0.1", 8080))
+        vc.increment(("127.0.0.1", 8080))
+        return vc
+
+    def test_roundtrip(self):
+        vc = self._vc()
+        vc2, value = decode(encode(vc, "value"))
+        self.assertEqual(vc2, vc)
+        self.assertEqual(vc2._clocks, vc._clocks)
+        self.assertTrue(isinstance(value, buffer))
+        self.assertEqual(str(value), "value")
+
+    def test_deleted(self):
+        vc = self._vc()
+        vc2, value = decode(encode(vc, None))
+        self.assertEqual(vc2, vc)
+        self.assertEqual(value, None)
+
+    def test_empty_value(self):
+        vc2, value = decode(encode(self._vc(), ""))
+        self.assertEqual(str(value), "")
+
+    def test_concurrent(self):
+        versions = ["a", "", "b"*10000, buffer("xcx", 1, 1)]
+        vc2, value = decode(encode(self._vc(), versions))
+        self.assertEqual([str(v) for v in value], ["a", "", "b"*10000, "c"])
+
+    def test_compressed(self):
+        vc = self._vc()
+        blob = encode(vc, "a"*10000, 100)
+        self.assertTrue(len(blob) < 1000)
+        vc2, value = decode(blob)
+        self.assertEqual(str(value), "a"*10000)
+        blob = encode(vc, "a"*10000, 20000)
+        self.assertTrue(len(blob) > 10000)
+
+    def test_buffer_input(self):
+        blob = encode(self._vc(), "value")
+        vc2, value = decode(buffer("xx" + blob, 2))
+        self.assertEqual(str(value), "value")
+
+    def test_other_names(self):
+        vc = vectorclock.VectorClock()
+        vc.increment(("a", "b", 1))
+        vc2, value = decode(encode(vc, "value"))
+        self.assertEqual(vc2, vc)
+
+    def test_legacy(self):
+        vc = self._vc()
+        blob = bz2.compress(pickle.dumps((vc, "value")))
+        vc2, value = decode(blob)
+        self.assertEqual(vc2, vc)
+        self.assertEqual(value, "value")
+
+    def test_context(self):
+        vc = self._vc()
+        self.assertEqual(decode_context(encode_context(vc)), vc)
+        legacy = base64.b64encode(bz2.compress(pickle.dumps(vc)))
+        self.assertEqual(decode_context(legacy), vc)
+
+    def test_digest(self):
+        vc = self._vc()
+        for value in ("value", ["a", "b"], "a"*10000):
+            d = digest(encode(vc, value, 100))
+            self.assertEqual(len(d), len(encode(vc, None)))
+            self.assertEqual(decode_digest(d), vc)
+        self.assertEqual(decode_digest(digest(encode(vc, None))), None)
+        legacy = bz2.compress(pickle.dumps((vc, "value")))
+        self.assertEqual(decode_digest(digest(legacy)), vc)
+        self.assertEqual(decode_digest(digest(buffer("xx" + encode(vc, "value"), 2))), vc)
+        self.assertRaises(InvalidEnvelope, digest, "garbage")
+
+    def test_invalid(self):
+        self.assertRaises(InvalidEnvelope, decode, "garbage")
+        self.assertRaises(InvalidEnvelope, decode, encode(self._vc(), "value")[:10])
+        self.assertRaises(InvalidEnvelope, decode_context, base64.b64encode("garbage"))
+
+if __name__=="__main__":
+    unittest.main()
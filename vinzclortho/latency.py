@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Tracking of how fast the other nodes answer reads, so that reads can go to
+the fastest replicas first, and to the others only when they are late.
+"""
+
+import collections
+import time
+import unittest
+
+import tangled.core as tc
+
+class ReplicaLatency(object):
+    """
+    Node wide statistics of the reads from other nodes.
+
+    Each node has an exponentially weighted moving average (EWMA) of the
+    latency of its reads, and of the number of reads in flight to it when a
+    read is started. Replicas are ranked by latency * (1 + in flight), the
+    local storage and nodes that haven't been read from yet first.
+
+    The hedge delay, how long to wait for the first replicas before reading
+    from the others, is the L{percentile} of the latency of the last
+    L{window} reads from all nodes.
+
+    @param clock: Returns the current time, for tests
+    """
+    alpha = 0.2
+    """The weight of a new sample in the EWMAs"""
+    window = 256
+    percentile = 0.95
+    min_hedge_delay = 0.002
+    default_hedge_delay = 0.05
+    """The hedge delay until there are samples"""
+    failure_latency = 1.0
+    """The latency counted for a read that failed (but not for a key that wasn't found)"""
+    max_in_flight = 16
+    """More reads in flight than this to a node, and it's L{overloaded}"""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.hedges = 0
+        self.digests = 0
+        self._latency = {}
+        self._load = {}
+        self._in_flight = {}
+        self._samples = collections.deque(maxlen=self.window)
+        self._new_samples = 0
+        self._hedge_delay = None
+
+    def _ewma(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.alpha * (sample - average)
+
+    def start(self, address):
+        """Returns the start time to pass to L{done} when the read from address is done"""
+        in_flight = self._in_flight.get(address, 0)
+        self._load[address] = self._ewma(self._load.get(address), in_flight)
+        self._in_flight[address] = in_flight + 1
+        return self.clock()
+
+    def done(self, address, started, result):
+        """A callback/errback for the read started at started, that returns result"""
+        self._in_flight[address] = self._in_flight[address] - 1
+        latency = self.clock() - started
+        if isinstance(result, tc.Failure) and not result.check(KeyError):
+            latency = max(latency, self.failure_latency)
+        else:
+            self._samples.append(latency)
+            self._new_samples = self._new_samples + 1
+        self._latency[address] = self._ewma(self._latency.get(address), latency)
+        return result
+
+    def score(self, address):
+        """Lower is better, address is None for the local storage"""
+        if address is None:
+            return -1.0
+        return self._latency.get(address, 0.0) * (1 + self._load.get(address, 0.0))
+
+    def overloaded(self, address):
+        """Returns True if optional reads (digests) shouldn't be sent to address"""
+        return self._in_flight.get(address, 0) >= self.max_in_flight
+
+    def rank(self, replicas):
+        """Returns the replicas sorted by L{score}, the fastest first"""
+        return sorted(replicas, key=lambda r: self.score(getattr(r, "address", None)))
+
+    def hedge_delay(self):
+        """Returns the seconds to wait for the first replicas before reading from the others"""
+        # Sorting the window for each read would cost more than the read
+        if self._hedge_delay is None or self._new_samples >= self.window // 8:
+            self._new_samples = 0
+            if not self._samples:
+                return self.default_hedge_delay
+            samples = sorted(self._samples)
+            index = min(len(samples) - 1, int(len(samples) * self.percentile))
+            self._hedge_delay = max(self.min_hedge_delay, samples[index])
+        return self._hedge_delay
+
+    def stats(self):
+        """Returns a dict of the counters, and the latency (in microseconds) and load of each node"""
+        stats = {"hedge_delay_us": int(self.hedge_delay() * 1000000),
+                 "hedges": self.hedges,
+                 "digests": self.digests}
+        for address, latency in self._latency.items():
+            name = "%s:%d"%address
+            stats[name + " latency_us"] = int(latency * 1000000)
+            stats[name + " in_flight"] = self._in_flight[address]
+        return stats
+
+
+class TestReplicaLatency(unittest.TestCase):
+    class Replica(object):
+        def __init__(self, address=None):
+            self.address = address
+
+    def setUp(self):
+        self.now = 1000.0
+        self.latency = ReplicaLatency(lambda: self.now)
+
+    def read(self, address, latency, result="value"):
+        started = self.latency.start(address)
+        self.now = self.now + latency
+        return self.latency.done(address, started, result)
+
+    def test_rank(self):
+        a, b, c = [self.Replica(("a", i)) for i in range(3)]
+        local = self.Replica()
+        self.read(a.address, 0.010)
+        self.read(b.address, 0.001)
+        self.assertEqual(self.latency.rank([a, b, local]), [local, b, a])
+        # Not read from yet
+        self.assertEqual(self.latency.rank([a, b, c]), [c, b, a])
+        for i in range(20):
+            self.read(b.address, 0.100)
+        self.assertEqual(self.latency.rank([a, b]), [a, b])
+
+    def test_load(self):
+        a, b = [self.Replica(("a", i)) for i in range(2)]
+        self.read(a.address, 0.010)
+        self.read(b.address, 0.010)
+        for i in range(10):
+            self.latency.start(a.address)
+        self.latency.start(a.address)
+        self.assertEqual(self.latency.rank([a, b]), [b, a])
+        self.assertEqual(self.latency.stats()["a:0 in_flight"], 11)
+        self.assertFalse(self.latency.overloaded(a.address))
+        for i in range(ReplicaLatency.max_in_flight):
+            self.latency.start(a.address)
+        self.assertTrue(self.latency.overloaded(a.address))
+        self.assertFalse(self.latency.overloaded(b.address))
+
+    def test_failure(self):
+        a, b = [self.Replica(("a", i)) for i in range(2)]
+        self.read(a.address, 0.010)
+        self.read(b.address, 0.001, tc.Failure(KeyError()))
+        self.assertEqual(self.latency.rank([a, b]), [b, a])
+        failure = tc.Failure(IOError())
+        self.assertTrue(self.read(b.address, 0.001, failure) is failure)
+        self.assertEqual(self.latency.rank([a, b]), [a, b])
+
+    def test_hedge_delay(self):
+        self.assertEqual(self.latency.hedge_delay(), ReplicaLatency.default_hedge_delay)
+        for i in range(100):
+            self.read(("a", 0), 0.001 * (i + 1))
+        self.assertAlmostEqual(self.latency.hedge_delay(), 0.096)
+        # Not recomputed for every sample
+        self.read(("a", 0), 10.0)
+        self.assertAlmostEqual(self.latency.hedge_delay(), 0.096)
+        for i in range(ReplicaLatency.window):
+            self.read(("a", 0), 0.0001)
+        self.assertEqual(self.latency.hedge_delay(), ReplicaLatency.min_hedge_delay)
+
+if __name__=="__main__":
+    unittest.main()
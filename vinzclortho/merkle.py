@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2001-2010 Pär Bohrarper.
+# See LICENSE for details.
+
+"""
+Merkle trees used to find the keys that differ between two replicas of a
+partition, without comparing all the keys.
+
+The keys are hashed into a fixed number of buckets, the leaves of the tree.
+The hash of a leaf is the xor of the hashes of its key/value pairs, so it can
+be updated incrementally when a single key changes. The inner nodes are the
+md5 of their two children, and are recomputed lazily when they're asked for.
+"""
+
+import hashlib
+import binascii
+import unittest
+
+DEPTH = 10
+"""The default depth, which gives 1024 buckets"""
+
+class MerkleTree(object):
+    """
+    A Merkle tree over the key/value pairs of a partition. Level 0 is the
+    root, and level L{depth} are the leaves.
+
+    The tree keeps the hash of each key/value pair, so that a pair can be
+    replaced without knowing the old value.
+    """
+    def __init__(self, depth=DEPTH):
+        self.depth = depth
+        size = 1 << depth
+        self._items = [{} for i in xrange(size)]
+        self._leaves = [0L] * size
+        self._dirty = set()
+        # All levels, the leaves (as digests) last
+        self._levels = [[self._digest(0L)] * size]
+        for level in xrange(depth):
+            below = self._levels[0]
+            self._levels.insert(0, [self._parent(below, i) for i in xrange(len(below) // 2)])
+
+    def _digest(self, leaf):
+        return binascii.unhexlify("%032x"%leaf)
+
+    def _parent(self, below, index):
+        return hashlib.md5(below[2 * index] + below[2 * index + 1]).digest()
+
+    def bucket(self, key):
+        """Returns the leaf that key belongs to"""
+        return int(hashlib.md5(key).hexdigest()[:8], 16) >> (32 - self.depth)
+
+    def update(self, key, value):
+        """Adds or replaces a key/value pair"""
+        h = hashlib.md5(key)
+        h.update("\0")
+        h.update(value)
+        item = long(h.hexdigest(), 16)
+        b = self.bucket(key)
+        items = self._items[b]
+        old = items.get(key)
+        if old == item:
+            return
+        if old is not None:
+            self._leaves[b] ^= old
+        items[key] = item
+        self._leaves[b] ^= item
+        self._dirty.add(b)
+
+    def remove(self, key):
+        """Removes a key, if present"""
+        b = self.bucket(key)
+        old = self._items[b].pop(key, None)
+        if old is not None:
+            self._leaves[b] ^= old
+            self._dirty.add(b)
+
+    def _refresh(self):
+        if not self._dirty:
+            return
+        dirty = self._dirty
+        self._dirty = set()
+        leaves = self._levels[self.depth]
+        for b in dirty:
+            leaves[b] = self._digest(self._leaves[b])
+        for level in xrange(self.depth - 1, -1, -1):
+            dirty = set([i // 2 for i in dirty])
+            below = self._levels[level + 1]
+            nodes = self._levels[level]
+            for i in dirty:
+                nodes[i] = self._parent(below, i)
+
+    def level(self, level, nodes=None):
+        """
+        Returns the digests of a level of the tree
+
+        @param nodes: The indexes of the nodes wanted, or None for all
+        @return: list of 16 byte digests
+        """
+        self._refresh()
+        digests = self._levels[level]
+        if nodes is None:
+            return list(digests)
+        return [digests[i] for i in nodes]
+
+    def keys(self, buckets):
+        """Returns the keys in the buckets"""
+        keys = []
+        for b in buckets:
+            keys.extend(self._items[b].keys())
+        return keys
+
+    def __len__(self):
+        return sum([len(items) for items in self._items])
+
+
+def children(nodes, levels):
+    """
+    Returns the indexes of the descendants of nodes, levels further down the tree
+
+    @param nodes: Indexes of nodes at some level
+    """
+    width = 1 << levels
+    result = []
+    for n in nodes:
+        result.extend(range(n * width, (n + 1) * width))
+    return result
+
+def differing(nodes, local, remote):
+    """
+    Returns the nodes whose digests differ
+
+    @param nodes: The indexes of the nodes
+    @param local: The local digests of the nodes
+    @param remote: The remote digests of the nodes
+    """
+    return [n for n, l, r in zip(nodes, local, remote) if l != r]
+
+
+class TestMerkleTree(unittest.TestCase):
+    def _fill(self, tree, n):
+        for i in range(n):
+            tree.update("key_%d"%i, "value_%d"%i)
+
+    def test_equal(self):
+        a = MerkleTree(6)
+        b = MerkleTree(6)
+        self.assertEqual(a.level(0), b.level(0))
+        self._fill(a, 100)
+        # Insertion order doesn't matter
+        for i in reversed(range(100)):
+            b.update("key_%d"%i, "value_%d"%i)
+        self.assertEqual(a.level(0), b.level(0))
+        self.assertEqual(a.level(6), b.level(6))
+
+    def test_incremental(self):
+        a = MerkleTree(6)
+        b = MerkleTree(6)
+        self._fill(a, 100)
+        self._fill(b, 100)
+        a.update("key_5", "changed")
+        self.assertNotEqual(a.level(0), b.level(0))
+        a.update("key_5", "value_5")
+        self.assertEqual(a.level(0), b.level(0))
+        a.update("extra", "value")
+        a.remove("extra")
+        a.remove("missing")
+        self.assertEqual(a.level(0), b.level(0))
+        self.assertEqual(len(a), 100)
+
+    def test_find_difference(self):
+        a = MerkleTree(6)
+        b = MerkleTree(6)
+        self._fill(a, 100)
+        self._fill(b, 100)
+        b.update("key_42", "changed")
+        b.remove("key_7")
+        nodes = [0]
+        level = 0
+        while level < 6:
+            nodes = differing(nodes, a.level(level, nodes), b.level(level, nodes))
+            step = min(3, 6 - level)
+            nodes = children(nodes, step)
+            level += step
+        nodes = differing(nodes, a.level(level, nodes), b.level(level, nodes))
+        self.assertTrue(len(nodes) <= 2)
+        keys = a.keys(nodes)
+        self.assertTrue("key_42" in keys and "key_7" in keys)
+        self.assertTrue(len(keys) < 10)
+
+if __name__=="__main__":
+    unittest.main()
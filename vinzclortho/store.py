@@ -3,25 +3,71 @@
 # Copyright (c) 2001-2010 Pär Bohrarper.
 # See LICENSE for details.
 
+import os
+import bisect
 import sqlite3
 import bsddb
+import mmap
+import struct
+import zlib
+import shutil
+import tempfile
 import unittest
 
+SYNC = "sync"
+"""Every write is made durable before it returns"""
+GROUP = "group"
+"""Writes are made durable in batches by L{Store.sync}, see L{GroupCommit}"""
+BUFFERED = "buffered"
+"""Writes are left to the OS, and made durable every now and then by L{Store.sync}"""
+DURABILITY_MODES = (SYNC, GROUP, BUFFERED)
+
 class Store(object):
     """Base class for stores."""
+    durability = SYNC
+
     def put(self, key, value):
         raise NotImplementedError
 
     def get(self, key):
         raise NotImplementedError
 
+    def get_file_region(self, key, min_size=0):
+        """
+        Returns (file, offset, size) of the value of key in one of the
+        files of the store, so that it can be sent without reading it into
+        memory. The file is opened for the caller, who closes it.
+
+        @return: None if the value is smaller than min_size, or if the store
+        doesn't keep the values in plain files
+        """
+        return None
+
     def delete(self, key):
         raise NotImplementedError
 
-    def get_iterator(self):
+    def sync(self):
+        """Makes the writes so far durable. Only needed unless the durability is L{SYNC}."""
+        pass
+
+    def merge(self, force=False):
+        """
+        Reclaims the space used by overwritten and deleted values, for stores
+        that need that. This can take a while.
+
+        @param force: Merge even if there isn't much to reclaim
+        @return: True if anything was merged
+        """
+        return False
+
+    def get_iterator(self, start=None, ordered=False):
         """
         Does not need to return an actual iterator, 
         just something that L{iterate} can recognize.
+
+        @param start: If given, the iteration starts with the first key after start
+        @param ordered: If the keys must come in order, which they always do if start
+        is given. An ordered iteration can be resumed from the last key seen.
         """  
         raise NotImplementedError
 
@@ -34,24 +80,193 @@ class Store(object):
         """
         raise NotImplementedError
 
-    def multi_put(self, kvlist, resolver):
-        for k, v in kvlist:
+    def scan(self, start=None, end=None, limit=None, inclusive=True, threshold=65536):
+        """
+        Returns the key/value tuples of the keys from start up to end (not
+        included), in order
+
+        @param start: The first key, None to start with the first key of the store
+        @param end: None to go on to the last key of the store
+        @param limit: The maximum number of keys, None for no limit
+        @param inclusive: If start itself is included
+        @param threshold: How many bytes to read at a time, see L{iterate}
+        """
+        kvlist = []
+        if start is not None and inclusive and (end is None or start < end):
+            try:
+                kvlist.append((start, self.get(start)))
+            except KeyError:
+                pass
+        iterator = self.get_iterator(start, ordered=True)
+        while limit is None or len(kvlist) < limit:
+            chunk, iterator = self.iterate(iterator, threshold)
+            if not chunk:
+                break
+            for k, v in chunk:
+                if isinstance(k, unicode):
+                    k = k.encode("utf-8")
+                if end is not None and k >= end:
+                    return kvlist
+                kvlist.append((k, v))
+                if len(kvlist) == limit:
+                    break
+        return kvlist
+
+    def multi_get(self, keys):
+        """
+        Returns the key/value tuples of the keys that are in the store
+
+        @param keys: list of keys
+        """
+        kvlist = []
+        for k in keys:
             try:
-                v_curr = self.get(k)
-                v = resolver(v, v_curr)
+                kvlist.append((k, self.get(k)))
             except KeyError:
-                # This store doesn't have the key, no need to resolve
                 pass
+        return kvlist
+
+    def multi_put(self, kvlist, resolver=None):
+        """
+        Puts the key/value tuples. If resolver is given, it's called with the
+        new and the current value of keys that are in the store already, and
+        what it returns is put instead.
+        """
+        for k, v in kvlist:
+            if resolver is not None:
+                try:
+                    v_curr = self.get(k)
+                    v = resolver(v, v_curr)
+                except KeyError:
+                    # This store doesn't have the key, no need to resolve
+                    pass
             # TODO: probably should check if the value was changed...
             self.put(k, v)
 
+    def delete_unchanged(self, kvlist):
+        """
+        Deletes the keys that still have the given values. Keys that have been
+        changed or deleted since are left alone.
+
+        @param kvlist: list of key/value tuples
+        @return: The number of keys deleted
+        """
+        deleted = 0
+        for k, v in kvlist:
+            try:
+                if str(self.get(k)) != str(v):
+                    continue
+                self.delete(k)
+                deleted = deleted + 1
+            except KeyError:
+                pass
+        return deleted
+
+
+class GroupCommit(object):
+    """
+    Book-keeping for group commit. Writes that have been executed, but are
+    not durable yet, wait here for the next L{Store.sync}. The batch is
+    synced when it has been open for window seconds, or when it reaches
+    max_batch writes, whichever comes first.
+
+    @param window: The longest time (in seconds) a write waits for the sync
+    @param max_batch: The number of writes that triggers a sync immediately
+    """
+    def __init__(self, window=0.002, max_batch=128):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.batch = 0
+        self.syncs = 0
+        self.writes = 0
+
+    def add(self, waiter):
+        """
+        Adds a write to the open batch
+
+        @return: True if this opened a new batch (so the caller should schedule the sync)
+        """
+        self.pending.append(waiter)
+        self.writes = self.writes + 1
+        return len(self.pending) == 1
+
+    def full(self):
+        return len(self.pending) >= self.max_batch
+
+    def take(self):
+        """Closes the open batch and returns its writes"""
+        pending = self.pending
+        self.pending = []
+        self.batch = self.batch + 1
+        if pending:
+            self.syncs = self.syncs + 1
+        return pending
+
+
+class SortedKeys(object):
+    """
+    The keys of a store in order, for the ordered iterations of the stores
+    that don't keep them in order. It's built when it's first needed, and
+    after that the store tells it about the keys it adds and removes.
+    """
+    def __init__(self):
+        self._keys = None
+        self._changes = 0
+
+    def __len__(self):
+        return len(self._keys or ())
+
+    def add(self, key):
+        """Adds a key that wasn't in the store"""
+        if self._keys is not None:
+            bisect.insort(self._keys, key)
+            self._changes = self._changes + 1
+
+    def remove(self, key):
+        if self._keys is not None:
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+                self._changes = self._changes + 1
+
+    def after(self, keys, start=None):
+        """
+        Returns an iterator over the keys after start (all of them if None),
+        in order. Keys that are added after the current one during the
+        iteration are included.
+
+        @param keys: All the keys of the store, to build the index from if needed
+        """
+        if self._keys is None:
+            self._keys = sorted(keys)
+        return self._iter(start)
+
+    def _iter(self, start):
+        keys = self._keys
+        i = 0
+        if start is not None:
+            i = bisect.bisect_right(keys, start)
+        while i < len(keys):
+            key = keys[i]
+            changes = self._changes
+            yield key
+            if changes == self._changes:
+                i = i + 1
+            else:
+                # Keys have been added or removed in the meantime, find it again
+                i = bisect.bisect_right(keys, key)
+
 
 class DictStore(Store):
     """Basic in-memory store."""
     def __init__(self):
         self._store = {}
+        self._index = SortedKeys()
 
     def put(self, key, value):
+        if key not in self._store:
+            self._index.add(key)
         self._store[key] = value
 
     def get(self, key):
@@ -59,9 +274,20 @@ class DictStore(Store):
 
     def delete(self, key):
         del self._store[key]
+        self._index.remove(key)
 
-    def get_iterator(self):
-        return self._store.iteritems()
+    def get_iterator(self, start=None, ordered=False):
+        if start is None and not ordered:
+            return self._store.iteritems()
+        return self._iter_from(self._index.after(self._store, start))
+
+    def _iter_from(self, keys):
+        for k in keys:
+            try:
+                yield k, self._store[k]
+            except KeyError:
+                # Deleted since the iteration started
+                pass
 
     def iterate(self, iterator, threshold):
         tot = 0
@@ -77,49 +303,81 @@ class DictStore(Store):
 
 class BerkeleyDBStore(Store):
     """Store using BerkeleyDB, specifically the B-Tree version"""
-    def __init__(self, filename):
+    def __init__(self, filename, durability=SYNC):
         self._store = bsddb.btopen(filename)
+        self.durability = durability
 
     def put(self, key, value):
         self._store[key] = value
-        self._store.sync()
+        if self.durability == SYNC:
+            self._store.sync()
 
     def get(self, key):
         return self._store[key]
 
     def delete(self, key):
         del self._store[key]
+        if self.durability == SYNC:
+            self._store.sync()
+
+    def multi_put(self, kvlist, resolver=None):
+        for k, v in kvlist:
+            if resolver is not None and self._store.has_key(k):
+                v = resolver(v, self._store[k])
+            self._store[k] = v
+        if self.durability == SYNC:
+            self._store.sync()
+
+    def sync(self):
         self._store.sync()
 
-    def get_iterator(self):
+    def get_iterator(self, start=None, ordered=False):
+        # A B-Tree is always in order
         try:
-            k, v = self._store.first()
+            if start is None:
+                k, v = self._store.first()
+            else:
+                # Positions at the smallest key >= start
+                k, v = self._store.set_location(start)
+                if k == start:
+                    k, v = self._store.next()
             return k
-        except bsddb.error:
+        except (bsddb.error, KeyError):
             return None
 
     def iterate(self, iterator, threshold):
+        # The iterator is the first key that hasn't been returned yet
         if iterator is None:
             return [], None
-        iterator, v = self._store.set_location(iterator)
         tot = 0
-        ret = [(iterator, v)]
+        ret = []
         try:
-            while tot < threshold:
-                iterator, v = self._store.next()
-                tot = tot + len(iterator) + len(v)
-                ret.append((iterator, v))
-            return ret, iterator
-        except bsddb.error:
+            k, v = self._store.set_location(iterator)
+            while True:
+                tot = tot + len(k) + len(v)
+                ret.append((k, v))
+                k, v = self._store.next()
+                if tot >= threshold:
+                    return ret, k
+        except (bsddb.error, KeyError):
             return ret, None
 
 
 class SQLiteStore(Store):
-    """Store that uses SQLite for storage."""
-    def __init__(self, filename):
+    """
+    Store that uses SQLite for storage. Unless the durability is L{SYNC},
+    the writes are collected in a transaction that is committed by L{sync}.
+    """
+    max_parameters = 500
+    def __init__(self, filename, durability=SYNC):
         self._db = filename
-        self.conn = sqlite3.connect(self._db)
+        self.durability = durability
+        # Created by one thread, but only used by the worker of the partition
+        self.conn = sqlite3.connect(self._db, check_same_thread=False)
         c = self.conn.cursor()
+        if durability == BUFFERED:
+            # Let the OS decide when the data hits the disk
+            c.execute("PRAGMA synchronous=OFF")
         # Create table
         c.execute("CREATE TABLE IF NOT EXISTS blobkey(k BLOB PRIMARY KEY, v BLOB)")
         self.conn.commit()
@@ -128,7 +386,8 @@ class SQLiteStore(Store):
     def put(self, key, value):
         c = self.conn.cursor()
         c.execute("INSERT OR REPLACE INTO blobkey(k, v) VALUES(?, ?)", (key, sqlite3.Binary(value)))
-        self.conn.commit()
+        if self.durability == SYNC:
+            self.conn.commit()
         c.close()
 
     def get(self, key):
@@ -140,18 +399,56 @@ class SQLiteStore(Store):
             raise KeyError(key)
         return value[0]
 
+    def multi_get(self, keys):
+        kvlist = []
+        c = self.conn.cursor()
+        # Stay below the limit on the number of parameters of a statement
+        for i in range(0, len(keys), self.max_parameters):
+            chunk = keys[i:i+self.max_parameters]
+            c.execute("SELECT k, v FROM blobkey WHERE k IN (%s)"%",".join("?" * len(chunk)), chunk)
+            for k, v in c.fetchall():
+                # Keys come back as unicode
+                if isinstance(k, unicode):
+                    k = k.encode("utf-8")
+                kvlist.append((k, v))
+        c.close()
+        return kvlist
+
+    def multi_put(self, kvlist, resolver=None):
+        c = self.conn.cursor()
+        for k, v in kvlist:
+            if resolver is not None:
+                c.execute("SELECT v FROM blobkey WHERE k = ?", (k,))
+                row = c.fetchone()
+                if row is not None:
+                    v = resolver(v, row[0])
+            c.execute("INSERT OR REPLACE INTO blobkey(k, v) VALUES(?, ?)", (k, sqlite3.Binary(v)))
+        # One commit for all of them
+        if self.durability == SYNC:
+            self.conn.commit()
+        c.close()
+
     def delete(self, key):
         c = self.conn.cursor()
         c.execute("DELETE FROM blobkey WHERE k = ?", (key,))
-        self.conn.commit()
+        if self.durability == SYNC:
+            self.conn.commit()
         rows = c.rowcount
         c.close()
         if rows == 0:
             raise KeyError
 
-    def get_iterator(self):
+    def sync(self):
+        self.conn.commit()
+
+    def get_iterator(self, start=None, ordered=False):
         c = self.conn.cursor()
-        c.execute("SELECT k, v FROM blobkey")
+        if start is None and not ordered:
+            c.execute("SELECT k, v FROM blobkey")
+        elif start is None:
+            c.execute("SELECT k, v FROM blobkey ORDER BY k")
+        else:
+            c.execute("SELECT k, v FROM blobkey WHERE k > ? ORDER BY k", (start,))
         return c
 
     def iterate(self, iterator, threshold):
@@ -166,6 +463,377 @@ class SQLiteStore(Store):
         except StopIteration:
             return ret, iterator
 
+class LogStore(Store):
+    """
+    Log-structured store, modeled on Bitcask. Writes are appended to segment
+    files, and an in-memory key directory maps each key to the segment, offset
+    and size of its latest value. Overwritten and deleted values are removed
+    by L{merge}, which rewrites the live values of the closed segments into one.
+
+    Each closed segment has a hint file with the key directory entries of the
+    segment, so opening the store doesn't have to read the values. The active
+    segment is scanned instead, and a torn record at its end is cut off.
+
+    A record is: crc32 (4 bytes), key length (4 bytes), value length (4 bytes,
+    -1 for deletes), key, value. A hint entry is: key length, value offset,
+    value length, key.
+
+    @param directory: The directory of the segments, created if needed
+    """
+    max_segment_size = 64 * 1048576
+    merge_threshold = 0.5
+    """Merge when at least this fraction of the closed segments is garbage"""
+    _record = struct.Struct(">IIi")
+    _hint = struct.Struct(">IIi")
+
+    def __init__(self, directory, durability=SYNC):
+        self.directory = directory
+        self.durability = durability
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._keydir = {}
+        self._index = SortedKeys()
+        self._sizes = {}
+        self._dead = {}
+        self._maps = {}
+        self._active = None
+        segments = self._segments()
+        for file_id in segments:
+            self._load(file_id)
+        # Never append to old segments, just start a new one
+        self._open_active((segments and segments[-1] + 1) or 0)
+
+    def _path(self, file_id, ext):
+        return os.path.join(self.directory, "%09d.%s"%(file_id, ext))
+
+    def _segments(self):
+        """Returns the ids of the segments, after cleaning up after interrupted merges"""
+        names = os.listdir(self.directory)
+        merged = [int(n.split(".")[0]) for n in names if n.endswith(".merged")]
+        for file_id in merged:
+            # A committed merge that was interrupted before its files were moved into place
+            for ext in ("data", "hint"):
+                if os.path.exists(self._path(file_id, ext + ".tmp")):
+                    os.rename(self._path(file_id, ext + ".tmp"), self._path(file_id, ext))
+        names = os.listdir(self.directory)
+        for n in names:
+            file_id = int(n.split(".")[0])
+            if n.endswith(".tmp") or (merged and file_id < max(merged)):
+                # Superseded by a merged segment
+                os.remove(os.path.join(self.directory, n))
+        return sorted([int(n.split(".")[0]) for n in os.listdir(self.directory) if n.endswith(".data")])
+
+    def _load(self, file_id):
+        if os.path.exists(self._path(file_id, "hint")):
+            entries = self._read_hint(file_id)
+        else:
+            entries = self._scan(file_id)
+            if not entries:
+                os.remove(self._path(file_id, "data"))
+                return
+            self._write_hint(file_id, entries)
+        self._sizes[file_id] = os.path.getsize(self._path(file_id, "data"))
+        for key, offset, size in entries:
+            self._apply(key, file_id, offset, size)
+
+    def _scan(self, file_id):
+        """Reads the key directory entries from a segment, and truncates a torn record at the end"""
+        entries = []
+        f = open(self._path(file_id, "data"), "r+b")
+        try:
+            good = 0
+            while True:
+                header = f.read(self._record.size)
+                if len(header) < self._record.size:
+                    break
+                crc, keylen, size = self._record.unpack(header)
+                key = f.read(keylen)
+                value = f.read(max(size, 0))
+                if len(key) != keylen or len(value) != max(size, 0) or \
+                        zlib.crc32(value, zlib.crc32(key)) & 0xffffffff != crc:
+                    break
+                entries.append((key, good + self._record.size + keylen, size))
+                good = f.tell()
+            f.truncate(good)
+        finally:
+            f.close()
+        return entries
+
+    def _read_hint(self, file_id):
+        entries = []
+        f = open(self._path(file_id, "hint"), "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        pos = 0
+        while pos < len(data):
+            keylen, offset, size = self._hint.unpack_from(data, pos)
+            pos += self._hint.size
+            entries.append((data[pos:pos+keylen], offset, size))
+            pos += keylen
+        return entries
+
+    def _write_hint(self, file_id, entries, ext="hint"):
+        tmp = self._path(file_id, "hint.tmp")
+        f = open(tmp, "wb")
+        try:
+            for key, offset, size in entries:
+                f.write(self._hint.pack(len(key), offset, size))
+                f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if ext != "hint.tmp":
+            os.rename(tmp, self._path(file_id, ext))
+
+    def _sync_directory(self):
+        """Makes the creation, renaming and removal of files durable"""
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _apply(self, key, file_id, offset, size):
+        """Updates the key directory, and the garbage accounting, with a record"""
+        old = self._keydir.get(key)
+        if old is not None:
+            self._dead[old[0]] = self._dead.get(old[0], 0) + self._record.size + len(key) + old[2]
+        if size < 0:
+            if old is not None:
+                del self._keydir[key]
+                self._index.remove(key)
+            self._dead[file_id] = self._dead.get(file_id, 0) + self._record.size + len(key)
+        else:
+            if old is None:
+                self._index.add(key)
+            self._keydir[key] = (file_id, offset, size)
+
+    def _open_active(self, file_id):
+        self._active_id = file_id
+        self._active = open(self._path(file_id, "data"), "ab")
+        self._reader = open(self._path(file_id, "data"), "rb")
+        self._offset = 0
+        self._entries = []
+        self._unflushed = False
+        self._sizes[file_id] = 0
+
+    def _rotate(self):
+        """Closes the active segment and starts a new one"""
+        self.sync()
+        self._active.close()
+        self._reader.close()
+        self._write_hint(self._active_id, self._entries)
+        self._open_active(self._active_id + 1)
+
+    def _append(self, key, value):
+        if value is None:
+            value = ""
+            size = -1
+        else:
+            size = len(value)
+        crc = zlib.crc32(value, zlib.crc32(key)) & 0xffffffff
+        self._active.write(self._record.pack(crc, len(key), size))
+        self._active.write(key)
+        self._active.write(value)
+        offset = self._offset + self._record.size + len(key)
+        self._offset = offset + len(value)
+        self._sizes[self._active_id] = self._offset
+        self._unflushed = True
+        self._entries.append((key, offset, size))
+        self._apply(key, self._active_id, offset, size)
+        if self._offset >= self.max_segment_size:
+            self._rotate()
+
+    def _map(self, file_id):
+        try:
+            return self._maps[file_id]
+        except KeyError:
+            f = open(self._path(file_id, "data"), "rb")
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self._maps[file_id] = m
+            return m
+
+    def _read(self, file_id, offset, size):
+        if file_id != self._active_id:
+            return self._map(file_id)[offset:offset+size]
+        if self._unflushed:
+            self._active.flush()
+            self._unflushed = False
+        self._reader.seek(offset)
+        return self._reader.read(size)
+
+    def put(self, key, value):
+        self._append(key, value)
+        if self.durability == SYNC:
+            self.sync()
+
+    def get(self, key):
+        file_id, offset, size = self._keydir[key]
+        return self._read(file_id, offset, size)
+
+    def get_file_region(self, key, min_size=0):
+        file_id, offset, size = self._keydir[key]
+        if size < min_size:
+            return None
+        if file_id == self._active_id and self._unflushed:
+            self._active.flush()
+            self._unflushed = False
+        # A merge can remove the segment, but the open file stays readable
+        return open(self._path(file_id, "data"), "rb"), offset, size
+
+    def delete(self, key):
+        if key not in self._keydir:
+            raise KeyError(key)
+        self._append(key, None)
+        if self.durability == SYNC:
+            self.sync()
+
+    def multi_put(self, kvlist, resolver=None):
+        for k, v in kvlist:
+            if resolver is not None and k in self._keydir:
+                v = resolver(v, self.get(k))
+            self._append(k, v)
+        if self.durability == SYNC:
+            self.sync()
+
+    def sync(self):
+        self._active.flush()
+        self._unflushed = False
+        os.fsync(self._active.fileno())
+
+    def get_iterator(self, start=None, ordered=False):
+        if start is None and not ordered:
+            # A snapshot of the keys, so that writes can go on while iterating
+            return iter(self._keydir.keys())
+        return self._index.after(self._keydir, start)
+
+    def iterate(self, iterator, threshold):
+        tot = 0
+        ret = []
+        for k in iterator:
+            try:
+                v = self.get(k)
+            except KeyError:
+                # Deleted since the iteration started
+                continue
+            tot = tot + len(k) + len(v)
+            ret.append((k, v))
+            if tot >= threshold:
+                break
+        return ret, iterator
+
+    def merge(self, force=False):
+        closed = sorted([f for f in self._sizes if f != self._active_id])
+        if not closed:
+            return False
+        total = sum([self._sizes[f] for f in closed])
+        dead = sum([self._dead.get(f, 0) for f in closed])
+        if not force and dead < total * self.merge_threshold:
+            return False
+        # The merged segment takes the place of the newest closed one. Deletes
+        # can be dropped, since all the older values are merged away too.
+        target = closed[-1]
+        closedset = set(closed)
+        live = [(k, loc) for k, loc in self._keydir.iteritems() if loc[0] in closedset]
+        if os.path.exists(self._path(target, "merged")):
+            # Left by an earlier merge into the same segment, it mustn't commit this one
+            os.remove(self._path(target, "merged"))
+            self._sync_directory()
+        entries, merged_size = self._write_merged(target, live)
+        self._commit_merge(target)
+        self._finish_merge(target, closed)
+        for file_id in closed:
+            if file_id != target:
+                del self._sizes[file_id]
+            self._dead.pop(file_id, None)
+        self._sizes[target] = merged_size
+        for key, voffset, size in entries:
+            self._keydir[key] = (target, voffset, size)
+        return True
+
+    def _write_merged(self, target, live):
+        """
+        Writes the live values to the temporary data and hint files of the
+        merged segment, returns its key directory entries and its size
+        """
+        entries = []
+        offset = 0
+        f = open(self._path(target, "data.tmp"), "wb")
+        try:
+            for key, (file_id, voffset, size) in live:
+                value = self._read(file_id, voffset, size)
+                f.write(self._record.pack(zlib.crc32(value, zlib.crc32(key)) & 0xffffffff, len(key), size))
+                f.write(key)
+                f.write(value)
+                entries.append((key, offset + self._record.size + len(key), size))
+                offset = offset + self._record.size + len(key) + size
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self._write_hint(target, entries, "hint.tmp")
+        return entries, offset
+
+    def _commit_merge(self, target):
+        """
+        Creates the marker of the merge. Before it exists, a crash leaves the
+        segments as they were and the temporary files are removed. After it,
+        the temporary files replace the target and the older segments are
+        superseded, see L{_segments}.
+        """
+        f = open(self._path(target, "merged"), "wb")
+        try:
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self._sync_directory()
+
+    def _finish_merge(self, target, closed):
+        """Moves the merged segment into place, and removes the segments it supersedes"""
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+        os.rename(self._path(target, "data.tmp"), self._path(target, "data"))
+        os.rename(self._path(target, "hint.tmp"), self._path(target, "hint"))
+        for file_id in closed:
+            if file_id != target:
+                for ext in ("data", "hint", "merged"):
+                    if os.path.exists(self._path(file_id, ext)):
+                        os.remove(self._path(file_id, ext))
+        self._sync_directory()
+
+    def close(self):
+        self.sync()
+        self._active.close()
+        self._reader.close()
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+
+
+STORE_TYPES = ("bdb", "sqlite", "log")
+
+def create(store_type, name, durability=SYNC):
+    """
+    Creates a persistent store, with a file (or directory) name based on name
+
+    @param store_type: One of L{STORE_TYPES}
+    """
+    if store_type == "bdb":
+        return BerkeleyDBStore("vc_store_" + name + ".db", durability)
+    elif store_type == "sqlite":
+        return SQLiteStore("vc_store_" + name + ".sqlite", durability)
+    elif store_type == "log":
+        return LogStore("vc_store_" + name + ".log", durability)
+    raise ValueError("Unknown store type %s"%store_type)
+
+
 class TestStores(unittest.TestCase):
     def _test_iterate(self, d):
         contents = [("Key_%d"%i, "Val_%d"%i) for i in range(100)]
@@ -180,17 +848,327 @@ class TestStores(unittest.TestCase):
             kvlist.extend(kv)
         self.assertEqual(set(contents), set([(str(k), str(v)) for k, v in kvlist]))
 
+        # In order, and resumed after a key
+        d.delete("Key_50")
+        expected = sorted([k for k, v in contents if k != "Key_50"])
+        for start in (None, "Key_42"):
+            iterator = d.get_iterator(start, True)
+            kvlist = []
+            while True:
+                kv, iterator = d.iterate(iterator, 100)
+                if not kv:
+                    break
+                kvlist.extend(kv)
+            keys = [str(k) for k, v in kvlist]
+            self.assertEqual(keys, [k for k in expected if start is None or k > start])
+        self.assertEqual(list(d.iterate(d.get_iterator("Key_99"), 100)[0]), [])
+
     def test_iterate_dict(self):
         d = DictStore()
         self._test_iterate(d)
 
     def test_iterate_bdb(self):
-        d = BerkeleyDBStore("bdb")
-        self._test_iterate(d)
+        directory = tempfile.mkdtemp()
+        try:
+            d = BerkeleyDBStore(os.path.join(directory, "bdb"))
+            self._test_iterate(d)
+        finally:
+            shutil.rmtree(directory)
 
     def test_iterate_sqlite(self):
-        d = SQLiteStore("sqlite")
-        self._test_iterate(d)
+        directory = tempfile.mkdtemp()
+        try:
+            d = SQLiteStore(os.path.join(directory, "sqlite"))
+            self._test_iterate(d)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_iterate_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            d = LogStore(directory)
+            self._test_iterate(d)
+            d.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def _test_multi(self, d):
+        d.multi_put([("a", "1"), ("b", "2"), ("c", "3")])
+        d.delete("b")
+        self.assertEqual(sorted([(str(k), str(v)) for k, v in d.multi_get(["a", "b", "c", "x"])]),
+                         [("a", "1"), ("c", "3")])
+        self.assertEqual(d.multi_get([]), [])
+        # Without a resolver the values are replaced
+        d.multi_put([("a", "new"), ("b", "new")])
+        d.multi_put([("a", "+"), ("d", "4")], lambda a, b: str(b) + a)
+        self.assertEqual(sorted([(str(k), str(v)) for k, v in d.multi_get(["a", "b", "d"])]),
+                         [("a", "new+"), ("b", "new"), ("d", "4")])
+
+    def _test_scan(self, d):
+        for i in range(100):
+            d.put("key_%03d"%i, "value_%d"%i)
+        d.delete("key_050")
+        def keys(*args, **kwargs):
+            return [str(k) for k, v in d.scan(*args, **kwargs)]
+        self.assertEqual(len(keys()), 99)
+        self.assertEqual(keys("key_010", "key_015"), ["key_%03d"%i for i in range(10, 15)])
+        self.assertEqual(keys("key_010", "key_015", inclusive=False), ["key_%03d"%i for i in range(11, 15)])
+        self.assertEqual(keys("key_048", "key_053"), ["key_048", "key_049", "key_051", "key_052"])
+        self.assertEqual(keys("key_0", limit=3), ["key_000", "key_001", "key_002"])
+        self.assertEqual(keys("key_097", threshold=1), ["key_097", "key_098", "key_099"])
+        self.assertEqual(keys(None, "key_002", threshold=1), ["key_000", "key_001"])
+        self.assertEqual(keys("x"), [])
+        self.assertEqual(keys("key_010", "key_010"), [])
+        self.assertEqual([str(v) for k, v in d.scan("key_020", limit=1)], ["value_20"])
+        # Written after the scans
+        d.put("key_050", "again")
+        d.put("key_100", "new")
+        d.put("key_011", "changed")
+        d.delete("key_010")
+        self.assertEqual(keys("key_008", "key_012"), ["key_008", "key_009", "key_011"])
+        self.assertEqual(keys("key_049", "key_051"), ["key_049", "key_050"])
+        self.assertEqual(keys("key_098"), ["key_098", "key_099", "key_100"])
+        self.assertEqual(len(keys()), 100)
+
+    def test_scan_dict(self):
+        self._test_scan(DictStore())
+
+    def test_scan_bdb(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self._test_scan(BerkeleyDBStore(os.path.join(directory, "bdb")))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_scan_sqlite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self._test_scan(SQLiteStore(os.path.join(directory, "sqlite")))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_scan_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            d = LogStore(directory)
+            self._test_scan(d)
+            d.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_multi_dict(self):
+        self._test_multi(DictStore())
+
+    def test_multi_bdb(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self._test_multi(BerkeleyDBStore(os.path.join(directory, "bdb")))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_multi_sqlite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            d = SQLiteStore(os.path.join(directory, "sqlite"))
+            d.max_parameters = 2
+            self._test_multi(d)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_multi_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            d = LogStore(directory)
+            self._test_multi(d)
+            d.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            d = LogStore(directory, GROUP)
+            d.max_segment_size = 100
+            for i in range(50):
+                d.put("key_%d"%(i % 10), "value_%d"%i)
+            d.delete("key_0")
+            self.assertRaises(KeyError, d.delete, "key_0")
+            d.multi_put([("key_1", "new"), ("key_new", "new")], lambda a, b: a + b)
+            self.assertRaises(KeyError, d.get, "key_0")
+            self.assertEqual(d.get("key_1"), "new" + "value_41")
+            self.assertEqual(d.get("key_9"), "value_49")
+            self.assertEqual(d.get("key_new"), "new")
+            d.close()
+
+            # Reopen using the hints, and merge
+            d = LogStore(directory)
+            self.assertRaises(KeyError, d.get, "key_0")
+            self.assertEqual(d.get("key_9"), "value_49")
+            self.assertTrue(d.merge())
+            self.assertFalse(d.merge())
+            self.assertRaises(KeyError, d.get, "key_0")
+            self.assertEqual(d.get("key_1"), "new" + "value_41")
+            d.put("key_2", "after merge")
+            d.close()
+
+            d = LogStore(directory)
+            self.assertRaises(KeyError, d.get, "key_0")
+            self.assertEqual(d.get("key_2"), "after merge")
+            self.assertEqual(d.get("key_9"), "value_49")
+            self.assertEqual(len(d._keydir), 10)
+            d.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_file_region(self):
+        self.assertEqual(DictStore().get_file_region("a"), None)
+        directory = tempfile.mkdtemp()
+        try:
+            d = LogStore(directory, GROUP)
+            d.max_segment_size = 100
+            d.put("a", "x" * 100)
+            d.put("b", "y" * 10)
+            self.assertEqual(d.get_file_region("b", 100), None)
+            self.assertRaises(KeyError, d.get_file_region, "c")
+            for key in ("a", "b"):
+                f, offset, size = d.get_file_region(key)
+                f.seek(offset)
+                self.assertEqual(f.read(size), str(d.get(key)))
+                f.close()
+            # Still readable after the merge removed the segment
+            f, offset, size = d.get_file_region("a")
+            d.put("a", "z")
+            self.assertTrue(d.merge(True))
+            f.seek(offset)
+            self.assertEqual(f.read(size), "x" * 100)
+            f.close()
+            d.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_log_torn_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            d = LogStore(directory)
+            d.put("a", "1")
+            d.put("b", "2")
+            d.close()
+            f = open(d._path(d._active_id, "data"), "ab")
+            f.write("garbage")
+            f.close()
+            d = LogStore(directory)
+            self.assertEqual(d.get("a"), "1")
+            self.assertEqual(d.get("b"), "2")
+            d.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_log_interrupted_merge(self):
+        class Crash(Exception):
+            pass
+        def crash(*args):
+            raise Crash()
+        def rename_data_and_crash(target, closed):
+            os.rename(d._path(target, "data.tmp"), d._path(target, "data"))
+            raise Crash()
+        for step in ("_commit_merge", "_finish_merge", rename_data_and_crash):
+            directory = tempfile.mkdtemp()
+            try:
+                d = LogStore(directory)
+                d.max_segment_size = 60
+                expected = {}
+                for i in range(20):
+                    key = "k%02d"%i
+                    expected[key] = "v%02d"%i + "x" * i
+                    d.put(key, expected[key])
+                for i in range(0, 20, 2):
+                    key = "k%02d"%i
+                    expected[key] = "w%02d"%i
+                    d.put(key, expected[key])
+                d.delete("k03")
+                del expected["k03"]
+                d._rotate()
+                if isinstance(step, str):
+                    setattr(d, step, crash)
+                else:
+                    d._finish_merge = step
+                self.assertRaises(Crash, d.merge, True)
+                # Reopen without closing, like after a crash
+                d = LogStore(directory)
+                self.assertRaises(KeyError, d.get, "k03")
+                self.assertEqual(len(d._keydir), len(expected))
+                for key, value in expected.items():
+                    self.assertEqual(d.get(key), value)
+                self.assertFalse([n for n in os.listdir(directory) if n.endswith(".tmp")])
+                self.assertTrue(d.merge(True))
+                d.close()
+                d = LogStore(directory)
+                for key, value in expected.items():
+                    self.assertEqual(d.get(key), value)
+                self.assertRaises(KeyError, d.get, "k03")
+                d.close()
+            finally:
+                shutil.rmtree(directory)
+
+    def test_sqlite_group(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "sqlite")
+            d = SQLiteStore(filename, GROUP)
+            d.put("a", "1")
+            other = SQLiteStore(filename)
+            self.assertRaises(KeyError, other.get, "a")
+            d.sync()
+            self.assertEqual(str(other.get("a")), "1")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sorted_keys(self):
+        index = SortedKeys()
+        # Not built until it's needed
+        index.add("b")
+        self.assertEqual(len(index), 0)
+        keys = set(["d", "b", "f"])
+        self.assertEqual(list(index.after(keys)), ["b", "d", "f"])
+        self.assertEqual(list(index.after(keys, "b")), ["d", "f"])
+        self.assertEqual(list(index.after(keys, "c")), ["d", "f"])
+        self.assertEqual(list(index.after(keys, "f")), [])
+        index.add("a")
+        index.add("e")
+        index.remove("d")
+        index.remove("x")
+        self.assertEqual(list(index.after(keys)), ["a", "b", "e", "f"])
+        # Changes during an iteration
+        it = index.after(keys)
+        self.assertEqual(it.next(), "a")
+        index.remove("a")
+        index.remove("b")
+        index.add("c")
+        index.add("0")
+        self.assertEqual(list(it), ["c", "e", "f"])
+
+    def test_group_commit(self):
+        g = GroupCommit(max_batch=2)
+        self.assertTrue(g.add(1))
+        self.assertFalse(g.full())
+        self.assertFalse(g.add(2))
+        self.assertTrue(g.full())
+        batch = g.batch
+        self.assertEqual(g.take(), [1, 2])
+        self.assertNotEqual(g.batch, batch)
+        self.assertEqual(g.take(), [])
+        self.assertEqual(g.syncs, 1)
+        self.assertTrue(g.add(3))
+
+    def test_delete_unchanged(self):
+        d = DictStore()
+        d.put("a", "1")
+        d.put("b", "2")
+        d.put("c", "3")
+        self.assertEqual(d.delete_unchanged([("a", "1"), ("b", "1"), ("x", "1")]), 1)
+        self.assertRaises(KeyError, d.get, "a")
+        self.assertEqual(d.get("b"), "2")
+        self.assertEqual(d.get("c"), "3")
 
 if __name__=="__main__":
     unittest.main()